@@ -1,28 +1,74 @@
 import settings  # load env before any imports
-from flask import Flask
+import os
+import time
+from flask import Flask, g, make_response, request
 from flask_restful import Api
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.middleware.proxy_fix import ProxyFix
-from resources.terms import Article, Term
+from resources.terms import Article, Term, TermList
+from resources.jobs import JobList, Job
+from resources.metrics import Metrics
+from resources.health import Health
+from libs.jobs import job_runner
+from libs.tagger import tagger_supervisor
+from libs.term_search import query_cache, CACHE_SNAPSHOT
+from utils import fast_json
+from utils.metrics import registry, start_timing, stop_timing, server_timing, HTTP_REQUESTS, SERVER_TIMING
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=1)  # fix x-forwarded-for
-limiter = Limiter(app, key_func=get_remote_address, default_limits=["2/second"])
+RATE_LIMIT = os.getenv('RATE_LIMIT', '2/second')  # per client address, raised for benchmarks
+limiter = Limiter(app, key_func=get_remote_address, default_limits=[RATE_LIMIT])
 api = Api(app)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # limit request size to 10MB
 app.config['PROPAGATE_EXCEPTIONS'] = True
+tagger_supervisor.start_servers()  # once, before uWSGI forks its workers
+if CACHE_SNAPSHOT:
+    query_cache.load_snapshot(CACHE_SNAPSHOT)
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    # compact JSON, encoded with orjson when it is installed
+    response = make_response(fast_json.dumps(data), code)
+    response.headers.extend(headers or {})
+    response.mimetype = 'application/json'
+    return response
+
+
+@app.before_request
+def before_request():
+    job_runner.ensure_started()  # once per process, since threads do not survive uWSGI forking
+    tagger_supervisor.ensure_started()
+    registry.ensure_started()
+    g.start_time = time.time()
+    start_timing()
 
 
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+    stages = stop_timing()
+    if 'start_time' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        HTTP_REQUESTS.observe(time.time() - g.start_time, endpoint=endpoint, method=request.method,
+                              status=response.status_code)
+    if SERVER_TIMING and stages:
+        response.headers.add('Server-Timing', server_timing(stages))
     return response
 
 
 api.add_resource(Article, '/articles')
 api.add_resource(Term, '/term/<string:term>')
+api.add_resource(TermList, '/terms')
+api.add_resource(JobList, '/jobs')
+api.add_resource(Job, '/jobs/<string:job_id>')
+api.add_resource(Metrics, '/metrics')
+api.add_resource(Health, '/health')
+limiter.exempt(app.view_functions['metrics'])  # scrapers and load balancers must not be throttled
+limiter.exempt(app.view_functions['health'])
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,257 @@
+"""
+Replayable PubMed and OMIM fixtures for benchmarks.
+
+A fixture directory holds, for each term, the EFetch result of its PubMed articles in `pubmed/<term>.xml` (in ESearch
+order) and the OMIM search response in `omim/<term>.json`. Fixtures are either recorded from the live APIs or
+generated from the sentences of `sample.txt`, and served by a local server standing in for E-utilities and the OMIM
+API. Point the app at it with PUBMED_BASE_URL=http://<host>:<port>/eutils and OMIM_BASE_URL=http://<host>:<port>/omim.
+
+    python -m bench.fixtures generate bench/data --terms 100
+    python -m bench.fixtures record bench/data rs333 rs7412
+    python -m bench.fixtures serve bench/data --port 8001 --latency 0.1
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import requests
+
+PUBMED_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+OMIM_URL = 'https://api.omim.org/api/entry/search'
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample.txt')
+
+_SENTENCE = re.compile(r'(?<=[.!?])\s+(?=[A-Z])')
+
+
+def sample_sentences(path: str = SAMPLE_PATH) -> List[str]:
+    """
+    :param path: a request body of `/articles`, optionally preceded by comment lines starting with `#`
+    :return: the sentences of its articles
+    """
+    with open(path) as file:
+        body = json.loads(''.join(line for line in file if not line.startswith('#')))
+    return [sentence for article in body['articles'] for sentence in _SENTENCE.split(article['text']) if sentence]
+
+
+def sample_text(rng: random.Random, sentences: List[str], median_length: int = 1200) -> str:
+    """
+    :return: a text of sentences drawn from `sentences`, with a log-normal length like PubMed abstracts
+    """
+    length = min(int(rng.lognormvariate(math.log(median_length), 0.5)), 20 * median_length)
+    text = []
+    while sum(len(each) + 1 for each in text) < length:
+        text.append(rng.choice(sentences))
+    return ' '.join(text)
+
+
+def _efetch_article(pubmed_id: str, title: str, abstract: str) -> str:
+    return (f'<PubmedArticle><MedlineCitation><PMID>{pubmed_id}</PMID><Article>'
+            f'<ArticleTitle>{escape(title)}</ArticleTitle><Abstract><AbstractText>{escape(abstract)}</AbstractText>'
+            f'</Abstract></Article></MedlineCitation></PubmedArticle>')
+
+
+def _efetch_document(articles: List[str]) -> str:
+    return '<?xml version="1.0" ?>\n<PubmedArticleSet>' + ''.join(articles) + '</PubmedArticleSet>\n'
+
+
+def _omim_response(rsid: str, entries: List[Dict]) -> Dict:
+    return {'omim': {'version': '1.0', 'searchResponse': {'search': f'av_db_snp:{rsid}', 'entryList': entries}}}
+
+
+def generate(directory: str, terms: int, seed: int = 0, median_articles: int = 15, omim_ratio: float = 0.3,
+             sample_path: str = SAMPLE_PATH) -> None:
+    """
+    generate fixtures for `terms` rsIDs, with a log-normal number of articles per term. Articles are shared between
+    terms now and then, like in PubMed.
+    """
+    rng = random.Random(seed)
+    sentences = sample_sentences(sample_path)
+    os.makedirs(os.path.join(directory, 'pubmed'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'omim'), exist_ok=True)
+    articles = {}  # pubmed id -> EFetch article
+    for n in range(terms):
+        term = f'rs{rng.randrange(1, 10 ** 9)}'
+        count = min(int(rng.lognormvariate(math.log(median_articles), 1)), 1000)
+        ids = []
+        for _ in range(count):
+            if articles and rng.random() < 0.1:
+                ids.append(rng.choice(list(articles)))
+                continue
+            pubmed_id = str(rng.randrange(10 ** 7, 4 * 10 ** 7))
+            articles[pubmed_id] = _efetch_article(pubmed_id, rng.choice(sentences), sample_text(rng, sentences))
+            ids.append(pubmed_id)
+        with open(os.path.join(directory, 'pubmed', f'{term}.xml'), 'w') as file:
+            file.write(_efetch_document([articles[pubmed_id] for pubmed_id in dict.fromkeys(ids)]))
+
+        entries = []
+        if rng.random() < omim_ratio:
+            mim_number = rng.randrange(100000, 700000)
+            variant = {'mimNumber': mim_number, 'number': rng.randrange(1, 100), 'dbSnps': term,
+                       'text': sample_text(rng, sentences, 600)}
+            entries = [{'entry': {'mimNumber': mim_number, 'allelicVariantList': [{'allelicVariant': variant}]}}]
+        with open(os.path.join(directory, 'omim', f'{term}.json'), 'w') as file:
+            json.dump(_omim_response(term, entries), file)
+    print(f'generated fixtures of {terms} terms and {len(articles)} articles in {directory}')
+
+
+def record(directory: str, terms: List[str], ret_max: int = 50) -> None:
+    """
+    record the live PubMed and OMIM responses of terms, using PUBMED_KEY and OMIM_KEY from env
+    """
+    os.makedirs(os.path.join(directory, 'pubmed'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'omim'), exist_ok=True)
+    for term in terms:
+        params = {'db': 'pubmed', 'term': term, 'retmax': ret_max, 'api_key': os.getenv('PUBMED_KEY')}
+        search = ElementTree.fromstring(requests.get(f'{PUBMED_URL}/esearch.fcgi', params=params).text)
+        ids = [each.text for each in search.findall('./IdList/Id')]
+        document = _efetch_document([])
+        if ids:
+            params = {'db': 'pubmed', 'retmode': 'xml', 'id': ','.join(ids), 'api_key': os.getenv('PUBMED_KEY')}
+            document = requests.get(f'{PUBMED_URL}/efetch.fcgi', params=params).text
+        with open(os.path.join(directory, 'pubmed', f'{term}.xml'), 'w') as file:
+            file.write(document)
+
+        params = {'search': f'av_db_snp:{term}', 'include': 'allelicVariantList', 'format': 'json'}
+        res = requests.get(OMIM_URL, params=params, headers={'apiKey': os.getenv('OMIM_KEY', '')})
+        with open(os.path.join(directory, 'omim', f'{term}.json'), 'w') as file:
+            json.dump(res.json() if res.ok else _omim_response(term, []), file)
+        print(f'recorded {term}: {len(ids)} PubMed articles, OMIM status {res.status_code}')
+        time.sleep(0.2)  # stay under the E-utilities rate limit
+
+
+class Fixtures:
+    """
+    The articles and OMIM responses of a fixture directory, indexed for the fixture server
+    """
+
+    def __init__(self, directory: str):
+        self.articles: Dict[str, bytes] = {}  # pubmed id -> serialized PubmedArticle
+        self.term_ids: Dict[str, List[str]] = {}
+        self.omim: Dict[str, bytes] = {}
+        for path in glob.glob(os.path.join(directory, 'pubmed', '*.xml')):
+            term = os.path.splitext(os.path.basename(path))[0]
+            ids = []
+            for article in ElementTree.parse(path).getroot().iterfind('./PubmedArticle'):
+                pubmed_id = article.findtext('./MedlineCitation/PMID')
+                self.articles[pubmed_id] = ElementTree.tostring(article)
+                ids.append(pubmed_id)
+            self.term_ids[term] = ids
+        for path in glob.glob(os.path.join(directory, 'omim', '*.json')):
+            with open(path, 'rb') as file:
+                self.omim[os.path.splitext(os.path.basename(path))[0]] = file.read()
+
+    @property
+    def terms(self) -> List[str]:
+        return sorted(set(self.term_ids) | set(self.omim))
+
+    def esearch(self, term: str, ret_max: int) -> bytes:
+        ids = self.term_ids.get(term, [])
+        id_list = ''.join(f'<Id>{pubmed_id}</Id>' for pubmed_id in ids[:ret_max])
+        return (f'<?xml version="1.0" ?>\n<eSearchResult><Count>{len(ids)}</Count><RetMax>{min(ret_max, len(ids))}'
+                f'</RetMax><RetStart>0</RetStart><QueryKey>1</QueryKey><WebEnv>{escape(term)}</WebEnv>'
+                f'<IdList>{id_list}</IdList></eSearchResult>\n').encode()
+
+    def efetch(self, ids: List[str]) -> bytes:
+        return (b'<?xml version="1.0" ?>\n<PubmedArticleSet>' +
+                b''.join(self.articles[pubmed_id] for pubmed_id in ids if pubmed_id in self.articles) +
+                b'</PubmedArticleSet>\n')
+
+    def omim_search(self, search: str) -> bytes:
+        rsid = search.split(':', 1)[-1]
+        return self.omim.get(rsid) or json.dumps(_omim_response(rsid, [])).encode()
+
+
+def make_handler(fixtures: Fixtures, latency: float, jitter: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path.endswith('/esearch.fcgi'):
+                body, content_type = fixtures.esearch(params.get('term', ''), int(params.get('retmax', 20))), 'text/xml'
+            elif url.path.endswith('/efetch.fcgi'):
+                if 'id' in params:
+                    ids = params['id'].split(',')
+                else:
+                    start = int(params.get('retstart', 0))
+                    ids = fixtures.term_ids.get(params.get('WebEnv'), [])[start:start + int(params.get('retmax', 20))]
+                body, content_type = fixtures.efetch(ids), 'text/xml'
+            elif url.path.endswith('/entry/search'):
+                body, content_type = fixtures.omim_search(params.get('search', '')), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            time.sleep(max(0.0, random.gauss(latency, jitter)))
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(directory: str, host: str = '127.0.0.1', port: int = 8001, latency: float = 0.1,
+          jitter: float = 0.03) -> Tuple[ThreadingHTTPServer, threading.Thread]:
+    """
+    serve a fixture directory in a background thread
+    :param latency: mean seconds added to each response, to mimic the round trip to the real APIs
+    :param jitter: standard deviation of the added latency
+    :return: the server and its thread
+    """
+    fixtures = Fixtures(directory)
+    server = ThreadingHTTPServer((host, port), make_handler(fixtures, latency, jitter))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='fixtures', daemon=True)
+    thread.start()
+    print(f'serving fixtures of {len(fixtures.terms)} terms at http://{host}:{server.server_address[1]}')
+    return server, thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    generate_parser = commands.add_parser('generate', help='generate fixtures from sample.txt')
+    generate_parser.add_argument('directory')
+    generate_parser.add_argument('--terms', type=int, default=100)
+    generate_parser.add_argument('--median-articles', type=int, default=15)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    record_parser = commands.add_parser('record', help='record live responses, with PUBMED_KEY and OMIM_KEY')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('terms', nargs='+')
+    serve_parser = commands.add_parser('serve', help='serve fixtures')
+    serve_parser.add_argument('directory')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8001)
+    serve_parser.add_argument('--latency', type=float, default=0.1)
+    serve_parser.add_argument('--jitter', type=float, default=0.03)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.directory, args.terms, args.seed, args.median_articles)
+    elif args.command == 'record':
+        record(args.directory, args.terms)
+    elif args.command == 'serve':
+        _, thread = serve(args.directory, args.host, args.port, args.latency, args.jitter)
+        thread.join()
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+"""
+Load driver for `/articles` and `/term`. It sends requests at several concurrency levels and reports the latency
+percentiles, the throughput and the CPU time of the app per request, as JSON so that runs can be compared.
+
+By default, it serves a fixture directory (see `bench.fixtures`) and starts the app against it, with the fake MetaMap
+of `bench/fake_metamap`, under uWSGI when installed and the Flask server otherwise. With `--url`, it drives an app
+already running, whose CPU time is measured when `--pid` gives its master process.
+
+    python -m bench.fixtures generate bench/data
+    python -m bench.load --fixtures bench/data --concurrency 1,4,16 --output results.json
+    python -m bench.load --fixtures bench/data --output new.json --baseline results.json
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+import requests
+
+from bench import fixtures
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_METAMAP_PATH = os.path.join(ROOT, 'bench', 'fake_metamap')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+Request = Tuple[str, str, Dict]  # endpoint name, path and JSON body
+
+
+class Workload:
+    """
+    Random requests with realistic sizes: a log-normal number of articles per `/articles` request, of log-normal
+    lengths, and terms drawn from the fixtures for `/term`.
+    """
+
+    def __init__(self, mix: Dict[str, float], terms: List[str], seed: int = 0, median_articles: int = 10,
+                 cache_hit_ratio: float = 0.0, use_cache: bool = False, replay: List[Request] = None):
+        self.mix = mix
+        self.terms = terms
+        self.median_articles = median_articles
+        self.cache_hit_ratio = cache_hit_ratio
+        self.use_cache = use_cache
+        self.replay = replay
+        self._rng = random.Random(seed)
+        self._sentences = fixtures.sample_sentences()
+        self._sent = []  # articles sent so far, reused to hit the article cache
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> Request:
+        with self._lock:
+            self._count += 1
+            if self.replay:
+                return self.replay[(self._count - 1) % len(self.replay)]
+            endpoint = self._rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            if endpoint == 'term':
+                return 'term', f'/term/{self._rng.choice(self.terms)}', {'use_cache': self.use_cache}
+            count = max(1, min(int(self._rng.lognormvariate(math.log(self.median_articles), 1)), 200))
+            return 'articles', '/articles', {'articles': [self._article() for _ in range(count)]}
+
+    def _article(self) -> Dict:
+        if self._sent and self._rng.random() < self.cache_hit_ratio:
+            return self._rng.choice(self._sent)
+        # a unique first sentence keeps the article out of the caches
+        text = f'Cohort {uuid.uuid4().hex[:12]} was studied. ' + fixtures.sample_text(self._rng, self._sentences)
+        article = {'source': 'pubmed', 'id': str(self._rng.randrange(10 ** 7, 4 * 10 ** 7)), 'text': text}
+        self._sent.append(article)
+        return article
+
+
+def read_replay(path: str) -> List[Request]:
+    """
+    :param path: JSON lines of `{"path": "/articles", "body": {...}}`
+    """
+    res = []
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                request = json.loads(line)
+                res.append((request['path'].strip('/').split('/')[0], request['path'], request.get('body') or {}))
+    return res
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    :return: CPU seconds used by a process and its descendants, including those that have been waited for
+    """
+    parents = {}
+    times = {}
+    for path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(path) as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue  # exited meanwhile
+        child = int(path.split('/')[2])
+        parents[child] = int(fields[1])
+        times[child] = sum(int(each) for each in fields[11:15]) / CLOCK_TICKS  # utime, stime, cutime, cstime
+    total = 0.0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += times.get(current, 0.0)
+        pending.extend(child for child, parent in parents.items() if parent == current)
+    return total
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def summarize(latencies: List[float]) -> Dict:
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max': max(latencies, default=0.0),
+    }
+
+
+def run_level(url: str, workload: Workload, concurrency: int, requests_count: int, duration: float,
+              timeout: float, cpu: Callable[[], float] = None) -> Dict:
+    """
+    send requests from `concurrency` clients, each sending its next request once the previous one is answered,
+    until `requests_count` requests are sent or `duration` seconds have passed
+    """
+    results = []  # (endpoint, status, seconds, articles)
+    lock = threading.Lock()
+    sent = [0]
+    deadline = time.time() + duration if duration else None
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if sent[0] >= requests_count or deadline and time.time() > deadline:
+                    return
+                sent[0] += 1
+            endpoint, path, body = workload.next()
+            start = time.time()
+            try:
+                res = session.post(f'{url}{path}', json=body, timeout=timeout)
+                status = res.status_code
+            except requests.RequestException:
+                status = 0
+            with lock:
+                results.append((endpoint, status, time.time() - start, len(body.get('articles', []))))
+
+    cpu_before = cpu() if cpu else None
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    cpu_used = cpu() - cpu_before if cpu else None
+
+    ok = [each for each in results if each[1] == 200]
+    level = {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'status': {str(status): count for status, count in sorted(Counter(each[1] for each in results).items())},
+        'duration': elapsed,
+        'throughput': len(ok) / elapsed if elapsed else 0.0,
+        'articles_per_second': sum(each[3] for each in ok) / elapsed if elapsed else 0.0,
+        'latency': summarize([each[2] for each in ok]),
+        'endpoints': {endpoint: summarize([each[2] for each in ok if each[0] == endpoint])
+                      for endpoint in sorted({each[0] for each in results})},
+        'cpu_seconds_per_request': cpu_used / len(results) if cpu_used is not None and results else None,
+    }
+    print(f'concurrency {concurrency}: {level["requests"]} requests, {level["errors"]} errors, '
+          f'{level["throughput"]:.2f} req/s, p50 {level["latency"]["p50"]:.3f}s, p95 {level["latency"]["p95"]:.3f}s, '
+          f'p99 {level["latency"]["p99"]:.3f}s, cpu/request {level["cpu_seconds_per_request"]}')
+    return level
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(fixtures_url: str, processes: int, server: str, env: Dict[str, str], workdir: str) -> Tuple:
+    """
+    start the app against the fixture server and the fake MetaMap
+    :return: the app process and its url
+    """
+    port = free_port()
+    app_env = dict(os.environ)
+    app_env.update({
+        'METAMAP_PATH': FAKE_METAMAP_PATH,
+        'PUBMED_BASE_URL': f'{fixtures_url}/eutils',
+        'OMIM_BASE_URL': f'{fixtures_url}/omim',
+        'PUBMED_KEY': 'bench',
+        'OMIM_KEY': 'bench',
+        'RATE_LIMIT': '1000000/second',
+        'JOBS_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'METAMAP_SLOTS_PATH': os.path.join(workdir, 'slots.sqlite3'),
+        'CACHE_PATH': os.path.join(workdir, 'cache.sqlite3'),
+    })
+    app_env.update(env)
+    if server == 'auto':
+        server = 'uwsgi' if any(os.access(os.path.join(each, 'uwsgi'), os.X_OK)
+                                for each in os.environ.get('PATH', '').split(os.pathsep)) else 'flask'
+    if server == 'uwsgi':
+        command = ['uwsgi', '--http', f'127.0.0.1:{port}', '--module', 'app:app', '--master', '--enable-threads',
+                   '--processes', str(processes), '--threads', '4', '--die-on-term', '--disable-logging']
+    else:
+        if processes > 1:
+            print('the Flask server runs a single process, install uWSGI to run several')
+        command = [sys.executable, '-c', f'from app import app; app.run(port={port}, threaded=True)']
+    log = open(os.path.join(workdir, 'app.log'), 'w')
+    process = subprocess.Popen(command, cwd=ROOT, env=app_env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f'the app exited, see {log.name}')
+        try:
+            if requests.get(f'{url}/health', timeout=1).ok:
+                print(f'app started with {server} at {url}, logging to {log.name}')
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f'the app did not start, see {log.name}')
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> bool:
+    """
+    print the change of each level from the baseline
+    :return: whether no p95 latency or throughput regressed by more than `tolerance`
+    """
+    ok = True
+    levels = {level['concurrency']: level for level in baseline['levels']}
+    for level in results['levels']:
+        before = levels.get(level['concurrency'])
+        if before is None:
+            continue
+        changes = {
+            'p50': (before['latency']['p50'], level['latency']['p50'], 1),
+            'p95': (before['latency']['p95'], level['latency']['p95'], 1),
+            'throughput': (before['throughput'], level['throughput'], -1),
+            'cpu/request': (before['cpu_seconds_per_request'], level['cpu_seconds_per_request'], 1),
+        }
+        report = []
+        for name, (old, new, direction) in changes.items():
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            report.append(f'{name} {change:+.1%}')
+            if name in ('p95', 'throughput') and change * direction > tolerance:
+                ok = False
+        print(f'concurrency {level["concurrency"]} vs baseline: {", ".join(report)}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=os.path.join(ROOT, 'bench', 'data'), help='fixture directory')
+    parser.add_argument('--fixtures-latency', type=float, default=0.1, help='seconds added to fixture responses')
+    parser.add_argument('--url', help='url of an app already running, instead of starting one')
+    parser.add_argument('--pid', type=int, help='pid of the app already running, to measure its CPU time')
+    parser.add_argument('--server', choices=('auto', 'uwsgi', 'flask'), default='auto')
+    parser.add_argument('--processes', type=int, default=2, help='app processes, under uWSGI')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE set in the env of the app')
+    parser.add_argument('--mix', default='articles:1,term:1', help='weights of the endpoints')
+    parser.add_argument('--replay', help='JSON lines of requests to send instead of random ones')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=100, help='requests per concurrency level')
+    parser.add_argument('--duration', type=float, help='seconds per concurrency level, at most')
+    parser.add_argument('--warmup', type=int, default=5, help='requests sent before measuring')
+    parser.add_argument('--median-articles', type=int, default=10, help='median number of articles per request')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.0, help='share of articles sent before')
+    parser.add_argument('--use-cache', action='store_true', help='let `/term` use the term cache')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path of the JSON results')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='regression of p95 or throughput to fail on')
+    args = parser.parse_args()
+
+    mix = {name: float(weight) for name, weight in (each.split(':') for each in args.mix.split(','))}
+    replay = read_replay(args.replay) if args.replay else None
+    terms = []
+    server = app = workdir = None
+    if os.path.isdir(args.fixtures):
+        terms = fixtures.Fixtures(args.fixtures).terms
+    elif 'term' in mix and not replay:
+        parser.error(f'no fixtures at {args.fixtures}, create them with `python -m bench.fixtures generate`')
+    if not terms:
+        mix.pop('term', None)
+
+    url, pid = args.url, args.pid
+    started_at = time.time()
+    try:
+        if url is None:
+            server, _ = fixtures.serve(args.fixtures, port=0, latency=args.fixtures_latency)
+            workdir = tempfile.mkdtemp(prefix='metamapy_bench_')
+            env = dict(each.split('=', 1) for each in args.env)
+            app, url = start_app(f'http://127.0.0.1:{server.server_address[1]}', args.processes, args.server, env,
+                                 workdir)
+            pid = app.pid
+        cpu = (lambda: cpu_seconds(pid)) if pid else None
+
+        workload = Workload(mix, terms, args.seed, args.median_articles, args.cache_hit_ratio, args.use_cache, replay)
+        if args.warmup:
+            run_level(url, workload, 1, args.warmup, None, args.timeout)
+        levels = [run_level(url, workload, int(concurrency), args.requests, args.duration, args.timeout, cpu)
+                  for concurrency in args.concurrency.split(',')]
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        if server is not None:
+            server.shutdown()
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    results = {'commit': commit, 'started_at': started_at, 'config': vars(args), 'levels': levels}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'results written to {args.output}')
+    if args.baseline:
+        with open(args.baseline) as file:
+            if not compare(results, json.load(file), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import heapq
+from typing import List, Dict
+
+
+class TermAggregator:
+    """
+    Incrementally merge the MetaMap entries of articles into terms, as soon as each article has been parsed.
+    Sources (and matched words) are tracked in sets, so merging an article costs O(1) per entry.
+    """
+
+    def __init__(self):
+        self._terms = {}  # CUI -> term
+
+    def add(self, source_name: str, source_id: str, entries: List[Dict]) -> None:
+        """
+        merge the MetaMap entries of an article
+        :param source_name: source of the article, e.g. pubmed
+        :param source_id: id of the article within its source
+        :param entries: MetaMap entries of the article
+        """
+        for entry in entries:
+            term = self._terms.get(entry['CUI'])
+            if term is None:  # new term
+                term = self._new_term(entry)
+            term['count'] += 1
+            self._add_occurrence(term, source_name, source_id, entry)
+
+    def _new_term(self, entry: Dict) -> Dict:
+        term = self._terms[entry['CUI']] = {
+            'term': entry['term'],
+            'category': entry['category'],
+            'count': 0,
+            'sources': {},
+        }
+        return term
+
+    def _add_occurrence(self, term: Dict, source_name: str, source_id: str, entry: Dict) -> None:
+        term['sources'].setdefault(source_name, set()).add(source_id)
+
+        # structured output only: best score, matched words and positions in each article
+        if 'score' in entry:
+            term['score'] = max(term.get('score', 0), entry['score'])
+            term.setdefault('matched_words', set()).update(entry['matched_words'])
+            positions = term.setdefault('positions', {}).setdefault(source_name, {})
+            positions.setdefault(source_id, []).extend(entry['positions'])
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def terms(self) -> List[Dict]:
+        """
+        :return: the terms found so far sorted by occurrence, in the format of the API response
+        """
+        res = []
+        for cui, term in self._terms.items():
+            item = dict(term)
+            item['sources'] = {name: sorted(ids) for name, ids in term['sources'].items()}
+            if 'matched_words' in term:
+                item['matched_words'] = sorted(term['matched_words'])
+            item['CUI'] = cui  # add cui as a key
+            res.append(item)
+        res.sort(key=lambda x: x['count'], reverse=True)
+        return res
+
+
+class TopKTermAggregator(TermAggregator):
+    """
+    TermAggregator keeping only the `capacity` most frequent terms with the Space-Saving algorithm, so that its memory
+    does not grow with the number of articles. Once all slots are taken, a new term replaces the least frequent one
+    and starts from its count, which is reported as `count_error`: the true count of a term lies between
+    `count - count_error` and `count`, and every term occurring more than (occurrences so far / capacity) times is kept.
+    Only the first `max_sources` articles of a term are listed in its sources, and contribute positions, score and
+    matched words.
+    """
+
+    def __init__(self, capacity: int, max_sources: int):
+        super().__init__()
+        self.capacity = capacity
+        self.max_sources = max_sources
+        self._heap = []  # (count, CUI) pushed on every occurrence, entries whose count is outdated are skipped
+
+    def add(self, source_name: str, source_id: str, entries: List[Dict]) -> None:
+        super().add(source_name, source_id, entries)
+        if len(self._heap) > 4 * self.capacity:  # drop outdated entries
+            self._heap = [(term['count'], cui) for cui, term in self._terms.items()]
+            heapq.heapify(self._heap)
+
+    def _new_term(self, entry: Dict) -> Dict:
+        count = self._evict() if len(self._terms) >= self.capacity else 0
+        term = super()._new_term(entry)
+        if count:
+            term['count'] = term['count_error'] = count
+        return term
+
+    def _evict(self) -> int:
+        """
+        remove the least frequent term
+        :return: its count
+        """
+        while True:
+            count, cui = heapq.heappop(self._heap)
+            term = self._terms.get(cui)
+            if term is not None and term['count'] == count:
+                del self._terms[cui]
+                return count
+
+    def _add_occurrence(self, term: Dict, source_name: str, source_id: str, entry: Dict) -> None:
+        heapq.heappush(self._heap, (term['count'], entry['CUI']))
+        if source_id not in term['sources'].get(source_name, ()) and \
+                sum(len(ids) for ids in term['sources'].values()) >= self.max_sources:
+            return
+        super()._add_occurrence(term, source_name, source_id, entry)
@@ -0,0 +1,139 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Dict, Iterable, List, Tuple, Union
+
+from libs.efetch import parse_efetch
+from libs.omim_search import parse_omim_search
+from utils.logger import logger
+from utils.sqlite import SQLiteConnections
+
+"""
+Read from env for ARTICLE_STORE_PATH and OMIM_REFRESH_INTERVAL
+ARTICLE_STORE_PATH is optional, defines the path of the SQLite database storing fetched articles. Articles are fetched
+again on every query when it is not set.
+OMIM_REFRESH_INTERVAL is optional, defines after how many seconds the OMIM variant of a rsID is fetched again,
+defaults to 30 days. PubMed articles are immutable and never refreshed.
+"""
+ARTICLE_STORE_PATH = os.getenv('ARTICLE_STORE_PATH')
+logger.info(f'ARTICLE_STORE_PATH={ARTICLE_STORE_PATH}')
+try:
+    OMIM_REFRESH_INTERVAL = float(os.getenv('OMIM_REFRESH_INTERVAL', 30 * 24 * 3600))
+except ValueError:
+    raise EnvironmentError('Expect OMIM_REFRESH_INTERVAL to evaluate to a number.')
+
+
+class ArticleStore:
+    """
+    Local store of articles keyed by (source, id), with compressed text, shared by all app processes.
+    OMIM lookups are also stored by rsID (including rsIDs without any variant) so that they can be refreshed.
+    """
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS articles (
+            source TEXT NOT NULL,
+            id TEXT NOT NULL,
+            text BLOB NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (source, id)
+        );
+        CREATE TABLE IF NOT EXISTS omim_lookups (
+            rsid TEXT PRIMARY KEY,
+            id TEXT,
+            fetched_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connections = SQLiteConnections(path)
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def get_many(self, source: str, ids: List[str]) -> Dict[str, Dict]:
+        """
+        :param source: source of the articles, e.g. pubmed
+        :param ids: ids of the articles within the source
+        :return: the stored articles by id, ids not in the store are left out
+        """
+        res = {}
+        connection = self._connect()
+        for i in range(0, len(ids), 500):  # stay below SQLite's max number of variables
+            chunk = ids[i:i + 500]
+            rows = connection.execute(f'SELECT id, text FROM articles WHERE source = ? AND id IN '
+                                      f'({",".join("?" * len(chunk))})', [source] + chunk)
+            for source_id, text in rows:
+                res[source_id] = {'source': source, 'id': source_id, 'text': zlib.decompress(text).decode()}
+        return res
+
+    def put_many(self, articles: Iterable[Dict]) -> None:
+        """
+        store articles, replacing the stored ones with the same source and id
+        :param articles: articles with `source`, `id` and `text`
+        """
+        now = time.time()
+        rows = [(a['source'], a['id'], zlib.compress(a['text'].encode()), now) for a in articles]
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?)', rows)
+
+    def get_omim(self, rsid: str, max_age: float = OMIM_REFRESH_INTERVAL) -> Tuple[bool, Union[Dict, None]]:
+        """
+        :param rsid: the rsID looked up in OMIM
+        :param max_age: lookups older than this many seconds are ignored
+        :return: whether a fresh lookup is stored, and the OMIM article found by that lookup if any
+        """
+        row = self._connect().execute('SELECT id, fetched_at FROM omim_lookups WHERE rsid = ?', (rsid,)).fetchone()
+        if row is None or row[1] < time.time() - max_age:
+            return False, None
+        if row[0] is None:
+            return True, None  # no variant for this rsID
+        article = self.get_many('omim', [row[0]]).get(row[0])
+        return article is not None, article
+
+    def put_omim(self, rsid: str, article: Union[Dict, None]) -> None:
+        """
+        store the result of an OMIM lookup
+        :param rsid: the rsID looked up in OMIM
+        :param article: the OMIM article found, None if the rsID has no variant
+        """
+        if article is not None:
+            self.put_many([article])
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO omim_lookups VALUES (?, ?, ?)',
+                               (rsid, article['id'] if article else None, time.time()))
+
+    def load_directory(self, path: str) -> int:
+        """
+        load articles from a local fixture directory, so that the store can be filled offline:
+        - `*.json`: a list of articles with `source`, `id` and `text`
+        - `pubmed/*.xml`: PubMed EFetch results
+        - `omim/<rsID>.json`: OMIM entry search results, as recorded or generated by `bench.fixtures`
+        :param path: the fixture directory
+        :return: number of articles loaded
+        """
+        count = 0
+        for filename in sorted(glob.glob(os.path.join(path, '*.json'))):
+            with open(filename) as file:
+                articles = json.load(file)
+            self.put_many(articles)
+            count += len(articles)
+        for filename in sorted(glob.glob(os.path.join(path, 'pubmed', '*.xml'))):
+            with open(filename, 'rb') as file:
+                articles = parse_efetch(file)
+            self.put_many(articles)
+            count += len(articles)
+        for filename in sorted(glob.glob(os.path.join(path, 'omim', '*.json'))):
+            rsid = os.path.splitext(os.path.basename(filename))[0]
+            with open(filename) as file:
+                article = parse_omim_search(rsid, json.load(file))
+            self.put_omim(rsid, article)
+            count += 1 if article else 0
+        logger.info(f'{count} articles loaded from {path}')
+        return count
+
+
+article_store = ArticleStore(ARTICLE_STORE_PATH) if ARTICLE_STORE_PATH else None
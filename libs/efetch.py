@@ -0,0 +1,76 @@
+from typing import Union, Dict, List, IO
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element
+
+from utils.logger import logger
+
+
+def parse_efetch(stream: IO) -> List[Dict]:
+    """
+    Parse an EFetch XML document incrementally, freeing each article once parsed, so that memory does not grow with
+    the number of articles.
+    :param stream: a binary file-like object of the EFetch XML
+    :return: a list of articles with `source`, `id` and `text`
+    """
+    result = []
+    a_count = 0
+    root = None
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if root is None:
+            root = element
+            if root.tag != 'PubmedArticleSet':
+                logger.error(f'PubMed EFetch result has wrong format.')
+                return result
+            continue
+        if event != 'end' or element.tag != 'PubmedArticle':
+            continue
+
+        a_count += 1
+        article = _parse_article(element.find('./MedlineCitation'), a_count)
+        if article:
+            result.append(article)
+        element.clear()
+        root.remove(element)  # drop the reference held by the root, so the article can be freed
+
+    logger.debug(f'Fetched {a_count} articles.')
+    return result
+
+
+def _parse_article(citation: Element, a_count: int) -> Union[Dict, None]:
+    if citation is None:
+        logger.error(f'Failed to locate MedlineCitation section for article #{a_count}')
+        return None
+
+    # parse pubmed ID
+    pubmed_id: Element = citation.find('./PMID')
+    if pubmed_id is None:
+        logger.error(f'Failed to parse PMID')
+        return None
+    pubmed_id: str = pubmed_id.text
+
+    # parse title
+    article: Element = citation.find('./Article')
+    if article is None:
+        logger.error(f'Failed to locate Article section for article #{a_count}')
+        return None
+
+    title: Element = article.find('ArticleTitle')
+    logger.debug(f'PMID {pubmed_id}: {title.text if title is not None else None}')
+    paragraph_list = []
+    for paragraph in article.findall('./Abstract/AbstractText'):
+        paragraph_text = "".join(paragraph.itertext())  # AbstractText may have additional nested xml
+        if paragraph_text:
+            paragraph_list.append(paragraph_text)
+
+    abstract = ' '.join(paragraph_list)  # concatenate
+
+    if title is not None or len(abstract):  # as long as title or abstract has any text
+        title_text = "".join(title.itertext()) if title is not None else ''
+        logger.debug(f'article #{a_count}: {len(paragraph_list)} paragraphs')
+        return {
+            'source': 'pubmed',
+            'id': pubmed_id,
+            'text': f'{title_text} {abstract}',  # concatenate
+        }
+    logger.error(f'Failed to parse ArticleTitle and AbstractText.')
+    return None
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.logger import logger
+from utils.metrics import UPSTREAM_SECONDS, UPSTREAM_ERRORS
+
+"""
+Read from env for HTTP_RETRIES, HTTP_BACKOFF and HTTP_POOL_SIZE
+HTTP_RETRIES is optional, defines how many times a failed request (connection error or 429/5xx) is retried, defaults to 2
+HTTP_BACKOFF is optional, defines the backoff factor between retries in seconds, defaults to 0.2
+HTTP_POOL_SIZE is optional, defines how many keep-alive connections are kept per host, defaults to 10
+"""
+try:
+    HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+    HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.2))
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+    logger.info(f'HTTP_RETRIES={HTTP_RETRIES}, HTTP_BACKOFF={HTTP_BACKOFF}, HTTP_POOL_SIZE={HTTP_POOL_SIZE}')
+except ValueError:
+    raise EnvironmentError('Expect HTTP_RETRIES, HTTP_BACKOFF and HTTP_POOL_SIZE to evaluate to numbers.')
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` calls per second on average, with bursts of at most `rate` calls.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        block until a call is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPClient:
+    """
+    HTTP client keeping a pool of keep-alive connections, retrying failed requests with exponential backoff and
+    optionally limiting its request rate. Sessions are not shared across processes, since forked processes must
+    not reuse the sockets of their parent.
+    """
+
+    def __init__(self, name: str, rate_limit: float = None):
+        self.name = name
+        self._limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._pid != os.getpid():
+                retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                              status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+                self._session = requests.Session()
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+                self._pid = os.getpid()
+                logger.debug(f'{self.name} HTTP session created.')
+            return self._session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        send a GET request, waiting for the rate limiter first
+        :param url: the url to request
+        :param kwargs: passed on to `requests.Session.get`
+        :return: the response
+        """
+        if self._limiter:
+            self._limiter.acquire()
+        start = time.time()
+        try:
+            response = self.session.get(url, **kwargs)
+        except requests.RequestException:
+            UPSTREAM_ERRORS.inc(source=self.name)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.time() - start, source=self.name)
+        if not response.ok:
+            UPSTREAM_ERRORS.inc(source=self.name)
+        return response
@@ -0,0 +1,259 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable, Dict, List, Union
+
+from libs.metamapy import MetaMaPY, MAX_PROCESSES
+from libs.term_search import search_terms
+from utils.logger import logger
+from utils.process import pid_alive
+from utils.sqlite import SQLiteConnections
+
+"""
+Read from env for JOBS_PATH, JOB_WORKERS, JOB_TTL and JOB_PROGRESS_INTERVAL
+JOBS_PATH is optional, defines the path of the SQLite database holding the job queue, defaults to `jobs.sqlite3`.
+It is shared by all app processes, so a job may be polled from any of them.
+JOB_WORKERS is optional, defines how many jobs each app process runs at the same time, defaults to 1
+JOB_TTL is optional, defines how many seconds the result of a job is kept after it finished, defaults to 1 day
+JOB_PROGRESS_INTERVAL is optional, defines the min number of seconds between two progress updates of a job, defaults to 1
+"""
+JOBS_PATH = os.getenv('JOBS_PATH', 'jobs.sqlite3')
+logger.info(f'JOBS_PATH={JOBS_PATH}')
+try:
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 1))
+    JOB_TTL = float(os.getenv('JOB_TTL', 24 * 3600))
+    JOB_PROGRESS_INTERVAL = float(os.getenv('JOB_PROGRESS_INTERVAL', 1))
+    logger.info(f'JOB_WORKERS={JOB_WORKERS}, JOB_TTL={JOB_TTL}, JOB_PROGRESS_INTERVAL={JOB_PROGRESS_INTERVAL}')
+except ValueError:
+    raise EnvironmentError('Expect JOB_WORKERS, JOB_TTL and JOB_PROGRESS_INTERVAL to evaluate to numbers.')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+# MetaMap jobs of interactive requests run at priority 0, so jobs always come after them
+JOB_PRIORITY_OFFSET = 1
+
+
+class JobQueue:
+    """
+    Persistent job queue stored in a SQLite database shared by all app processes.
+    Jobs are claimed by priority then age, and their progress and results stay in the database until they expire.
+    """
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL,
+            result TEXT,
+            error TEXT,
+            worker_pid INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at);
+        CREATE INDEX IF NOT EXISTS jobs_expiry ON jobs (expires_at);
+    '''
+
+    def __init__(self, path: str, ttl: float = JOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._connections = SQLiteConnections(path)
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def enqueue(self, kind: str, payload: Dict, total: int, priority: int = 0) -> str:
+        """
+        :param kind: kind of the job, `articles` or `terms`
+        :param payload: input of the job
+        :param total: number of items of the job, used to report progress
+        :param priority: lower values are served first
+        :return: id of the job
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute('INSERT INTO jobs (id, kind, payload, priority, status, total, created_at, updated_at, '
+                                'expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (job_id, kind, json.dumps(payload), priority, QUEUED, total, now, now, now + self.ttl))
+        return job_id
+
+    def claim(self) -> Union[Dict, None]:
+        """
+        mark the next queued job as running by this process
+        :return: the job with its payload, None if the queue is empty
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')  # no other process may claim the same job
+            row = connection.execute('SELECT id, kind, payload, priority FROM jobs WHERE status = ? '
+                                     'ORDER BY priority, created_at LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE jobs SET status = ?, worker_pid = ?, updated_at = ? WHERE id = ?',
+                               (RUNNING, os.getpid(), time.time(), row[0]))
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'priority': row[3]}
+
+    def progress(self, job_id: str, done: int, result: Dict = None) -> None:
+        """
+        :param job_id: id of the running job
+        :param done: number of items done
+        :param result: partial result
+        """
+        self._connect().execute('UPDATE jobs SET done = ?, result = ?, updated_at = ? WHERE id = ?',
+                                (done, json.dumps(result), time.time(), job_id))
+
+    def finish(self, job_id: str, result: Dict) -> None:
+        now = time.time()
+        self._connect().execute('UPDATE jobs SET status = ?, done = total, result = ?, updated_at = ?, expires_at = ? '
+                                'WHERE id = ?', (DONE, json.dumps(result), now, now + self.ttl, job_id))
+
+    def fail(self, job_id: str, error: str) -> None:
+        now = time.time()
+        self._connect().execute('UPDATE jobs SET status = ?, error = ?, updated_at = ?, expires_at = ? WHERE id = ?',
+                                (FAILED, error, now, now + self.ttl, job_id))
+
+    def get(self, job_id: str) -> Union[Dict, None]:
+        """
+        :param job_id: id of the job
+        :return: status, progress, result and error of the job, None if it does not exist or has expired
+        """
+        row = self._connect().execute('SELECT kind, status, done, total, result, error, created_at, updated_at '
+                                      'FROM jobs WHERE id = ? AND expires_at >= ?', (job_id, time.time())).fetchone()
+        if row is None:
+            return None
+        kind, status, done, total, result, error, created_at, updated_at = row
+        job = {'id': job_id, 'kind': kind, 'status': status, 'progress': {'done': done, 'total': total},
+               'created_at': created_at, 'updated_at': updated_at}
+        if result is not None:
+            job.update(json.loads(result))
+        if error is not None:
+            job['error'] = error
+        return job
+
+    def purge(self) -> int:
+        """
+        remove expired jobs, jobs that are still running are kept
+        :return: number of jobs removed
+        """
+        cursor = self._connect().execute('DELETE FROM jobs WHERE expires_at < ? AND status IN (?, ?, ?)',
+                                         (time.time(), QUEUED, DONE, FAILED))
+        return cursor.rowcount
+
+    def requeue_orphans(self) -> int:
+        """
+        queue again the running jobs whose process is gone, e.g. after a crash or a reload
+        :return: number of jobs queued again
+        """
+        connection = self._connect()
+        rows = connection.execute('SELECT id, worker_pid FROM jobs WHERE status = ?', (RUNNING,)).fetchall()
+        orphans = [job_id for job_id, pid in rows if not pid_alive(pid)]
+        for job_id in orphans:
+            connection.execute('UPDATE jobs SET status = ?, worker_pid = NULL WHERE id = ? AND status = ?',
+                               (QUEUED, job_id, RUNNING))
+        return len(orphans)
+
+
+class JobRunner:
+    """
+    Background threads running the queued jobs. They are started on first use in each process, since threads do not
+    survive uWSGI forking its workers.
+    """
+    _TERMS_PER_STEP = 20
+
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS, poll_interval: float = 1,
+                 progress_interval: float = JOB_PROGRESS_INTERVAL):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            logger.info(f'Requeued {self.queue.requeue_orphans()} orphaned jobs.')
+            for i in range(self.workers):
+                threading.Thread(target=self._loop, name=f'job-runner-{i}', daemon=True).start()
+
+    def _loop(self) -> None:
+        last_purge = 0
+        while True:
+            try:
+                if time.time() - last_purge > 60:
+                    self.queue.purge()
+                    last_purge = time.time()
+                job = self.queue.claim()
+            except sqlite3.Error:
+                logger.error(traceback.format_exc())
+                job = None
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict) -> None:
+        logger.info(f'Running {job["kind"]} job {job["id"]}.')
+        start = time.time()
+        try:
+            if job['kind'] == 'articles':
+                result = self._run_articles(job)
+            else:
+                result = self._run_terms(job)
+            self.queue.finish(job['id'], result)
+            logger.info(f'Job {job["id"]} done in {time.time() - start}s.')
+        except Exception:
+            logger.error(f'Job {job["id"]} failed.')
+            logger.error(traceback.format_exc())
+            self.queue.fail(job['id'], 'An error has occurred, please contact developer.')
+
+    def _throttled_progress(self, job_id: str):
+        """
+        :return: a callback saving the progress of a job, at most once per progress interval
+        """
+        last_update = [0.0]
+
+        def update(done: int, make_result: Callable[[], Dict]) -> None:
+            if time.time() - last_update[0] >= self.progress_interval:
+                self.queue.progress(job_id, done, make_result())
+                last_update[0] = time.time()
+
+        return update
+
+    def _run_articles(self, job: Dict) -> Dict:
+        update = self._throttled_progress(job['id'])
+
+        def progress(done, total, aggregator):
+            update(done, lambda: {'terms': aggregator.terms()})
+
+        metamapy = MetaMaPY(MAX_PROCESSES, admit=False)  # jobs wait for a slot instead of being rejected
+        res = metamapy.run(job['payload']['articles'], priority=JOB_PRIORITY_OFFSET + job['priority'],
+                           progress=progress)
+        if metamapy.timed_out:
+            return {'terms': res, 'timed_out': metamapy.timed_out}
+        return {'terms': res}
+
+    def _run_terms(self, job: Dict) -> Dict:
+        update = self._throttled_progress(job['id'])
+        results = {}
+        terms: List[str] = job['payload']['terms']
+        for i in range(0, len(terms), self._TERMS_PER_STEP):  # terms of a step share their articles
+            step = search_terms(terms[i:i + self._TERMS_PER_STEP], use_cache=job['payload']['use_cache'],
+                                priority=JOB_PRIORITY_OFFSET + job['priority'], admit=False)
+            results.update((term, dict(body, status=status)) for term, (body, status) in step.items())
+            update(len(results), lambda: {'results': results})
+        return {'results': results}
+
+
+job_queue = JobQueue(JOBS_PATH)
+job_runner = JobRunner(job_queue)
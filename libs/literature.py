@@ -0,0 +1,59 @@
+import os
+import traceback
+from concurrent.futures import wait
+from typing import Dict, List, Tuple
+
+from libs.omim import get_omim
+from libs.pubmed import get_pubmed
+from utils.executor import ProcessLocalThreadPool
+from utils.logger import logger
+
+"""
+Read from env for FETCH_DEADLINE and FETCH_WORKERS
+FETCH_DEADLINE is optional, defines how many seconds to wait for all sources of a term, defaults to 5s.
+Sources that have not answered by then are reported as missing.
+FETCH_WORKERS is optional, defines how many source queries of each app process may run at the same time, defaults to 8
+"""
+try:
+    FETCH_DEADLINE = float(os.getenv('FETCH_DEADLINE', 5))
+    FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 8))
+    logger.info(f'FETCH_DEADLINE={FETCH_DEADLINE}, FETCH_WORKERS={FETCH_WORKERS}')
+except ValueError:
+    raise EnvironmentError('Expect FETCH_DEADLINE and FETCH_WORKERS to evaluate to numbers.')
+
+_pool = ProcessLocalThreadPool(FETCH_WORKERS, 'fetch')
+
+
+def fetch_articles(term: str, deadline: float = FETCH_DEADLINE) -> Tuple[List[Dict], List[str]]:
+    """
+    Query PubMed and OMIM concurrently for articles about a term, giving up on sources that are not done by the deadline.
+    Late sources keep running in the background, so that their results still reach the article store.
+    :param term: the term to query
+    :param deadline: seconds to wait for all sources
+    :return: the articles found, and the names of the sources that missed the deadline or failed
+    """
+    futures = {
+        'pubmed': _pool.submit(get_pubmed, term),
+        'omim': _pool.submit(get_omim, term),
+    }
+    done, _ = wait(futures.values(), timeout=deadline)
+
+    articles = []
+    missed = []
+    for source, future in futures.items():
+        if future not in done:
+            logger.error(f'{source} missed the deadline of {deadline}s for {term}.')
+            missed.append(source)
+            continue
+        try:
+            result = future.result()
+        except Exception:
+            logger.error(f'{source} failed for {term}.')
+            logger.error(traceback.format_exc())
+            missed.append(source)
+            continue
+        if isinstance(result, list):
+            articles.extend(result)
+        elif result:
+            articles.append(result)
+    return articles, missed
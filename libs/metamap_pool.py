@@ -0,0 +1,221 @@
+import itertools
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import Dict, List, Union
+
+from libs.metamap_slots import MetaMapSlots
+from utils.logger import logger
+
+EOT_MARKERS = ('<<< EOT >>>', "'EOT'.")  # printed by MetaMap after each citation when started with `-E`
+
+
+class MetaMapTimeout(Exception):
+    """
+    Raised when MetaMap did not finish citations within their time limit, its process has been killed
+    """
+
+
+def kill_process_group(process: subprocess.Popen) -> None:
+    """
+    kill a process started in its own session along with its children, since the `metamap` script runs the actual
+    MetaMap binary as a child process
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class MetaMapWorker:
+    """
+    A long-lived MetaMap process that reads citations from stdin and writes the results to stdout.
+    MetaMap must be started with `-E` so that the output of each citation is terminated by an EOT marker.
+    """
+
+    def __init__(self, command: List[str], name: str):
+        self.command = command
+        self.name = name
+        self.lock = threading.Lock()  # held while the process is serving a citation
+        self.busy_time = 0.0  # total seconds spent serving citations
+        self._process: Union[subprocess.Popen, None] = None
+
+    def start(self) -> None:
+        logger.debug(f'{self.name}: starting `{" ".join(self.command)}`')
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1,
+                                         start_new_session=True)
+
+    def stop(self) -> None:
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            kill_process_group(self._process)
+            self._process.wait()
+        self._process = None
+
+    def restart(self) -> None:
+        logger.info(f'{self.name}: restarting MetaMap process.')
+        self.stop()
+        self.start()
+
+    def alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def process(self, payload: str, citations: int = 1, timeout: float = None) -> List[str]:
+        """
+        feed citations to MetaMap and collect their output
+        :param payload: the input to write to MetaMap's stdin, formatted for the input mode MetaMap was started with
+        :param citations: number of citations in the payload, i.e. number of EOT markers to wait for
+        :param timeout: seconds after which MetaMap is killed if it has not finished, None to wait forever
+        :return: the output lines of the citations, without the EOT markers
+        :raise MetaMapTimeout: if MetaMap was killed, the worker must be restarted
+        """
+        process = self._process
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            kill_process_group(process)
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        try:
+            process.stdin.write(payload)
+            process.stdin.flush()
+            lines = []
+            for line in process.stdout:
+                if line.startswith(EOT_MARKERS):
+                    citations -= 1
+                    if citations <= 0:
+                        return lines
+                    continue
+                lines.append(line)
+        except OSError:
+            if not killed.is_set():
+                raise
+        finally:
+            if timer:
+                timer.cancel()
+        if killed.is_set():
+            raise MetaMapTimeout(f'{self.name}: MetaMap killed after {timeout}s.')
+        raise RuntimeError(f'{self.name}: MetaMap exited before finishing the citation.')
+
+
+class MetaMapPool:
+    """
+    A fixed-size pool of warm MetaMap processes shared by all requests of a process.
+    Each worker process is served by a dedicated thread pulling citations from a shared priority queue,
+    and a supervisor thread restarts idle workers whose MetaMap process has died.
+    When given machine-wide MetaMapSlots, a worker only feeds MetaMap while holding a slot.
+    """
+    _SHUTDOWN = float('inf')  # priority of the shutdown signal, served after all pending citations
+
+    def __init__(self, command: List[str], size: int, check_interval: float = 5, slots: MetaMapSlots = None):
+        self.size = size
+        self.check_interval = check_interval
+        self.slots = slots
+        self._tasks = queue.PriorityQueue()
+        self._sequence = itertools.count()  # FIFO among equal priorities
+        self._stopped = threading.Event()
+        self._workers = [MetaMapWorker(command, f'metamap-{i}') for i in range(size)]
+        self._threads = []
+        for worker in self._workers:
+            worker.start()
+            thread = threading.Thread(target=self._serve, args=(worker,), name=worker.name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._supervisor = threading.Thread(target=self._supervise, name='metamap-supervisor', daemon=True)
+        self._supervisor.start()
+        logger.info(f'MetaMapPool started with {size} workers.')
+
+    def submit(self, payload: str, citations: int = 1, priority: int = 0, timeout: float = None) -> Future:
+        """
+        queue citations for the next idle worker
+        :param payload: the input to write to MetaMap's stdin
+        :param citations: number of citations in the payload
+        :param priority: citations with a lower priority value are served first, e.g. interactive requests before
+        background jobs
+        :param timeout: seconds MetaMap may spend on the citations once a worker starts them, None for no limit
+        :return: a future resolving to the output lines of the citations, or to a MetaMapTimeout
+        """
+        if self._stopped.is_set():
+            raise RuntimeError('MetaMapPool has been shut down.')
+        future = Future()
+        self._tasks.put((priority, next(self._sequence), future, payload, citations, timeout))
+        return future
+
+    def _serve(self, worker: MetaMapWorker) -> None:
+        while True:
+            priority, _, future, payload, citations, timeout = self._tasks.get()
+            if future is None:  # shutdown signal
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            with worker.lock:
+                try:
+                    if not worker.alive():
+                        worker.restart()
+                    with self.slots.slot(priority) if self.slots else nullcontext():
+                        start = time.time()
+                        try:
+                            lines = worker.process(payload, citations, timeout)
+                        finally:
+                            worker.busy_time += time.time() - start
+                    future.set_result(lines)
+                except Exception as e:
+                    logger.error(f'{worker.name}: failed to process citation. {e}')
+                    future.set_exception(e)
+                    try:
+                        worker.restart()  # the process state is unknown, start over with a fresh one
+                    except OSError as e:
+                        logger.error(f'{worker.name}: failed to restart MetaMap. {e}')
+
+    def pending(self) -> int:
+        """
+        :return: number of citation batches waiting for a worker
+        """
+        return self._tasks.qsize()
+
+    def busy_times(self) -> Dict[str, float]:
+        """
+        :return: total seconds each worker has spent serving citations, by worker name
+        """
+        return {worker.name: worker.busy_time for worker in self._workers}
+
+    def _supervise(self) -> None:
+        while not self._stopped.wait(self.check_interval):
+            for worker in self._workers:
+                if not worker.lock.acquire(blocking=False):
+                    continue  # busy workers are checked by their own thread
+                try:
+                    if not worker.alive():
+                        logger.error(f'{worker.name}: MetaMap process died.')
+                        worker.restart()
+                except OSError as e:
+                    logger.error(f'{worker.name}: failed to restart MetaMap. {e}')
+                finally:
+                    worker.lock.release()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        for _ in self._threads:
+            self._tasks.put((self._SHUTDOWN, next(self._sequence), None, None, None, None))
+        for thread in self._threads:
+            thread.join()
+        for worker in self._workers:
+            worker.stop()
+        logger.info('MetaMapPool shut down.')
@@ -0,0 +1,142 @@
+import math
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Tuple
+
+from utils.logger import logger
+from utils.process import pid_alive
+from utils.sqlite import SQLiteConnections
+
+
+class OverloadedError(Exception):
+    """
+    Raised when too many MetaMap jobs are waiting for a slot, the request should be retried after `retry_after` seconds
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'MetaMap is overloaded, retry after {retry_after}s.')
+        self.retry_after = retry_after
+
+
+class MetaMapSlots:
+    """
+    Machine-wide budget of concurrently running MetaMap jobs, shared by all app processes through a SQLite database.
+    Each job takes a ticket and waits until it is among the first waiting tickets, by priority then arrival, and a
+    slot is free. Tickets of dead processes are removed, so that a crash never leaks slots.
+    The average job duration is tracked to estimate how long new jobs would wait.
+    """
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            priority INTEGER NOT NULL,
+            pid INTEGER NOT NULL,
+            running INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tickets_queue ON tickets (running, priority, id);
+        CREATE TABLE IF NOT EXISTS job_duration (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            average REAL NOT NULL
+        );
+    '''
+    _SMOOTHING = 0.2  # weight of the last job in the moving average of job durations
+    _MIN_POLL_INTERVAL = 0.01
+    _MAX_POLL_INTERVAL = 0.1
+    _CLEANUP_INTERVAL = 1
+
+    def __init__(self, path: str, slots: int, queue_limit: int):
+        self.path = path
+        self.slots = slots
+        self.queue_limit = queue_limit
+        self._connections = SQLiteConnections(path)
+        self._connect().executescript(self._SCHEMA)
+        logger.info(f'MetaMapSlots created with {slots} slots and a queue limit of {queue_limit} at {path}')
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def admit(self, jobs: int, local_pending: int = 0) -> None:
+        """
+        check that the jobs of a request may queue for a slot
+        :param jobs: number of jobs of the request
+        :param local_pending: number of jobs of this process queued before they take a ticket
+        :raise OverloadedError: if the queue would exceed its limit. A request is always admitted into an empty
+        queue, however many jobs it has, or large requests would never be served.
+        """
+        waiting, running = self.counts()
+        if waiting + local_pending > 0 and waiting + local_pending + jobs > self.queue_limit:
+            retry_after = self.retry_after(waiting + local_pending + running + jobs)
+            logger.info(f'{jobs} jobs rejected, {waiting + local_pending} jobs already waiting, '
+                        f'retry after {retry_after}s.')
+            raise OverloadedError(retry_after)
+
+    def counts(self) -> Tuple[int, int]:
+        """
+        :return: number of jobs waiting for a slot and number of jobs holding one, over all processes
+        """
+        return self._connect().execute(
+            'SELECT COALESCE(SUM(running = 0), 0), COALESCE(SUM(running = 1), 0) FROM tickets').fetchone()
+
+    def retry_after(self, jobs: int) -> int:
+        """
+        :param jobs: number of jobs ahead
+        :return: estimated seconds until that many jobs are done
+        """
+        row = self._connect().execute('SELECT average FROM job_duration WHERE id = 0').fetchone()
+        average = row[0] if row else 1
+        return max(1, math.ceil(jobs * average / self.slots))
+
+    @contextmanager
+    def slot(self, priority: int = 0):
+        """
+        hold a slot while running a MetaMap job, waiting for it if all slots are taken
+        :param priority: jobs with a lower priority value take free slots first
+        """
+        connection = self._connect()
+        ticket = connection.execute('INSERT INTO tickets (priority, pid, created_at) VALUES (?, ?, ?)',
+                                    (priority, os.getpid(), time.time())).lastrowid
+        try:
+            self._wait(ticket)
+            start = time.time()
+            yield
+            self._record(time.time() - start)
+        finally:
+            connection.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+
+    def _wait(self, ticket: int) -> None:
+        connection = self._connect()
+        poll_interval = self._MIN_POLL_INTERVAL
+        last_cleanup = time.time()
+        while True:
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                running = connection.execute('SELECT COUNT(*) FROM tickets WHERE running = 1').fetchone()[0]
+                free = self.slots - running
+                if free > 0:
+                    heads = connection.execute('SELECT id FROM tickets WHERE running = 0 ORDER BY priority, id '
+                                               'LIMIT ?', (free,)).fetchall()
+                    if (ticket,) in heads:
+                        connection.execute('UPDATE tickets SET running = 1 WHERE id = ?', (ticket,))
+                        return
+            if time.time() - last_cleanup > self._CLEANUP_INTERVAL:
+                self._remove_orphans()
+                last_cleanup = time.time()
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, self._MAX_POLL_INTERVAL)
+
+    def _record(self, duration: float) -> None:
+        connection = self._connect()
+        updated = connection.execute('UPDATE job_duration SET average = average * ? + ? WHERE id = 0',
+                                     (1 - self._SMOOTHING, duration * self._SMOOTHING)).rowcount
+        if not updated:
+            connection.execute('INSERT OR IGNORE INTO job_duration VALUES (0, ?)', (duration,))
+
+    def _remove_orphans(self) -> None:
+        connection = self._connect()
+        pids = [pid for pid, in connection.execute('SELECT DISTINCT pid FROM tickets')]
+        for pid in pids:
+            if not pid_alive(pid):
+                logger.info(f'removing MetaMap slot tickets of dead process {pid}')
+                connection.execute('DELETE FROM tickets WHERE pid = ?', (pid,))
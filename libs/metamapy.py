@@ -1,23 +1,103 @@
 import os
 import time
 import re
+import atexit
+import bisect
+import subprocess
+import heapq
+import math
+import tempfile
+import threading
 from utils.logger import logger
-from typing import List, Dict
-from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Iterable, Tuple, Callable, Union
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from libs.aggregator import TermAggregator
+from libs.metamap_pool import MetaMapPool, MetaMapTimeout, kill_process_group
+from libs.metamap_slots import MetaMapSlots
+from libs.tagger import tagger_supervisor, TaggerUnavailableError
+from libs.semantic_types import SEMANTIC_TYPES
+from utils.article_cache import ArticleCache
+from utils.metrics import registry, record_stage, REQUEST_ARTICLES, REQUEST_TERMS, METAMAP_TIMEOUTS, POOL_PENDING, \
+    POOL_BUSY_SECONDS, SLOTS_JOBS
+from utils.sentence_cache import SentenceCache
+
+MAX_PROCESSES = int(os.getenv('MAX_PROCESSES', 1))
+logger.info(f'MAX_PROCESSES={MAX_PROCESSES}')
+
+"""
+Read from env for METAMAP_SLOTS, METAMAP_QUEUE_LIMIT and METAMAP_SLOTS_PATH
+METAMAP_SLOTS is optional, defines how many MetaMap jobs may run at the same time on this machine, across all app
+processes, defaults to MAX_PROCESSES. Set it to 0 to let each process run up to MAX_PROCESSES jobs on its own.
+METAMAP_QUEUE_LIMIT is optional, defines how many MetaMap jobs may wait for a slot before requests are rejected with
+status 429, defaults to 8 times METAMAP_SLOTS. Background jobs are never rejected.
+METAMAP_SLOTS_PATH is optional, defines the path of the SQLite database of the slots, shared by all app processes,
+defaults to `metamapy_slots.sqlite3` in the temporary directory.
+"""
+try:
+    METAMAP_SLOTS = int(os.getenv('METAMAP_SLOTS', MAX_PROCESSES))
+    METAMAP_QUEUE_LIMIT = int(os.getenv('METAMAP_QUEUE_LIMIT', 8 * METAMAP_SLOTS))
+    logger.info(f'METAMAP_SLOTS={METAMAP_SLOTS}, METAMAP_QUEUE_LIMIT={METAMAP_QUEUE_LIMIT}')
+except ValueError:
+    raise EnvironmentError('Expect METAMAP_SLOTS and METAMAP_QUEUE_LIMIT to evaluate to numbers.')
+METAMAP_SLOTS_PATH = os.getenv('METAMAP_SLOTS_PATH', os.path.join(tempfile.gettempdir(), 'metamapy_slots.sqlite3'))
+logger.info(f'METAMAP_SLOTS_PATH={METAMAP_SLOTS_PATH}')
 
 
 class MetaMaPY:
     _METAMAP_PATH = os.getenv('METAMAP_PATH', 'metamap')
-    _PROJECT_PATH = os.getenv('PROJECT_PATH', './')
     _METAMAP_SEM_TYPES = os.getenv('METAMAP_SEM_TYPES', None)
     _METAMAP_DATA_SOURCES = os.getenv('METAMAP_DATA_SOURCES', None)
+    _METAMAP_POOL = os.getenv('METAMAP_POOL', 'true').lower() == 'true'
+    _METAMAP_POOL_CHECK_INTERVAL = float(os.getenv('METAMAP_POOL_CHECK_INTERVAL', 5))
+    _METAMAP_BATCH_SIZE = int(os.getenv('METAMAP_BATCH_SIZE', 1))
+    _METAMAP_OUTPUT = os.getenv('METAMAP_OUTPUT', 'text').lower()  # `text` (human-readable) or `xml`
+    _METAMAP_SENTENCE_CACHE = os.getenv('METAMAP_SENTENCE_CACHE', 'false').lower() == 'true'
+    _METAMAP_MAX_CHUNK = int(os.getenv('METAMAP_MAX_CHUNK', 20000))  # in characters, 0 to never split texts
+    _METAMAP_TIMEOUT = float(os.getenv('METAMAP_TIMEOUT', 60))  # in seconds per article, 0 for no limit
+    _METAMAP_FAILURE_TTL = float(os.getenv('METAMAP_FAILURE_TTL', 600))  # how long timed out articles are skipped
     logger.debug(f'setting metamap path: {_METAMAP_PATH}')
-    logger.debug(f'setting project path: {_PROJECT_PATH}')
     logger.debug(f'configuring metamap sem_types: {_METAMAP_SEM_TYPES}')
     logger.debug(f'configuring metamap data_sources: {_METAMAP_DATA_SOURCES}')
+    logger.debug(f'using persistent metamap pool: {_METAMAP_POOL}')
+    logger.debug(f'configuring metamap batch size: {_METAMAP_BATCH_SIZE}')
+    logger.debug(f'configuring metamap output format: {_METAMAP_OUTPUT}')
+    logger.debug(f'using sentence cache: {_METAMAP_SENTENCE_CACHE}')
+    logger.debug(f'configuring metamap max chunk size: {_METAMAP_MAX_CHUNK}')
+    logger.debug(f'configuring metamap timeout: {_METAMAP_TIMEOUT}s per article, failures cached for '
+                 f'{_METAMAP_FAILURE_TTL}s')
+    if _METAMAP_OUTPUT not in ('text', 'xml'):
+        raise EnvironmentError('Expect METAMAP_OUTPUT to be either `text` or `xml`.')
+
+    # a mapping line of the human-readable output, e.g. `  1000   C0026769:MS (Multiple Sclerosis) [Disease or Syndrome]`
+    _MAPPING_LINE = re.compile(r"^\s*(\d+)?\s*(C\d{7}):(.*?)(?:\s+\((.*)\))?\s+\[(.*)\]\s*$")
+    _PROCESSING_LINE = re.compile(r"^Processing (\d+)\.tx\.\d+:")
+    _XML_PMID_LINE = re.compile(r"<PMID>(\d+)</PMID>")
+    # end of a sentence followed by the start of another one, or a line break
+    _SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])|\s*\n\s*")
+    _NON_SPACE = re.compile(r"\S+")
+    # leading blank lines, and the line break before each blank line
+    _BLANK_LINE = re.compile(r"^\s*\n|\n[^\S\n]*(?=\n)")
+
+    _FAILURE = {'timed_out': True}  # cached instead of the entries of an article MetaMap timed out on
+
+    _pool = None  # MetaMapPool shared by all requests of this process, created on first use
+    _pool_lock = threading.Lock()
+    _article_cache = ArticleCache()
+    _sentence_cache = SentenceCache() if _METAMAP_SENTENCE_CACHE else None
+    _slots = MetaMapSlots(METAMAP_SLOTS_PATH, METAMAP_SLOTS, METAMAP_QUEUE_LIMIT) if METAMAP_SLOTS > 0 else None
 
-    def __init__(self, max_processes: int):
+    def __init__(self, max_processes: int, admit: bool = True):
+        """
+        :param max_processes: number of MetaMap processes to run in parallel
+        :param admit: whether the jobs of each run go through the admission of the machine-wide slots, which rejects
+        them when too many jobs are waiting. Background work waits for a slot instead, whatever its priority.
+        """
         self.max_processes = max_processes
+        self.admit = admit
+        self.timed_out = []  # articles of the last run that MetaMap timed out on, with `source` and `id`
 
     @classmethod
     def remove_non_ascii(cls, s: str) -> str:
@@ -29,161 +109,648 @@ class MetaMaPY:
         return "".join(c for c in s if ord(c) < 128)
 
     @classmethod
-    def _run_command(cls, command_line: str) -> str:
+    def _metamap_options(cls, sem_types: List[str] = None, data_sources: List[str] = None) -> List[str]:
         """
-        execute a bash command
-        :param command_line: the command to execute
-        :return: terminal output
+        build the MetaMap command line options shared by one-off and pooled MetaMap processes
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :return: a list of command line options
         """
-        logger.debug(f'executing command: $ {command_line}')
-        output = os.popen(command_line).read()
-        if 'command not found' in output:
-            logger.error(output)
-            raise EnvironmentError(output)
-        return output
+        options = ['-I', '-p', '-K', '-8', '--silent', '--conj']
+        if cls._METAMAP_OUTPUT == 'xml':
+            options.append('--XMLf1')  # one XML document per citation, one element per line
+        if cls._METAMAP_BATCH_SIZE > 1:
+            options.append('--sldiID')  # single line delimited input with ID, one `ID|text` line per citation
+        if sem_types:
+            options += ['-J', ','.join(sem_types)]
+        if data_sources:
+            options += ['-R', ','.join(data_sources)]
+        return options
 
     @classmethod
-    def _start_tagger_server(cls):
+    def _run_metamap(cls, payload: str, sem_types: List[str] = None, data_sources: List[str] = None,
+                     timeout: float = None) -> List[str]:
         """
-        Check if metamap is installed first. Then check if tagger server is running, if not, try starting it.
-        :return:
+        run a one-off MetaMap process with given options, feeding the input through stdin and reading stdout.
+
+        :param payload: the input of MetaMap
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :param timeout: seconds after which MetaMap is killed if it has not finished, None to wait forever
+        :return: MetaMap output lines
+        :raise MetaMapTimeout: if MetaMap was killed
         """
+        command = [os.path.join(cls._METAMAP_PATH, 'metamap')] + cls._metamap_options(sem_types, data_sources)
+        logger.debug(f'executing command: $ {" ".join(command)}')
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   universal_newlines=True, start_new_session=True)
         try:
-            cls._run_command(f'{os.path.join(cls._METAMAP_PATH, "metamap")} --help')
-        except EnvironmentError:
-            logger.error('metamap not installed')
-            raise RuntimeError('command metamap is not found, please make sure you have installed metamap.')
-        else:
-            tagger_processes = cls._run_command(f'ps -ef | grep taggerServer | grep -c -v grep').strip()
-            if tagger_processes == '1':
-                logger.info('tagger server already started')
-            elif tagger_processes == '0':
-                logger.info('starting tagger server...')
-                output = cls._run_command(f'{os.path.join(cls._METAMAP_PATH, "skrmedpostctl")} start')
-                logger.debug(output)
-                if 'started' not in output:
-                    raise RuntimeError('Failed to start tagger server.')
-            else:
-                logger.info(f'{tagger_processes} tagger processes found:')
-                logger.debug(cls._run_command(f'ps -ef | grep taggerServer | grep -v grep'))
-                raise RuntimeError('An unknown error has occurred while starting metamap tagger server.')
+            stdout, _ = process.communicate(payload, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            process.communicate()
+            raise MetaMapTimeout(f'MetaMap killed after {timeout}s.')
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        logger.debug('a metamap process has finished.')
+        return stdout.splitlines(keepends=True)
 
     @classmethod
-    def _run_metamap(cls, in_file: str, out_file: str, sem_types: List[str] = None,
-                     data_sources: List[str] = None) -> None:
+    def _get_pool(cls, size: int, sem_types: List[str] = None, data_sources: List[str] = None) -> MetaMapPool:
         """
-        run MetaMap with given options.
-
-        :param in_file: path to input file
-        :param out_file: path to output file
+        lazily start the persistent MetaMap pool, so that each (forked) worker process owns its own pool
+        :param size: number of MetaMap processes to keep warm
         :param sem_types: the semantic types to restrict to, use default in common case
         :param data_sources: the sources to restrict to, use default in common case
-        :return: None
+        :return: the MetaMapPool of this process
         """
-        options = ''
-        if sem_types:
-            options = f" -J {','.join(sem_types)}"
-        if data_sources:
-            options = f"{options} -R {','.join(data_sources)}"
+        with cls._pool_lock:
+            if cls._pool is None:
+                command = [os.path.join(cls._METAMAP_PATH, 'metamap'), '-E'] + cls._metamap_options(sem_types,
+                                                                                                  data_sources)
+                cls._pool = MetaMapPool(command, size, check_interval=cls._METAMAP_POOL_CHECK_INTERVAL,
+                                        slots=cls._slots)
+                atexit.register(cls._pool.shutdown)
+            return cls._pool
 
-        commands = f"{os.path.join(cls._METAMAP_PATH, 'metamap')} -I -p -K -8 --silent --conj{options} {in_file} {out_file}"
-        cls._run_command(commands)
-        logger.debug('a metamap process has finished.')
+    @classmethod
+    def _make_batches(cls, texts: List[str], batch_size: int, bins: int) -> List[List[int]]:
+        """
+        group texts into batches of at most batch_size texts, balanced by total text length.
+        There are at least as many batches as bins (when there are enough texts) so that all processes get work.
+        :param texts: texts to process
+        :param batch_size: max number of texts in a batch
+        :param bins: number of MetaMap processes running in parallel
+        :return: indices of the texts in each batch
+        """
+        n_batches = max(math.ceil(len(texts) / batch_size), min(bins, len(texts)))
+        batches = [[] for _ in range(n_batches)]
+        heap = [(0, i) for i in range(n_batches)]  # (total text length, batch index), lightest batch on top
+        # longest texts first, each into the lightest batch that still has room
+        for index in sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True):
+            length, batch = heapq.heappop(heap)
+            batches[batch].append(index)
+            if len(batches[batch]) < batch_size:
+                heapq.heappush(heap, (length + len(texts[index]), batch))
+        return [batch for batch in batches if batch]
+
+    def _make_jobs(self, texts: List[str], interactive: bool) -> List[Tuple[List[int], str]]:
+        """
+        format texts into MetaMap inputs, batching them when METAMAP_BATCH_SIZE > 1
+        :param texts: ASCII texts to process
+        :param interactive: whether the input is written to stdin of a persistent MetaMap process instead of a file
+        :return: tuples of (indices of the texts, MetaMap input) for each MetaMap job, blank texts are left out
+        """
+        indices = [i for i, text in enumerate(texts) if text.strip()]
+        if self._METAMAP_BATCH_SIZE <= 1:
+            return [([i], self._format_job(texts, [i], interactive)) for i in indices]
+        batches = self._make_batches([texts[i] for i in indices], self._METAMAP_BATCH_SIZE, self.max_processes)
+        return [([indices[j] for j in batch], self._format_job(texts, [indices[j] for j in batch], interactive))
+                for batch in batches]
 
     @classmethod
-    def _parse_result(cls, result_files: List[str]) -> List[Dict]:
-        res = []
-        res_dict = {}
-        for each in result_files:   # each format: path/to/project/out/input_source_id.temp.res
-            source_name, source_id = os.path.basename(each).split('.')[0].split('_')[-2:]
-            with open(each) as file:
-                for line in file:
-                    if re.search("^Processing", line) or re.search("^Meta Mapping", line):
-                        continue    # skip unrelated lines
-
-                    try:    # MetaMap entry found
-                        cui = re.search(r"C\d{7}", line).group(0)
-                        category = re.search(r"\[.*\]", line).group(0)[1:-1]
-                    except AttributeError:
-                        logger.error(f'cannot find cui/category for line: {line}')
+    def _format_job(cls, texts: List[str], indices: List[int], interactive: bool) -> str:
+        """
+        :param texts: ASCII texts to process
+        :param indices: indices of the texts of the job
+        :param interactive: whether the input is written to stdin of a persistent MetaMap process instead of a file
+        :return: the MetaMap input of the job
+        """
+        if cls._METAMAP_BATCH_SIZE > 1:
+            # the index of a text is its ID, text must fit in a single line
+            return ''.join(f'{i}|' + texts[i].replace('\r', ' ').replace('\n', ' ') + '\n' for i in indices)
+        text = texts[indices[0]]
+        if interactive:  # blank lines separate citations, they become spaces so that positions stay the same
+            text = cls._BLANK_LINE.sub(lambda blank: ' ' * len(blank.group(0)), text.replace('\r', ' '))
+            return text.rstrip() + '\n\n'
+        return f'{text}\n'  # metamap needs a new line at EOF
+
+    @classmethod
+    def _split_output(cls, indices: List[int], lines: List[str]) -> Dict[int, List[str]]:
+        """
+        split the MetaMap output of a job back into the output of each text.
+        In batch mode, the human-readable output of a citation starts with `Processing <ID>.tx.<n>: ...` lines,
+        and each citation is a separate XML document with the ID in its `PMID` elements.
+        :param indices: indices of the texts of the job
+        :param lines: MetaMap output lines of the job
+        :return: MetaMap output lines of each text, by index
+        """
+        if cls._METAMAP_BATCH_SIZE <= 1:
+            return {indices[0]: lines}
+
+        res = {i: [] for i in indices}
+        if cls._METAMAP_OUTPUT == 'xml':
+            document = []
+            for line in lines + ['<?xml']:  # the sentinel flushes the last document
+                if line.startswith('<?xml') and document:
+                    pmid = next((m.group(1) for m in map(cls._XML_PMID_LINE.search, document) if m), None)
+                    if pmid is None or int(pmid) not in res:
+                        logger.error('cannot attribute an XML document to a citation.')
                     else:
-                        # retrieve term name
-                        preferred_name = re.search(r"\(.*\)", line)
-                        if preferred_name:
-                            name = preferred_name.group(0)[1:-1]  # get rid of the parenthesis
-                        else:
-                            name = line.split(':', 2)[1].replace(f'[{category}]', '').strip()
-
-                        # check if it's a new term or a found term
-                        if cui in res_dict.keys():
-                            res_dict[cui]['count'] += 1
-                        else:
-                            res_dict[cui] = {
-                                'term': name,
-                                'category': category,
-                                'count': 1,
-                                'sources': {}
-                            }
-
-                        # update the source info
-                        if source_name not in res_dict[cui]['sources'].keys():
-                            res_dict[cui]['sources'][source_name] = []
-                        if source_id not in res_dict[cui]['sources'][source_name]:
-                            res_dict[cui]['sources'][source_name].append(source_id)
-        for k, v in res_dict.items():
-            v['CUI'] = k    # add cui as a key
-            res.append(v)
-        res.sort(key=lambda x: x['count'], reverse=True)
-        logger.debug(f'parsing finished, result: {res}')
+                        res[int(pmid)].extend(document)
+                    document = []
+                document.append(line)
+        else:
+            current = None
+            for line in lines:
+                processing = cls._PROCESSING_LINE.match(line)
+                if processing:
+                    current = int(processing.group(1))
+                if current not in res:
+                    logger.error(f'cannot attribute line to a citation: {line}')
+                else:
+                    res[current].append(line)
         return res
 
-    def run(self, articles: List[Dict]) -> List[Dict]:
-        self._start_tagger_server()
+    @classmethod
+    def _parse_output(cls, lines: Iterable[str]) -> List[Dict]:
+        """
+        extract the MetaMap entries found in the output of one article
+        :param lines: MetaMap output lines
+        :return: a list of entries with `CUI`, `term` and `category`, one for each occurrence
+        """
+        if cls._METAMAP_OUTPUT == 'xml':
+            return cls._parse_xml(lines)
+
+        entries = []
+        for line in lines:
+            mapping = cls._MAPPING_LINE.match(line)
+            if mapping is None:
+                if line.strip() and not line.startswith(('Processing', 'Meta Mapping')):
+                    logger.debug(f'skipping line without cui/category: {line}')
+                continue
+            _, cui, matched, preferred, category = mapping.groups()
+            entries.append({
+                'CUI': cui,
+                'term': (preferred or matched).strip(),
+                'category': category,
+            })
+        return entries
+
+    @classmethod
+    def _parse_xml(cls, lines: Iterable[str]) -> List[Dict]:
+        """
+        extract the MetaMap entries found in the XML output of one article, with their score, matched words and
+        positions. The output is parsed incrementally and each candidate is freed once read, so that the document
+        is never held in memory as a whole.
+        :param lines: MetaMap XML output lines, possibly holding several XML documents
+        :return: a list of entries, one for each candidate of the mappings
+        """
+        entries = []
+        parser = None
+        in_mapping = False  # candidates outside of mappings are not part of the result
+        for line in lines:
+            if line.startswith('<?xml'):
+                parser = ElementTree.XMLPullParser(events=('start', 'end'))
+            if parser is None:
+                continue
+            parser.feed(line)
+            for event, element in parser.read_events():
+                if element.tag == 'Mapping':
+                    in_mapping = event == 'start'
+                elif event == 'end' and element.tag == 'Candidate':
+                    if in_mapping:
+                        entries.append(cls._xml_entry(element))
+                    element.clear()
+                elif event == 'end' and element.tag == 'Phrase':
+                    element.clear()
+        return entries
+
+    @classmethod
+    def _xml_entry(cls, candidate: Element) -> Dict:
+        sem_types = [SEMANTIC_TYPES.get(each.text, each.text) for each in candidate.iterfind('./SemTypes/SemType')]
+        return {
+            'CUI': candidate.findtext('./CandidateCUI'),
+            'term': candidate.findtext('./CandidatePreferred'),
+            'category': ','.join(sem_types),
+            'score': abs(int(candidate.findtext('./CandidateScore', '0'))),
+            'matched_words': [each.text for each in candidate.iterfind('./MatchedWords/MatchedWord')],
+            'positions': [[int(each.findtext('./StartPos')), int(each.findtext('./Length'))]
+                          for each in candidate.iterfind('./ConceptPIs/ConceptPI')],
+        }
+
+    def run(self, articles: List[Dict], use_cache: bool = True, priority: int = 0,
+            progress: Callable[[int, int, TermAggregator], None] = None) -> List[Dict]:
+        """
+        run MetaMap on articles and aggregate the terms found
+        :param articles: the articles to process, each with `source`, `id` and `text`
+        :param use_cache: whether to look up per-article results in the article cache, results are stored either way
+        :param priority: priority of the MetaMap jobs in the persistent pool, lower values are served first
+        :param progress: called with (articles done, total articles, aggregator) whenever articles are done
+        :return: a list of terms sorted by occurrence
+        """
+        start_time = time.time()
+        aggregator = TermAggregator()
+        self.timed_out = []
+        done = 0
+        for i, entries in self.annotate(articles, use_cache, priority):
+            if entries is None:
+                self.timed_out.append({'source': articles[i]['source'], 'id': articles[i]['id']})
+            else:
+                aggregator.add(articles[i]['source'], articles[i]['id'], entries)
+            done += 1
+            if progress:
+                progress(done, len(articles), aggregator)
+        return self._sort_terms(aggregator, len(articles), start_time)
+
+    def stream(self, articles: List[Dict], use_cache: bool = True, priority: int = 0) -> Iterable[Dict]:
+        """
+        run MetaMap on articles, reporting the terms of each article as soon as it is done
+        :param articles: the articles to process, each with `source`, `id` and `text`
+        :param use_cache: whether to look up per-article results in the article cache, results are stored either way
+        :param priority: priority of the MetaMap jobs in the persistent pool, lower values are served first
+        :return: yields an `article` record with the `source`, `id` and `terms` of each article, in order of
+        completion, or `timed_out` instead of `terms` if MetaMap timed out on it. Then a `summary` record with the
+        terms of all articles sorted by occurrence, and the articles MetaMap timed out on if any.
+        """
+        start_time = time.time()
+        aggregator = TermAggregator()
+        self.timed_out = []
+        for i, entries in self.annotate(articles, use_cache, priority):
+            source, source_id = articles[i]['source'], articles[i]['id']
+            if entries is None:
+                self.timed_out.append({'source': source, 'id': source_id})
+                yield {'type': 'article', 'source': source, 'id': source_id, 'timed_out': True}
+                continue
+            aggregator.add(source, source_id, entries)
+            article_terms = TermAggregator()
+            article_terms.add(source, source_id, entries)
+            yield {'type': 'article', 'source': source, 'id': source_id, 'terms': article_terms.terms()}
+        summary = {'type': 'summary', 'terms': self._sort_terms(aggregator, len(articles), start_time)}
+        if self.timed_out:
+            summary['timed_out'] = self.timed_out
+        yield summary
+
+    def _sort_terms(self, aggregator: TermAggregator, articles: int, start_time: float) -> List[Dict]:
+        """
+        :return: the terms of the aggregator sorted by occurrence, logging the timing of the run
+        """
+        annotate_time = time.time()
+        terms = aggregator.terms()
+        logger.debug(f'parsing finished, result: {terms}')
+        post_sort = time.time()
+        logger.info(f'result sort time: {post_sort - annotate_time}')
+        logger.info(f'total time: {post_sort - start_time}')
+        logger.info(f'{len(terms)} terms found for {articles} articles.')
+        record_stage('sort', post_sort - annotate_time)
+        record_stage('total', post_sort - start_time)
+        REQUEST_ARTICLES.observe(articles)
+        REQUEST_TERMS.observe(len(terms))
+        if self.timed_out:
+            logger.error(f'MetaMap timed out on {len(self.timed_out)} articles: {self.timed_out}')
+        return terms
+
+    def annotate(self, articles: List[Dict], use_cache: bool = True,
+                 priority: int = 0) -> Iterable[Tuple[int, List[Dict]]]:
+        """
+        run MetaMap on articles, without aggregating the terms found
+        :param articles: the articles to process, each with `text`
+        :param use_cache: whether to look up per-article results in the article cache, results are stored either way
+        :param priority: priority of the MetaMap jobs in the persistent pool, lower values are served first
+        :return: yields (index of the article, entries found in the article), cache hits first and then in order of
+        completion. Entries are None for articles MetaMap timed out on, now or recently.
+        """
         logger.debug(f'running metamap on input text: {articles}')
         start_time = time.time()
-        if not os.path.exists(f'{self._PROJECT_PATH}/out'):
-            logger.debug('creating output folder.')
-            os.makedirs(f'{self._PROJECT_PATH}/out')
-
-        # step 1: write each article to a separate file
-        logger.debug('start pre-parsing.')
-        filenames = []
-        for article in articles:
+        sem_types = self._METAMAP_SEM_TYPES.split(',') if self._METAMAP_SEM_TYPES else None
+        data_sources = self._METAMAP_DATA_SOURCES.split(',') if self._METAMAP_DATA_SOURCES else None
+
+        # step 1: look up articles in cache, only cache misses go to MetaMap
+        parse = 'sentences' if self._METAMAP_SENTENCE_CACHE else f'chunks:{self._METAMAP_MAX_CHUNK}'
+        misses = []
+        for i, article in enumerate(articles):
             ascii_text = self.remove_non_ascii(article['text'])
-            filename = f'{self._PROJECT_PATH}/out/input_{article["source"]}_{article["id"]}.tmp'
-            filenames.append(filename)
-            with open(filename, 'w') as file:   # create a list of temp files
-                file.write(ascii_text)
-                file.write('\n')  # metamap needs a new line at EOF
-
-        logger.debug(f'{len(filenames)} temp files created.')
-        pre_parse = time.time()
-
-        # step 2: run metamap on those files using as much processors as possible in parallel
-        logger.debug('pre-parsing finished, start MetaMap')
-        temp_results = []
-        with ProcessPoolExecutor(max_workers=self.max_processes) as pool:
-            logger.info(f'dispatching jobs to {self.max_processes} cores')
-            sem_types = self._METAMAP_SEM_TYPES.split(',') if self._METAMAP_SEM_TYPES else None
-            data_sources = self._METAMAP_DATA_SOURCES.split(',') if self._METAMAP_DATA_SOURCES else None
-            for name in filenames:
-                temp_result = f'{name}.res'
-                temp_results.append(temp_result)
-                pool.submit(self._run_metamap, name, temp_result, sem_types, data_sources)
-
-        metamap_time = time.time()
-
-        # step 3: parse metamap results
-        logger.debug('MetaMap finished, start parsing result')
-        terms = self._parse_result(temp_results)
-        logger.debug('removing temp files.')
-        command = f'rm {self._PROJECT_PATH}/out/*.tmp*'  # remove all tmp files
-        self._run_command(command)
-        post_parse = time.time()
-
-        logger.info(f'pre-parse time: {pre_parse - start_time}')
-        logger.info(f'metamap time: {metamap_time - pre_parse}')
-        logger.info(f'result parse time: {post_parse - metamap_time}')
-        logger.info(f'total time: {post_parse - start_time}')
-        logger.info(f'{len(terms)} terms found for {len(articles)} articles.')
-        return terms
+            key = self._article_cache.make_key(ascii_text, sem_types, data_sources, self._METAMAP_OUTPUT, parse)
+            entries = self._article_cache.get(key)
+            if entries == self._FAILURE:  # even without cache, so that a poison input cannot be retried in a loop
+                logger.info(f'skipping article {i}, MetaMap timed out on it recently.')
+                yield i, None
+            elif entries is None or not use_cache:
+                misses.append((i, ascii_text, key))
+            else:
+                yield i, entries
+        logger.info(f'{len(articles) - len(misses)} of {len(articles)} articles hit the article cache.')
+        cache_time = time.time()
+        logger.info(f'cache lookup time: {cache_time - start_time}')
+        record_stage('cache_lookup', cache_time - start_time)
+        if not misses:
+            return
+
+        # step 2: run metamap on cache misses, as whole texts or as sentences not seen yet
+        tagger_supervisor.ensure_started()
+        if not tagger_supervisor.ready:
+            raise TaggerUnavailableError('MetaMap servers are not ready, retry later.')
+        texts = [ascii_text for _, ascii_text, _ in misses]
+        if self._METAMAP_SENTENCE_CACHE:
+            results = self._map_sentences(texts, sem_types, data_sources, priority, use_cache)
+        else:
+            results = self._map_texts(texts, sem_types, data_sources, priority)
+        for j, entries in results:
+            i, _, key = misses[j]
+            if entries is None:
+                METAMAP_TIMEOUTS.inc()
+                self._article_cache.memorize(key, self._FAILURE, ttl=self._METAMAP_FAILURE_TTL)
+            else:
+                self._article_cache.memorize(key, entries)
+            yield i, entries
+        logger.info(f'metamap time: {time.time() - cache_time}')
+        record_stage('metamap', time.time() - cache_time)
+
+    def _map_texts(self, texts: List[str], sem_types: List[str] = None, data_sources: List[str] = None,
+                   priority: int = 0) -> Iterable[Tuple[int, List[Dict]]]:
+        """
+        run MetaMap on texts, splitting texts longer than METAMAP_MAX_CHUNK into chunks of whole sentences, so that
+        a single long text does not keep one MetaMap process busy long after the others are idle
+        :param texts: ASCII texts to process
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :param priority: priority of the jobs in the persistent pool
+        :return: yields (index of the text, entries found in the text), as soon as all its chunks are done.
+        Entries are None if MetaMap timed out on any chunk of the text.
+        """
+        chunks = []  # (index of the text, offset in the text, chunk)
+        for i, text in enumerate(texts):
+            chunks.extend((i, offset, chunk) for offset, chunk in self._split_chunks(text, self._METAMAP_MAX_CHUNK))
+        if len(chunks) > len(texts):
+            logger.info(f'{len(texts)} texts split into {len(chunks)} chunks.')
+
+        parts = [[] for _ in texts]  # (offset, entries) of the chunks done, for each text
+        waiting = [0] * len(texts)  # number of chunks each text waits for
+        for i, _, _ in chunks:
+            waiting[i] += 1
+        for j, entries in self._map_parsed([chunk for _, _, chunk in chunks], sem_types, data_sources, priority):
+            i, offset, _ = chunks[j]
+            parts[i].append((offset, entries))
+            waiting[i] -= 1
+            if not waiting[i]:
+                if any(part is None for _, part in parts[i]):
+                    yield i, None
+                    continue
+                parts[i].sort(key=lambda part: part[0])
+                yield i, [self._shift_entry(entry, part_offset) for part_offset, part in parts[i] for entry in part]
+
+    def _map_parsed(self, texts: List[str], sem_types: List[str] = None, data_sources: List[str] = None,
+                    priority: int = 0) -> Iterable[Tuple[int, List[Dict]]]:
+        """
+        run MetaMap on texts, parsing the output of each job as soon as it is done
+        :param texts: ASCII texts to process
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :param priority: priority of the jobs in the persistent pool
+        :return: yields (index of the text, entries found in the text), in order of completion. Entries are None if
+        MetaMap timed out on the text.
+        """
+        parse_time = 0
+        for outputs in self._map_jobs(texts, sem_types, data_sources, priority):
+            pre_parse = time.time()
+            parsed = [(i, None if lines is None else self._parse_output(lines)) for i, lines in outputs.items()]
+            parse_time += time.time() - pre_parse
+            yield from parsed
+        logger.info(f'result parse time: {parse_time} (overlapped with metamap)')
+        record_stage('parse', parse_time)
+
+    @classmethod
+    def _sentence_spans(cls, text: str) -> List[Tuple[int, int]]:
+        """
+        :return: (start, end) of each sentence of a text, whitespaces between sentences are left out
+        """
+        spans = []
+        start = 0
+        for boundary in list(cls._SENTENCE_BOUNDARY.finditer(text)) + [None]:
+            end = boundary.start() if boundary else len(text)
+            if end > start:
+                spans.append((start, end))
+            if boundary:
+                start = boundary.end()
+        return spans
+
+    @classmethod
+    def _split_chunks(cls, text: str, max_chars: int) -> List[Tuple[int, str]]:
+        """
+        split a text into chunks of consecutive sentences of at most max_chars characters.
+        A sentence longer than max_chars makes a chunk on its own.
+        :param text: the text to split
+        :param max_chars: max length of a chunk, 0 to keep the text whole
+        :return: (offset in the text, chunk) of each chunk
+        """
+        if max_chars <= 0 or len(text) <= max_chars:
+            return [(0, text)]
+        chunks = []
+        chunk_start, chunk_end = None, None
+        for start, end in cls._sentence_spans(text):
+            if chunk_start is not None and end - chunk_start > max_chars:
+                chunks.append((chunk_start, text[chunk_start:chunk_end]))
+                chunk_start = None
+            if chunk_start is None:
+                chunk_start = start
+            chunk_end = end
+        if chunk_start is not None:
+            chunks.append((chunk_start, text[chunk_start:chunk_end]))
+        return chunks
+
+    @classmethod
+    def _split_sentences(cls, text: str) -> List[Tuple[Tuple[List[int], List[int]], str]]:
+        """
+        split a text into sentences, normalized by collapsing whitespaces
+        :param text: the text to split
+        :return: (words, normalized sentence) of each sentence, words holding the start of each word in the normalized
+        sentence and in the text, so that positions in the sentence can be mapped back to the text
+        """
+        res = []
+        for start, end in cls._sentence_spans(text):
+            words = list(cls._NON_SPACE.finditer(text, start, end))
+            if words:
+                normalized_starts, position = [], 0
+                for word in words:
+                    normalized_starts.append(position)
+                    position += len(word.group(0)) + 1
+                res.append(((normalized_starts, [word.start() for word in words]),
+                            ' '.join(word.group(0) for word in words)))
+        return res
+
+    @classmethod
+    def _map_entry(cls, entry: Dict, words: Tuple[List[int], List[int]]) -> Dict:
+        """
+        :param words: start of each word in the normalized sentence and in the text, from _split_sentences
+        :return: the entry of a normalized sentence with its positions relative to the text holding the sentence
+        """
+        if 'positions' not in entry:
+            return entry
+        normalized, original = words
+
+        def to_text(position: int) -> int:
+            i = max(bisect.bisect_right(normalized, position) - 1, 0)
+            return original[i] + position - normalized[i]
+
+        return dict(entry, positions=[[to_text(start), to_text(start + length - 1) + 1 - to_text(start)]
+                                      for start, length in entry['positions']])
+
+    @classmethod
+    def _shift_entry(cls, entry: Dict, offset: int) -> Dict:
+        """
+        :return: the entry of a sentence with its positions relative to the text holding the sentence
+        """
+        if not offset or 'positions' not in entry:
+            return entry
+        return dict(entry, positions=[[start + offset, length] for start, length in entry['positions']])
+
+    def _map_sentences(self, texts: List[str], sem_types: List[str] = None, data_sources: List[str] = None,
+                       priority: int = 0, use_cache: bool = True) -> Iterable[Tuple[int, List[Dict]]]:
+        """
+        run MetaMap on the sentences of texts that are not in the sentence cache, and rebuild the entries of each text
+        from the entries of its sentences. Sentences shared by several texts go through MetaMap once.
+        :param texts: ASCII texts to process
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :param priority: priority of the jobs in the persistent pool
+        :param use_cache: whether to look up sentences in the sentence cache, results are stored either way
+        :return: yields (index of the text, entries found in the text), as soon as all its sentences are done.
+        Entries are None if MetaMap timed out on any sentence of the text.
+        """
+        splits = []  # (words, sentence key) of each sentence of each text
+        entries = {}  # sentence key -> entries
+        pending = {}  # sentence key -> (sentence, indices of the texts waiting for it)
+        for i, text in enumerate(texts):
+            split = [(words, self._sentence_cache.make_key(sentence, sem_types, data_sources, self._METAMAP_OUTPUT,
+                                                           'sentence'), sentence)
+                     for words, sentence in self._split_sentences(text)]
+            for _, key, sentence in split:
+                if key in pending:
+                    pending[key][1].add(i)
+                elif key not in entries:
+                    cached = self._sentence_cache.get(key) if use_cache else None
+                    if cached is None:
+                        pending[key] = (sentence, {i})
+                    else:
+                        entries[key] = cached
+            splits.append([(words, key) for words, key, _ in split])
+        logger.info(f'{len(entries)} of {len(entries) + len(pending)} sentences hit the sentence cache.')
+
+        def rebuild(index: int) -> Tuple[int, Union[List[Dict], None]]:
+            if any(entries[key] is None for _, key in splits[index]):
+                return index, None
+            return index, [self._map_entry(entry, words) for words, key in splits[index] for entry in entries[key]]
+
+        waiting = [0] * len(texts)  # number of sentences each text waits for
+        for _, indices in pending.values():
+            for i in indices:
+                waiting[i] += 1
+        for i in range(len(texts)):
+            if not waiting[i]:
+                yield rebuild(i)
+
+        keys = list(pending)
+        for j, sentence_entries in self._map_parsed([pending[key][0] for key in keys], sem_types, data_sources,
+                                                    priority):
+            key = keys[j]
+            if sentence_entries is not None:
+                self._sentence_cache.memorize(key, sentence_entries)
+            entries[key] = sentence_entries
+            for i in pending[key][1]:
+                waiting[i] -= 1
+                if not waiting[i]:
+                    yield rebuild(i)
+
+    def _map_jobs(self, texts: List[str], sem_types: List[str] = None, data_sources: List[str] = None,
+                  priority: int = 0) -> Iterable[Dict[int, List[str]]]:
+        """
+        run MetaMap on texts, through the persistent pool of warm MetaMap processes if enabled, otherwise with one
+        MetaMap process per job using as much processors as possible in parallel.
+        In both cases inputs and outputs go through pipes, so that concurrent requests never share any file.
+        :param texts: ASCII texts to process
+        :param sem_types: the semantic types to restrict to, use default in common case
+        :param data_sources: the sources to restrict to, use default in common case
+        :param priority: priority of the jobs in the persistent pool
+        :return: yields MetaMap output lines of the texts of each job by index, in order of completion. Jobs taking longer
+        than METAMAP_TIMEOUT seconds per text are killed, texts of a batch are then retried one by one, and the output
+        of a single text MetaMap timed out on is None.
+        """
+        blank = [i for i, text in enumerate(texts) if not text.strip()]
+        if blank:  # e.g. texts with non-ASCII characters only, a persistent MetaMap never ends a blank citation
+            yield {i: [] for i in blank}
+        jobs = self._make_jobs(texts, interactive=self._METAMAP_POOL)
+        if not jobs:
+            return
+        # longest jobs first, so that the last jobs to finish are short ones and all processes finish close together
+        jobs.sort(key=lambda job: sum(len(texts[i]) for i in job[0]), reverse=True)
+        pool = self._get_pool(self.max_processes, sem_types, data_sources) if self._METAMAP_POOL else None
+        if self._slots is not None and self.admit:
+            self._slots.admit(len(jobs), pool.pending() if pool else 0)
+        start = time.time()
+        busy = {}  # seconds each thread spent running MetaMap, without the pool
+
+        def run_timed(payload: str, timeout: float) -> List[str]:
+            with self._slots.slot(priority) if self._slots else nullcontext():
+                job_start = time.time()
+                try:
+                    return self._run_metamap(payload, sem_types, data_sources, timeout)
+                finally:
+                    name = threading.current_thread().name
+                    busy[name] = busy.get(name, 0) + time.time() - job_start
+
+        executor = None if pool else ThreadPoolExecutor(max_workers=self.max_processes, thread_name_prefix='metamap')
+
+        def submit(indices: List[int], payload: str):
+            timeout = self._METAMAP_TIMEOUT * len(indices) if self._METAMAP_TIMEOUT > 0 else None
+            if pool:
+                return pool.submit(payload, citations=len(indices), priority=priority, timeout=timeout)
+            return executor.submit(run_timed, payload, timeout)
+
+        if pool:
+            logger.info(f'dispatching {len(jobs)} jobs to {pool.size} metamap workers')
+            busy_before = pool.busy_times()
+        else:
+            logger.info(f'dispatching {len(jobs)} jobs to {self.max_processes} cores')
+        try:
+            futures = {submit(indices, payload): indices for indices, payload in jobs}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indices = futures.pop(future)
+                    try:
+                        yield self._split_output(indices, future.result())
+                    except MetaMapTimeout as e:
+                        logger.error(f'{e} texts: {indices}')
+                        if len(indices) == 1:
+                            yield {indices[0]: None}
+                            continue
+                        # retry each text of the batch on its own, so that only the texts MetaMap hangs on time out
+                        for i in indices:
+                            futures[submit([i], self._format_job(texts, [i], interactive=pool is not None))] = [i]
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+        if pool:
+            busy_after = pool.busy_times()
+            busy = {name: busy_after[name] - busy_before[name] for name in busy_after}
+        self._log_utilization(busy, time.time() - start)
+
+    @classmethod
+    def _log_utilization(cls, busy: Dict[str, float], elapsed: float) -> None:
+        """
+        log the share of time each MetaMap process was busy while running jobs. When the persistent pool is shared
+        by concurrent requests, the time spent on the other requests is included.
+        :param busy: busy seconds of each MetaMap process
+        :param elapsed: seconds from the first submitted job to the last finished one
+        """
+        if elapsed <= 0 or not busy:
+            return
+        usage = ', '.join(f'{name} {min(seconds / elapsed, 1):.0%}' for name, seconds in sorted(busy.items()))
+        logger.info(f'metamap utilization over {elapsed:.2f}s: {usage}')
+
+    @classmethod
+    def collect_metrics(cls) -> None:
+        """
+        update the metrics of the MetaMap pool of this process and of the machine-wide slots
+        """
+        if cls._pool is not None:
+            POOL_PENDING.set(cls._pool.pending())
+            for name, seconds in cls._pool.busy_times().items():
+                POOL_BUSY_SECONDS.set(seconds, worker=name)
+        if cls._slots is not None:
+            waiting, running = cls._slots.counts()
+            SLOTS_JOBS.set(waiting, state='waiting')
+            SLOTS_JOBS.set(running, state='running')
+
+
+registry.add_collector(MetaMaPY.collect_metrics)
@@ -1,12 +1,15 @@
 import os
-import requests
-from typing import Union, Dict
-from requests.exceptions import Timeout
+from typing import Union, Dict, Tuple
+from requests.exceptions import Timeout, RequestException
 
+from libs.article_store import article_store
+from libs.http_client import HTTPClient
+from libs.omim_search import parse_omim_search
 from utils.logger import logger
 
 
-OMIM_URL = 'https://api.omim.org/api/entry/search?search=av_db_snp:{}&include=allelicVariantList&format=json'
+OMIM_BASE_URL = os.getenv('OMIM_BASE_URL', 'https://api.omim.org/api')  # e.g. the fixture server of the benchmarks
+OMIM_URL = f'{OMIM_BASE_URL}/entry/search?search=av_db_snp:{{}}&include=allelicVariantList&format=json'
 _OMIM_API_KEY = os.getenv('OMIM_KEY')
 if not _OMIM_API_KEY:
     raise EnvironmentError('Must specify OMIM_KEY in environment.')
@@ -20,32 +23,42 @@ except TypeError:
 _headers = {
     'apiKey': _OMIM_API_KEY,
 }
+_client = HTTPClient('OMIM')
 
 
 def get_omim(rsid: str) -> Union[None, Dict]:
+    """
+    Query OMIM for the allelic variant of a rsID, using the article store when it is enabled and fresh
+    :param rsid: the rsID to query
+    :return: the variant as an article, None if there is none or the query failed
+    """
+    if article_store is not None:
+        stored, article = article_store.get_omim(rsid)
+        if stored:
+            logger.debug(f'OMIM result of {rsid} found in article store.')
+            return article
+
+    succeeded, article = _fetch_omim(rsid)
+    if succeeded and article_store is not None:
+        article_store.put_omim(rsid, article)
+    return article
+
+
+def _fetch_omim(rsid: str) -> Tuple[bool, Union[None, Dict]]:
     try:
-        res = requests.get(OMIM_URL.format(rsid), headers=_headers, timeout=timeout)
+        res = _client.get(OMIM_URL.format(rsid), headers=_headers, timeout=timeout)
     except Timeout:
         logger.error(f'OMIM request timeout. (>{timeout}s)')
-        return None
+        return False, None
+    except RequestException as e:
+        logger.error(f'OMIM request failed. {e}')
+        return False, None
     else:
         if res.status_code == 200:
             logger.debug('OMIM request succeeded.')
             res_json = res.json()
             logger.debug(res_json)
-            try:
-                allelic_variants = res_json['omim']['searchResponse']['entryList'][0]['entry']['allelicVariantList']
-                for each in allelic_variants:
-                    variant = each['allelicVariant']
-                    if rsid == variant.get('dbSnps'):
-                        return {
-                            'source': 'omim',
-                            'id': f'{variant["mimNumber"]}#{variant["number"]:04d}',  # format to be 4 digits (e.g 0001)
-                            'text': variant['text'],
-                        }
-            except (IndexError, KeyError) as e:
-                logger.debug(f'OMIM no result. {e}')
-        else:
-            logger.debug('OMIM request failed.')
-            logger.debug(res.text)
-        return None  # no result or failed
+            return True, parse_omim_search(rsid, res_json)
+        logger.debug('OMIM request failed.')
+        logger.debug(res.text)
+        return False, None
@@ -0,0 +1,25 @@
+from typing import Union, Dict
+
+from utils.logger import logger
+
+
+def parse_omim_search(rsid: str, response: Dict) -> Union[Dict, None]:
+    """
+    Find the allelic variant of a rsID in an OMIM entry search response
+    :param rsid: the rsID searched for
+    :param response: the decoded JSON response of the search
+    :return: the variant as an article with `source`, `id` and `text`, None if there is none
+    """
+    try:
+        allelic_variants = response['omim']['searchResponse']['entryList'][0]['entry']['allelicVariantList']
+        for each in allelic_variants:
+            variant = each['allelicVariant']
+            if rsid == variant.get('dbSnps'):
+                return {
+                    'source': 'omim',
+                    'id': f'{variant["mimNumber"]}#{variant["number"]:04d}',  # format to be 4 digits (e.g 0001)
+                    'text': variant['text'],
+                }
+    except (IndexError, KeyError) as e:
+        logger.debug(f'OMIM no result. {e}')
+    return None
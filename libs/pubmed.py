@@ -1,25 +1,33 @@
 import os
-import requests
-from typing import Union, Dict, List
+from collections import deque
+from typing import Union, Dict, Iterator, List, Tuple
 from xml.etree import ElementTree
-from xml.etree.ElementTree import Element
-from requests.exceptions import Timeout
+from requests.exceptions import Timeout, RequestException
+from urllib3.exceptions import HTTPError as StreamError
 
+from libs.article_store import article_store
+from libs.efetch import parse_efetch
+from libs.http_client import HTTPClient
+from utils.executor import ProcessLocalThreadPool
 from utils.logger import logger
 
 """
-Read from env for PUBMED_KEY, PUBMED_TIMEOUT and PUBMED_RET_MAX 
+Read from env for PUBMED_BASE_URL, PUBMED_KEY, PUBMED_TIMEOUT, PUBMED_RET_MAX and PUBMED_RATE_LIMIT
+PUBMED_BASE_URL is optional, defines the E-utilities base url, e.g. the fixture server of the benchmarks, defaults to
+the NCBI one
 PUBMED_KEY is required and allow us to query PubMed at a higher rate.
 PUBMED_TIMEOUT is optional, defines the request timeout for both e-search and e-fetch, defaults to 3.5s
 PUBMED_RET_MAX is optional, defines the max return size (number of articles), defaults to 50
+PUBMED_RATE_LIMIT is optional, defines the max number of requests per second of each app process, defaults to 10 which
+is the quota of an API key. It should be divided by the number of app processes sharing the key.
+PUBMED_FETCH_PAGE_SIZE is optional, defines how many articles each EFetch request returns, pages being fetched
+concurrently, defaults to 20
 """
-PUBMED_BASE_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+PUBMED_BASE_URL = os.getenv('PUBMED_BASE_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils')
 PUBMED_API_KEY = os.getenv('PUBMED_KEY')
 if not PUBMED_API_KEY:
     raise EnvironmentError('Must specify PUBMED_KEY in environment.')
 
-API_KEY_ARGS = f'api_key={PUBMED_API_KEY}'
-
 try:
     TIMEOUT = float(os.getenv('PUBMED_TIMEOUT', 3.5))
     logger.info(f'PUBMED timeout set to {TIMEOUT}')
@@ -32,12 +40,30 @@ try:
 except TypeError:
     raise EnvironmentError('Expect PUBMED_RET_MAX to evaluate to a number.')
 
+try:
+    PUBMED_RATE_LIMIT = float(os.getenv('PUBMED_RATE_LIMIT', 10))
+    logger.info(f'PUBMED rate limit set to {PUBMED_RATE_LIMIT}/s')
+except ValueError:
+    raise EnvironmentError('Expect PUBMED_RATE_LIMIT to evaluate to a number.')
+
+try:
+    PUBMED_FETCH_PAGE_SIZE = int(os.getenv('PUBMED_FETCH_PAGE_SIZE', 20))
+    logger.info(f'PUBMED EFetch page size set to {PUBMED_FETCH_PAGE_SIZE}')
+except ValueError:
+    raise EnvironmentError('Expect PUBMED_FETCH_PAGE_SIZE to evaluate to a number.')
+
+_client = HTTPClient('PubMed', rate_limit=PUBMED_RATE_LIMIT)
+_page_pool = ProcessLocalThreadPool(4, 'efetch')
+
 
 def get_pubmed(term: str) -> Union[None, List]:
     """
-    Use sequential requests to query PubMed (search and then fetch) using the ESearch and EFetch from E-utilities
+    Use sequential requests to query PubMed (search and then fetch) using the ESearch and EFetch from E-utilities.
+    When the article store is enabled, only the articles that are not stored yet are fetched.
     :param term:
     :return:
+    :raise RequestException: if a page of articles failed to be fetched, so that PubMed is reported as missing
+    instead of its partial result being taken as complete
     """
     search_res = _search_pubmed(term)
 
@@ -45,19 +71,99 @@ def get_pubmed(term: str) -> Union[None, List]:
         logger.debug('PUBMED no result.')
         return None
 
-    web_env = search_res.get('web_env')
-    query_key = search_res.get('query_key')
-
-    return _fetch_pubmed(web_env=web_env, query_key=query_key)
+    if article_store is None:
+        web_env = search_res.get('web_env')
+        query_key = search_res.get('query_key')
+        count = min(search_res.get('count'), PUBMED_RET_MAX)
+        futures = [_page_pool.submit(_fetch_pubmed, web_env=web_env, query_key=query_key, retstart=start,
+                                     retmax=min(PUBMED_FETCH_PAGE_SIZE, count - start))
+                   for start in range(0, count, PUBMED_FETCH_PAGE_SIZE)]
+        return [article for future in futures for article in future.result()]
+
+    ids = search_res.get('ids')
+    articles = article_store.get_many('pubmed', ids)
+    missing = [pubmed_id for pubmed_id in ids if pubmed_id not in articles]
+    logger.info(f'{len(articles)} of {len(ids)} PubMed articles found in article store.')
+    if missing:
+        futures = [_page_pool.submit(_fetch_pubmed, ids=missing[start:start + PUBMED_FETCH_PAGE_SIZE])
+                   for start in range(0, len(missing), PUBMED_FETCH_PAGE_SIZE)]
+        fetched, failure = [], None
+        for future in futures:
+            try:
+                fetched.extend(future.result())
+            except RequestException as e:
+                failure = e
+        article_store.put_many(fetched)  # pages fetched are not lost with the failed ones
+        if failure is not None:
+            raise failure
+        articles.update((article['id'], article) for article in fetched)
+    return [articles[pubmed_id] for pubmed_id in ids if pubmed_id in articles]  # keep the order of ESearch
+
+
+def iter_pubmed(term: str, batch_size: int, max_articles: int,
+                prefetch: int = 2) -> Iterator[Tuple[int, int, Union[List[Dict], None]]]:
+    """
+    Page through all PubMed articles about a term with the ESearch history (WebEnv, query_key and retstart), keeping
+    the next `prefetch` EFetch batches in flight while the caller processes the current one. Only `prefetch + 1`
+    batches are held at a time, whatever the number of articles.
+    :param term: the term to query
+    :param batch_size: number of articles of each EFetch request
+    :param max_articles: max number of articles to fetch, in the order of ESearch (most recent first)
+    :param prefetch: number of batches fetched ahead
+    :return: yields (number of articles PubMed has about the term, number of articles requested in the batch, batch
+    of articles) for each batch, in the order of ESearch. The batch is None if it failed to be fetched, so that the
+    caller can skip it and account for its articles. Nothing is yielded if there is no article.
+    :raise RequestException: if the search failed
+    """
+    search_res = _search_pubmed(term)
+    if not search_res:
+        raise RequestException(f'PubMed ESearch failed for {term}.')
+    if search_res.get('count') <= 0:
+        logger.debug('PUBMED no result.')
+        return
+
+    count = search_res.get('count')
+    total = min(count, max_articles)
+    starts = iter(range(0, total, batch_size))
+    futures = deque()
+
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            size = min(batch_size, total - start)
+            futures.append((size, _page_pool.submit(_efetch, web_env=search_res.get('web_env'),
+                                                    query_key=search_res.get('query_key'), retstart=start,
+                                                    retmax=size)))
+
+    for _ in range(prefetch + 1):
+        submit()
+    try:
+        while futures:
+            size, future = futures.popleft()
+            batch = future.result()
+            submit()
+            yield count, size, batch
+    finally:  # the caller stopped early, batches not started yet are not fetched
+        for _, future in futures:
+            future.cancel()
 
 
 def _search_pubmed(term: str) -> Union[Dict, None]:
     try:
-        args = f'db=pubmed&term={term}&usehistory=y&retmax={PUBMED_RET_MAX}&{API_KEY_ARGS}'
-        res = requests.get(f'{PUBMED_BASE_URL}/esearch.fcgi?{args}', timeout=TIMEOUT)
+        params = {
+            'db': 'pubmed',
+            'term': term,
+            'usehistory': 'y',
+            'retmax': PUBMED_RET_MAX,
+            'api_key': PUBMED_API_KEY,
+        }
+        res = _client.get(f'{PUBMED_BASE_URL}/esearch.fcgi', params=params, timeout=TIMEOUT)
     except Timeout:
         logger.error(f'PUBMED search request timeout. (>{TIMEOUT}s)')
         return None
+    except RequestException as e:
+        logger.error(f'PUBMED search request failed. {e}')
+        return None
 
     if res.status_code == 200:  # ESearch succeeded
         logger.debug('PUBMED search request succeeded.')
@@ -71,10 +177,12 @@ def _search_pubmed(term: str) -> Union[Dict, None]:
             count = int(xml.find('./Count').text)
             query_key = xml.find('./QueryKey').text
             web_env = xml.find('./WebEnv').text
+            ids = [each.text for each in xml.findall('./IdList/Id')]
             return {
                 'count': count,
                 'query_key': query_key,
-                'web_env': web_env
+                'web_env': web_env,
+                'ids': ids,
             }
         except AttributeError as e:
             logger.error(f'PubMed ESearch result has wrong format. {e}')
@@ -88,66 +196,55 @@ def _search_pubmed(term: str) -> Union[Dict, None]:
     return None
 
 
-def _fetch_pubmed(web_env: str, query_key: str) -> List:
-    result = []
+def _fetch_pubmed(web_env: str = None, query_key: str = None, ids: List[str] = None, retstart: int = 0,
+                  retmax: int = PUBMED_RET_MAX) -> List:
+    """
+    Fetch articles either from the ESearch history (web_env and query_key, paged with retstart and retmax) or by PMIDs
+    :raise RequestException: if the request failed
+    """
+    articles = _efetch(web_env, query_key, ids, retstart, retmax)
+    if articles is None:
+        raise RequestException('PubMed EFetch failed.')  # the cause has been logged by _efetch
+    return articles
+
+
+def _efetch(web_env: str = None, query_key: str = None, ids: List[str] = None, retstart: int = 0,
+            retmax: int = PUBMED_RET_MAX) -> Union[List, None]:
+    """
+    same as _fetch_pubmed, but None if the request failed
+    """
     try:
-        args = f'db=pubmed&WebEnv={web_env}&query_key={query_key}&retmode=xml&retmax={PUBMED_RET_MAX}&{API_KEY_ARGS}'
-        res = requests.get(f'{PUBMED_BASE_URL}/efetch.fcgi?{args}', timeout=TIMEOUT)
+        params = {
+            'db': 'pubmed',
+            'retmode': 'xml',
+            'retstart': retstart,
+            'retmax': retmax,
+            'api_key': PUBMED_API_KEY,
+        }
+        if ids:
+            params['id'] = ','.join(ids)
+        else:
+            params['WebEnv'] = web_env
+            params['query_key'] = query_key
+        res = _client.get(f'{PUBMED_BASE_URL}/efetch.fcgi', params=params, timeout=TIMEOUT, stream=True)
     except Timeout:
         logger.error(f'PUBMED EFetch request timeout. (>{TIMEOUT}s)')
-        return result
-
-    if res.status_code == 200:  # ESearch succeeded
-        logger.debug('PubMed search request succeeded.')
-        xml: Element = ElementTree.fromstring(res.text)
-        if xml is None or xml.tag != 'PubmedArticleSet':
-            logger.error(f'PubMed EFetch result has wrong format.')
-            return result
-
-        a_count = 0
-        for each in xml.findall('./PubmedArticle/MedlineCitation'):
-            a_count += 1
-            p_count = 0
-            # parse pubmed ID
-            pubmed_id: Element = each.find('./PMID')
-            if pubmed_id is None:
-                logger.error(f'Failed to parse PMID')
-                continue
-            pubmed_id: str = pubmed_id.text
-
-            # parse title
-            article: Element = each.find('./Article')
-            if article is None:
-                logger.error(f'Failed to locate Article section for article #{a_count}')
-                continue
-
-            title: Element = article.find('ArticleTitle')
-            print(pubmed_id)
-            print(title.text)
-            paragraph_list = []
-            for paragraph in article.findall('./Abstract/AbstractText'):
-                p_count += 1
-                paragraph_text = "".join(paragraph.itertext())  # AbstractText may have additional nested xml
-                if paragraph_text:
-                    paragraph_list.append(paragraph_text)
-
-            abstract = ' '.join(paragraph_list)  # concatenate
-
-            if title is not None or len(abstract):  # as long as title or abstract has any text
-                text = f'{title.text} {abstract}'  # concatenate
-                result.append({
-                    'source': 'pubmed',
-                    'id': pubmed_id,
-                    'text': text,
-                })
-                logger.debug(f'article #{a_count}: {p_count} paragraphs')
-            else:
-                logger.error(f'Failed to parse ArticleTitle and AbstractText.')
-
-        logger.debug(f'Fetched {a_count} articles.')
-        return result
+        return None
+    except RequestException as e:
+        logger.error(f'PUBMED EFetch request failed. {e}')
+        return None
 
-    # else: no result or failed
-    logger.debug('PubMed EFetch request failed.')
-    logger.debug(res.text)
-    return result
+    with res:
+        if res.status_code == 200:  # EFetch succeeded
+            logger.debug('PubMed fetch request succeeded.')
+            res.raw.decode_content = True  # let urllib3 handle gzip
+            try:
+                return parse_efetch(res.raw)
+            except (ElementTree.ParseError, RequestException, StreamError) as e:  # e.g. connection lost mid-body
+                logger.error(f'Failed to read PubMed EFetch result. {e}')
+                return None
+
+        # else: no result or failed
+        logger.debug('PubMed EFetch request failed.')
+        logger.debug(res.text)
+        return None
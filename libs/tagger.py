@@ -0,0 +1,194 @@
+import fcntl
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict
+
+from utils.logger import logger
+
+"""
+Read from env for TAGGER_HOST, TAGGER_PORT, WSD_SERVER, WSD_PORT, TAGGER_CHECK_INTERVAL and TAGGER_START_TIMEOUT
+TAGGER_HOST is optional, defines the host of the MetaMap tagger (and WSD) server, defaults to localhost
+TAGGER_PORT is optional, defines the port of the tagger server, defaults to 1795
+WSD_SERVER is optional, set it to `true` to also supervise the word sense disambiguation server, which MetaMap needs
+when started with `-y`
+WSD_PORT is optional, defines the port of the WSD server, defaults to 5554
+TAGGER_CHECK_INTERVAL is optional, defines how often the servers are health-checked, defaults to 5s
+TAGGER_START_TIMEOUT is optional, defines how long to wait for a server to accept connections once started, defaults
+to 60s
+"""
+TAGGER_HOST = os.getenv('TAGGER_HOST', 'localhost')
+WSD_SERVER = os.getenv('WSD_SERVER', 'false').lower() == 'true'
+try:
+    TAGGER_PORT = int(os.getenv('TAGGER_PORT', 1795))
+    WSD_PORT = int(os.getenv('WSD_PORT', 5554))
+    TAGGER_CHECK_INTERVAL = float(os.getenv('TAGGER_CHECK_INTERVAL', 5))
+    TAGGER_START_TIMEOUT = float(os.getenv('TAGGER_START_TIMEOUT', 60))
+    logger.info(f'TAGGER_HOST={TAGGER_HOST}, TAGGER_PORT={TAGGER_PORT}, WSD_SERVER={WSD_SERVER}, WSD_PORT={WSD_PORT}')
+    logger.info(f'TAGGER_CHECK_INTERVAL={TAGGER_CHECK_INTERVAL}, TAGGER_START_TIMEOUT={TAGGER_START_TIMEOUT}')
+except ValueError:
+    raise EnvironmentError('Expect TAGGER_PORT, WSD_PORT, TAGGER_CHECK_INTERVAL and TAGGER_START_TIMEOUT to evaluate '
+                           'to numbers.')
+
+
+class TaggerUnavailableError(Exception):
+    """
+    Raised when MetaMap cannot run because its servers are down, the request should be retried later
+    """
+
+
+class TaggerSupervisor:
+    """
+    Keeps the servers MetaMap depends on running: the tagger server, and optionally the WSD server.
+    Servers are started once when the app starts, then each app process health-checks them over their sockets in the
+    background and restarts them when they stop answering. A file lock makes sure a single process starts or restarts
+    them at a time. Requests only read the in-memory `ready` flag.
+    """
+
+    def __init__(self, metamap_path: str, host: str = TAGGER_HOST, servers: Dict[str, int] = None,
+                 check_interval: float = TAGGER_CHECK_INTERVAL, start_timeout: float = TAGGER_START_TIMEOUT):
+        """
+        :param metamap_path: directory of the MetaMap commands
+        :param host: host of the servers
+        :param servers: port of each server, by the name of its control command
+        """
+        self.metamap_path = metamap_path
+        self.host = host
+        self.servers = servers if servers is not None else {'skrmedpostctl': TAGGER_PORT}
+        self.check_interval = check_interval
+        self.start_timeout = start_timeout
+        self.status: Dict[str, bool] = {name: False for name in self.servers}
+        self.installed = False
+        self._ready = threading.Event()
+        self._lock_path = os.path.join(tempfile.gettempdir(), 'metamapy_tagger.lock')
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start_servers(self) -> bool:
+        """
+        check that MetaMap is installed and start the servers that are not answering, once for all app processes
+        :return: whether all servers answer
+        """
+        self.installed = os.access(os.path.join(self.metamap_path, 'metamap'), os.X_OK)
+        if not self.installed:
+            logger.error(f'metamap not found in {self.metamap_path}, please make sure you have installed metamap.')
+            self._ready.clear()
+            return False
+        with open(self._lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # other processes wait, then find the servers answering
+            try:
+                for name, port in self.servers.items():
+                    self.status[name] = self._answers(port) or self._restart(name, port)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._update_ready()
+        return self.ready
+
+    def ensure_started(self) -> None:
+        """
+        start health-checking the servers in the background, once per process since threads do not survive uWSGI
+        forking its workers
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._probe()  # the flag is known before the first request is served, restarts happen in the background
+            threading.Thread(target=self._loop, name='tagger-supervisor', daemon=True).start()
+
+    def check(self) -> bool:
+        """
+        health-check the servers, restarting those that do not answer
+        :return: whether all servers answer
+        """
+        if not self._probe():
+            for name, healthy in self.status.items():
+                if not healthy:
+                    logger.error(f'{name} server on port {self.servers[name]} is not answering.')
+            self.start_servers()
+        return self.ready
+
+    def _probe(self) -> bool:
+        for name, port in self.servers.items():
+            self.status[name] = self._answers(port)
+        self.installed = os.access(os.path.join(self.metamap_path, 'metamap'), os.X_OK)
+        self._update_ready()
+        return self.ready
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f'failed to check MetaMap servers. {e}')
+                self._ready.clear()
+            time.sleep(self.check_interval)
+
+    def _update_ready(self) -> None:
+        if self.installed and all(self.status.values()):
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    def _answers(self, port: int) -> bool:
+        try:
+            with socket.create_connection((self.host, port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def _restart(self, name: str, port: int) -> bool:
+        """
+        stop and start a server with its control command, and wait until it accepts connections
+        :return: whether the server answers
+        """
+        command = os.path.join(self.metamap_path, name)
+        logger.info(f'starting {name} server...')
+        try:
+            self._control(command, 'stop')
+            output = self._control(command, 'start')
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f'failed to run `{command} start`. {e}')
+            return False
+        logger.debug(output)
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if self._answers(port):
+                logger.info(f'{name} server started.')
+                return True
+            time.sleep(0.5)
+        logger.error(f'{name} server did not answer on port {port} within {self.start_timeout}s: {output}')
+        return False
+
+    @classmethod
+    def _control(cls, command: str, action: str) -> str:
+        # the server started in the background may inherit stdout, so it goes to a file rather than a pipe whose end
+        # would never be reached
+        with tempfile.TemporaryFile('w+') as output:
+            subprocess.run([command, action], stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT,
+                           timeout=60)
+            output.seek(0)
+            return output.read()
+
+    def health(self) -> Dict:
+        """
+        :return: the state of MetaMap and of each server
+        """
+        return {'ready': self.ready, 'metamap': self.installed, 'servers': dict(self.status)}
+
+
+def _servers() -> Dict[str, int]:
+    servers = {'skrmedpostctl': TAGGER_PORT}
+    if WSD_SERVER:
+        servers['wsdserverctl'] = WSD_PORT
+    return servers
+
+
+tagger_supervisor = TaggerSupervisor(os.getenv('METAMAP_PATH', 'metamap'), servers=_servers())
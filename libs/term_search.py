@@ -0,0 +1,369 @@
+import itertools
+import math
+import os
+import time
+import traceback
+from concurrent.futures import TimeoutError
+from typing import Dict, Iterable, List, Tuple, Union
+from requests.exceptions import RequestException
+from libs.aggregator import TermAggregator, TopKTermAggregator
+from libs.literature import fetch_articles, FETCH_DEADLINE, FETCH_WORKERS
+from libs.metamapy import MetaMaPY, MAX_PROCESSES
+from libs.omim import get_omim
+from libs.pubmed import iter_pubmed, PUBMED_FETCH_PAGE_SIZE, PUBMED_RATE_LIMIT, PUBMED_RET_MAX
+from utils.executor import ProcessLocalThreadPool
+from utils.response_cache import ResponseCache, PreparedBody
+from utils.single_flight import SingleFlight
+from utils.logger import logger
+from utils.metrics import record_stage, REQUEST_ARTICLES, REQUEST_TERMS
+
+"""
+Read from env for BULK_MAX_TERMS, CACHE_SNAPSHOT and the CORPUS_ settings of full corpus queries
+BULK_MAX_TERMS is optional, defines the max number of terms of a bulk query, defaults to as many terms as PubMed can be
+queried for in 30s at PUBMED_RATE_LIMIT, i.e. 75 terms with the default PubMed settings, so that fetching takes a
+quarter of the `harakiri` of uWSGI and leaves the rest to MetaMap
+CACHE_SNAPSHOT is optional, defines the path of a snapshot written by `warm_cache.py`, loaded in the query cache when
+the app starts
+CORPUS_MAX_ARTICLES is optional, defines the max number of PubMed articles of a full corpus query, defaults to 10000,
+which is as far as the ESearch history of PubMed can be paged
+CORPUS_TIME_BUDGET is optional, defines the max seconds of a full corpus query, defaults to 90s to stay within the
+`harakiri` of uWSGI
+CORPUS_BATCH_SIZE is optional, defines the number of articles of each EFetch request and MetaMap run, defaults to 100
+CORPUS_TOP_K is optional, defines the number of terms a full corpus query keeps track of, defaults to 1000
+CORPUS_MAX_SOURCES is optional, defines the number of articles listed in the sources of each term, defaults to 100
+"""
+CACHE_SNAPSHOT = os.getenv('CACHE_SNAPSHOT')
+logger.info(f'CACHE_SNAPSHOT={CACHE_SNAPSHOT}')
+# an ESearch, then an EFetch request for each page of the articles of a term
+_PUBMED_REQUESTS_PER_TERM = 1 + math.ceil(PUBMED_RET_MAX / PUBMED_FETCH_PAGE_SIZE)
+try:
+    BULK_MAX_TERMS = int(os.getenv('BULK_MAX_TERMS', max(int(30 * PUBMED_RATE_LIMIT / _PUBMED_REQUESTS_PER_TERM), 1)))
+    logger.info(f'BULK_MAX_TERMS={BULK_MAX_TERMS}')
+except ValueError:
+    raise EnvironmentError('Expect BULK_MAX_TERMS to evaluate to a number.')
+try:
+    CORPUS_MAX_ARTICLES = int(os.getenv('CORPUS_MAX_ARTICLES', 10000))
+    CORPUS_TIME_BUDGET = float(os.getenv('CORPUS_TIME_BUDGET', 90))
+    CORPUS_BATCH_SIZE = int(os.getenv('CORPUS_BATCH_SIZE', 100))
+    CORPUS_TOP_K = int(os.getenv('CORPUS_TOP_K', 1000))
+    CORPUS_MAX_SOURCES = int(os.getenv('CORPUS_MAX_SOURCES', 100))
+    logger.info(f'CORPUS_MAX_ARTICLES={CORPUS_MAX_ARTICLES}, CORPUS_TIME_BUDGET={CORPUS_TIME_BUDGET}, '
+                f'CORPUS_BATCH_SIZE={CORPUS_BATCH_SIZE}, CORPUS_TOP_K={CORPUS_TOP_K}, '
+                f'CORPUS_MAX_SOURCES={CORPUS_MAX_SOURCES}')
+except ValueError:
+    raise EnvironmentError('Expect CORPUS_MAX_ARTICLES, CORPUS_TIME_BUDGET, CORPUS_BATCH_SIZE, CORPUS_TOP_K and '
+                           'CORPUS_MAX_SOURCES to evaluate to numbers.')
+if min(CORPUS_BATCH_SIZE, CORPUS_TOP_K) < 1:
+    raise EnvironmentError('Expect CORPUS_BATCH_SIZE and CORPUS_TOP_K to be at least 1.')
+CORPUS_PRIORITY = 1  # MetaMap jobs of regular requests come first, a full corpus query is bulk work, though admitted
+
+query_cache = ResponseCache()
+_single_flight = SingleFlight()
+# terms of a bulk query are fetched here, each fetch fans out to the sources on the pool of libs.literature
+_term_pool = ProcessLocalThreadPool(FETCH_WORKERS, 'term')
+
+
+def search_term(term: str, use_cache: bool = True, priority: int = 0) -> Tuple[Dict, int]:
+    """
+    find the terms of the literature about a term, from the query cache if possible
+    :param term: the term to query, usually a rsID
+    :param use_cache: whether to read from the query cache and the article cache, results are stored either way
+    :param priority: priority of the MetaMap jobs, lower values are served first
+    :return: the response body and status code
+    """
+    # identical requests in flight share one computation
+    key = f'{term}?use_cache={use_cache}&priority={priority}'
+    if use_cache:
+        res = query_cache.get(term)  # try to use cache first
+        if res:  # hit
+            logger.info(f'{term} hits cache.')
+            return {'terms': res}, 200
+        # miss, the result is looked up in cache by followers in other processes
+        logger.info(f'{term} misses cache.')
+        return _single_flight.do(key, lambda: _query(term, use_cache, priority), lookup=lambda: _lookup(term))
+    return _single_flight.do(key, lambda: _query(term, use_cache, priority))
+
+
+def cached_term(term: str) -> Union[PreparedBody, None]:
+    """
+    :param term: the term to look up, usually a rsID
+    :return: the `/term` response body of the term ready to send, if it is cached
+    """
+    body = query_cache.get_response(term)
+    if body is not None:
+        logger.info(f'{term} hits cache.')
+    return body
+
+
+def refresh_term(term: str, priority: int = 0, admit: bool = True) -> Tuple[Dict, int]:
+    """
+    query a term again even if it is cached, so that new literature is taken into account, and cache the result.
+    Articles already processed still come from the article cache.
+    :param term: the term to query, usually a rsID
+    :param priority: priority of the MetaMap jobs, lower values are served first
+    :param admit: whether the MetaMap jobs may be rejected when MetaMap is overloaded, False for background work
+    :return: the response body and status code
+    """
+    key = f'{term}?refresh&priority={priority}&admit={admit}'
+    return _single_flight.do(key, lambda: _query(term, True, priority, admit))
+
+
+def _lookup(term: str) -> Union[Tuple[Dict, int], None]:
+    res = query_cache.get(term)
+    return ({'terms': res}, 200) if res else None
+
+
+def _query(term: str, use_cache: bool, priority: int, admit: bool = True) -> Tuple[Dict, int]:
+    """
+    query OMIM and PubMed for articles about the term and run them through MetaMap
+    :param term: the term to query
+    :param use_cache: whether to read from the article cache, results are stored either way
+    :param priority: priority of the MetaMap jobs
+    :param admit: whether the MetaMap jobs may be rejected when MetaMap is overloaded
+    :return: the response body and status code
+    """
+    pre_fetch = time.time()
+    articles, missed = fetch_articles(term)
+    post_fetch = time.time()
+    logger.info(f'Querying OMIM and Pubmed took {post_fetch - pre_fetch}s.')
+    record_stage('fetch', post_fetch - pre_fetch)
+
+    if len(articles) < 1:
+        return _not_found(term, missed)
+
+    metamapy = MetaMaPY(MAX_PROCESSES, admit)
+    res = metamapy.run(articles, use_cache=use_cache, priority=priority)  # run MetaMap if cache misses
+    return _found(term, res, missed, metamapy.timed_out)
+
+
+def stream_term(term: str, use_cache: bool = True, priority: int = 0) -> Iterable[Dict]:
+    """
+    find the terms of the literature about a term, reporting the terms of each article as soon as it is done.
+    Streams are not shared between identical requests, only the query cache is.
+    :param term: the term to query, usually a rsID
+    :param use_cache: whether to read from the query cache and the article cache, results are stored either way
+    :param priority: priority of the MetaMap jobs, lower values are served first
+    :return: yields the records of `MetaMaPY.stream`, the summary holding the body of a `/term` response. Only a
+    summary is yielded on a query cache hit, and only an `error` record with the `status` of the response if no
+    literature was found.
+    """
+    if use_cache:
+        res = query_cache.get(term)
+        if res:
+            logger.info(f'{term} hits cache.')
+            yield {'type': 'summary', 'terms': res}
+            return
+    pre_fetch = time.time()
+    articles, missed = fetch_articles(term)
+    logger.info(f'Querying OMIM and Pubmed took {time.time() - pre_fetch}s.')
+    record_stage('fetch', time.time() - pre_fetch)
+    if len(articles) < 1:
+        body, status = _not_found(term, missed)
+        yield dict(body, type='error', status=status)
+        return
+
+    metamapy = MetaMaPY(MAX_PROCESSES)
+    for record in metamapy.stream(articles, use_cache=use_cache, priority=priority):
+        if record['type'] == 'summary':
+            body, _ = _found(term, record['terms'], missed, metamapy.timed_out)
+            record = dict(body, type='summary')
+        yield record
+
+
+def stream_corpus(term: str, max_articles: int = CORPUS_MAX_ARTICLES, time_budget: float = CORPUS_TIME_BUDGET,
+                  use_cache: bool = True) -> Iterable[Dict]:
+    """
+    find the terms of all the PubMed literature about a term rather than of the first PUBMED_RET_MAX articles.
+    PubMed is paged in batches of CORPUS_BATCH_SIZE articles, each going to MetaMap while the next ones are fetched,
+    and only the CORPUS_TOP_K most frequent terms are tracked, so memory does not depend on the number of articles.
+    The query stops after max_articles PubMed articles, or at the first batch boundary past the time budget.
+    Results are not kept in the query cache, the article cache still spares MetaMap the articles seen before.
+    :param term: the term to query, usually a rsID
+    :param max_articles: max number of PubMed articles to process
+    :param time_budget: seconds after which no more batches are processed
+    :param use_cache: whether to read from the article cache, results are stored either way
+    :return: yields a `progress` record with the number of articles `processed` and the `total` to process, OMIM
+    included, after each batch, then a `summary` record holding the body of the response: the `terms` and a `corpus`
+    field with the number of articles PubMed has about the term (`count`), those `processed`, those MetaMap `timed_out`
+    on and whether all were processed (`complete`). Batches that failed to be fetched are skipped, and PubMed is then
+    listed in `missing_sources`. Only an `error` record with the `status` of the response is yielded if no literature
+    was found.
+    """
+    start_time = time.time()
+    deadline = start_time + time_budget
+    omim = _term_pool.submit(get_omim, term)  # alongside the ESearch and first EFetch of PubMed
+    batches = iter_pubmed(term, CORPUS_BATCH_SIZE, max_articles)
+    metamapy = MetaMaPY(MAX_PROCESSES)
+    aggregator = TopKTermAggregator(CORPUS_TOP_K, CORPUS_MAX_SOURCES)
+    count = processed = timed_out = unfetched = 0
+    missed = []
+    complete = True
+    try:
+        try:
+            first = next(batches, None)
+        except RequestException as e:
+            logger.error(f'pubmed failed for {term}. {e}')
+            first = None
+            missed.append('pubmed')
+        try:
+            article = omim.result(timeout=max(0.0, start_time + FETCH_DEADLINE - time.time()))
+        except TimeoutError:
+            logger.error(f'omim missed the deadline of {FETCH_DEADLINE}s for {term}.')
+            article = None
+            missed.append('omim')
+        except Exception:
+            logger.error(f'omim failed for {term}.')
+            logger.error(traceback.format_exc())
+            article = None
+            missed.append('omim')
+        record_stage('fetch', time.time() - start_time)
+        if first is not None:
+            count = first[0]
+        if not article and not count:
+            body, status = _not_found(term, missed)
+            yield dict(body, type='error', status=status)
+            return
+        total = min(count, max_articles) + (1 if article else 0)
+
+        articles = [article] if article else []  # the OMIM article goes with the first PubMed batch
+        for _, size, batch in itertools.chain([first] if first else [], batches):
+            if processed and time.time() >= deadline:
+                logger.info(f'time budget of {time_budget}s spent for {term} after {processed} articles.')
+                complete = False
+                break
+            if batch is None:  # failed to be fetched, its articles are left out
+                unfetched += size
+                continue
+            articles += batch
+            timed_out += _annotate_corpus(metamapy, articles, aggregator, use_cache)
+            metamapy.admit = False  # the query has been admitted with its first batch, the next ones wait for a slot
+            processed += len(articles)
+            articles = []
+            yield {'type': 'progress', 'processed': processed, 'total': total}
+        if articles:  # no PubMed batch came with the OMIM article
+            timed_out += _annotate_corpus(metamapy, articles, aggregator, use_cache)
+            processed += len(articles)
+            yield {'type': 'progress', 'processed': processed, 'total': total}
+    finally:
+        batches.close()  # stop fetching ahead
+
+    if unfetched:
+        logger.error(f'{unfetched} PubMed articles of {term} failed to be fetched.')
+        missed.append('pubmed')
+    terms = aggregator.terms()
+    logger.info(f'{len(terms)} terms found for {processed} articles of {term} in {time.time() - start_time}s.')
+    record_stage('total', time.time() - start_time)
+    REQUEST_ARTICLES.observe(processed)
+    REQUEST_TERMS.observe(len(terms))
+    summary = {'type': 'summary', 'terms': terms,
+               'corpus': {'count': count, 'processed': processed, 'timed_out': timed_out,
+                          'complete': complete and not missed and count <= max_articles}}
+    if missed:
+        summary['missing_sources'] = missed
+    yield summary
+
+
+def _annotate_corpus(metamapy: MetaMaPY, articles: List[Dict], aggregator: TopKTermAggregator,
+                     use_cache: bool) -> int:
+    """
+    run MetaMap on a batch of articles of a full corpus query and aggregate the terms found
+    :return: the number of articles MetaMap timed out on
+    """
+    timed_out = 0
+    for i, entries in metamapy.annotate(articles, use_cache, CORPUS_PRIORITY):
+        if entries is None:
+            timed_out += 1
+        else:
+            aggregator.add(articles[i]['source'], articles[i]['id'], entries)
+    return timed_out
+
+
+def search_corpus(term: str, max_articles: int = CORPUS_MAX_ARTICLES, time_budget: float = CORPUS_TIME_BUDGET,
+                  use_cache: bool = True) -> Tuple[Dict, int]:
+    """
+    find the terms of all the PubMed literature about a term, see stream_corpus
+    :return: the response body and status code
+    """
+    for record in stream_corpus(term, max_articles, time_budget, use_cache):
+        if record['type'] in ('summary', 'error'):
+            status = record.pop('status', 200)
+            record.pop('type')
+            return record, status
+
+
+def _not_found(term: str, missed: List[str]) -> Tuple[Dict, int]:
+    if missed:
+        return {'message': f'No literature found for {term}', 'missing_sources': missed}, 504
+    return {'message': f'No literature found for {term}'}, 404
+
+
+def _found(term: str, res: List[Dict], missed: List[str], timed_out: List[Dict] = None) -> Tuple[Dict, int]:
+    if missed or timed_out:  # partial result, do not cache it so that the next query tries the missing parts again
+        body = {'terms': res}
+        if missed:
+            body['missing_sources'] = missed
+        if timed_out:
+            body['timed_out'] = timed_out
+        return body, 200
+    query_cache.memorize(term, res)
+    return {'terms': res}, 200
+
+
+def search_terms(terms: List[str], use_cache: bool = True, priority: int = 0,
+                 admit: bool = True) -> Dict[str, Tuple[Dict, int]]:
+    """
+    find the terms of the literature about each of many terms. The literature of all terms is fetched concurrently,
+    and articles found for several terms go through MetaMap only once.
+    :param terms: the terms to query, usually rsIDs
+    :param use_cache: whether to read from the query cache and the article cache, results are stored either way
+    :param priority: priority of the MetaMap jobs, lower values are served first
+    :param admit: whether the MetaMap jobs may be rejected when MetaMap is overloaded, False for background work
+    :return: the response body and status code of each term
+    """
+    res = {}
+    if use_cache:
+        for term in terms:
+            cached = _lookup(term)
+            if cached:
+                res[term] = cached
+        logger.info(f'{len(res)} of {len(terms)} terms hit cache.')
+    misses = [term for term in dict.fromkeys(terms) if term not in res]
+    if not misses:
+        return res
+
+    # step 1: fetch the articles of all terms concurrently, keeping one copy of each article
+    pre_fetch = time.time()
+    futures = {term: _term_pool.submit(fetch_articles, term) for term in misses}
+    unique = {}  # (source, id) -> article
+    found = {}  # term -> (keys of its articles, missing sources)
+    for term, future in futures.items():
+        articles, missed = future.result()
+        keys = []
+        for article in articles:
+            key = (article['source'], article['id'])
+            unique.setdefault(key, article)
+            keys.append(key)
+        found[term] = (keys, missed)
+    logger.info(f'Querying OMIM and Pubmed for {len(misses)} terms took {time.time() - pre_fetch}s, '
+                f'{len(unique)} unique articles found.')
+    record_stage('fetch', time.time() - pre_fetch)
+
+    # step 2: run MetaMap once per unique article
+    keys = list(unique)
+    metamapy = MetaMaPY(MAX_PROCESSES, admit)
+    entries = {keys[i]: each for i, each in metamapy.annotate([unique[key] for key in keys], use_cache, priority)}
+
+    # step 3: aggregate the entries of the articles of each term
+    for term, (term_keys, missed) in found.items():
+        if not term_keys:
+            res[term] = _not_found(term, missed)
+            continue
+        aggregator = TermAggregator()
+        timed_out = []
+        for key in dict.fromkeys(term_keys):
+            if entries[key] is None:
+                timed_out.append({'source': key[0], 'id': key[1]})
+            else:
+                aggregator.add(key[0], key[1], entries[key])
+        res[term] = _found(term, aggregator.terms(), missed, timed_out)
+    return res
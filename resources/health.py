@@ -0,0 +1,9 @@
+from flask_restful import Resource
+from libs.tagger import tagger_supervisor
+
+
+class Health(Resource):
+    @classmethod
+    def get(cls):
+        health = tagger_supervisor.health()
+        return health, 200 if health['ready'] else 503
@@ -0,0 +1,52 @@
+import traceback
+from flask_restful import Resource, inputs, reqparse
+from libs.jobs import job_queue
+from utils.logger import logger
+
+ERROR_MISSING_ARGS = 'missing argument `{}` in request body.'
+ERROR_JOB_INPUT = 'expect either `articles` or `terms` in request body.'
+
+
+class JobList(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('articles', type=dict, action='append')
+    parser.add_argument('terms', type=str, action='append')
+    parser.add_argument('use_cache', type=inputs.boolean)
+    parser.add_argument('priority', type=inputs.natural)  # negative values would compete with interactive requests
+
+    nested_parser = reqparse.RequestParser()
+    nested_parser.add_argument('source', type=str, required=True, location='articles',
+                               help=ERROR_MISSING_ARGS.format('source'))
+    nested_parser.add_argument('id', type=str, required=True, location='articles', help=ERROR_MISSING_ARGS.format('id'))
+    nested_parser.add_argument('text', type=str, required=True, location='articles',
+                               help=ERROR_MISSING_ARGS.format('text'))
+
+    @classmethod
+    def post(cls):
+        data = cls.parser.parse_args(strict=True)
+        articles, terms = data['articles'], data['terms']
+        if (articles is None) == (terms is None):
+            return {'message': ERROR_JOB_INPUT}, 400
+        priority = data['priority'] or 0
+        try:
+            if articles is not None:
+                job_id = job_queue.enqueue('articles', {'articles': articles}, len(articles), priority)
+            else:
+                use_cache = True if data['use_cache'] is None else data['use_cache']  # default to use cache
+                job_id = job_queue.enqueue('terms', {'terms': terms, 'use_cache': use_cache}, len(terms), priority)
+        except:
+            logger.error(f'Error occurs while enqueuing a job.')
+            logger.error(traceback.format_exc())
+            return {'message': f'An error has occurred, please contact developer.'}, 500
+        logger.debug(f'Job {job_id} enqueued.')
+        return {'id': job_id, 'status': 'queued'}, 202, {'Location': f'/jobs/{job_id}'}
+
+
+class Job(Resource):
+
+    @classmethod
+    def get(cls, job_id: str):
+        job = job_queue.get(job_id)
+        if job is None:
+            return {'message': f'Job {job_id} not found, it may have expired.'}, 404
+        return job, 200
@@ -0,0 +1,9 @@
+from flask import Response
+from flask_restful import Resource
+from utils.metrics import registry
+
+
+class Metrics(Resource):
+    @classmethod
+    def get(cls):
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
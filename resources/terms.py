@@ -1,18 +1,85 @@
-import os
-import time
 import traceback
-from concurrent.futures.process import ProcessPoolExecutor
-from flask_restful import Resource, reqparse
-from libs.omim import get_omim
-from libs.pubmed import get_pubmed
-from libs.metamapy import MetaMaPY
-from utils.query_cache import QueryCache
+from typing import Dict, Iterable
+from flask import Response, request
+from flask_restful import Resource, inputs, reqparse
+from libs.metamapy import MetaMaPY, MAX_PROCESSES
+from libs.metamap_slots import OverloadedError
+from libs.tagger import TaggerUnavailableError, TAGGER_CHECK_INTERVAL
+from libs.term_search import cached_term, search_term, search_terms, stream_term, search_corpus, stream_corpus, \
+    BULK_MAX_TERMS, CORPUS_MAX_ARTICLES, CORPUS_TIME_BUDGET
+from utils import fast_json
 from utils.logger import logger
+from utils.response_cache import PreparedBody
 
 ERROR_MISSING_ARGS = 'missing argument `{}` in request body.'
-MAX_PROCESSES = int(os.getenv('MAX_PROCESSES', 1))
-logger.info(f'MAX_PROCESSES={MAX_PROCESSES}')
-_cache = QueryCache()
+NDJSON = 'application/x-ndjson'
+
+
+def overloaded(e: OverloadedError):
+    return {'message': str(e)}, 429, {'Retry-After': str(e.retry_after)}
+
+
+def unavailable(e: TaggerUnavailableError):
+    return {'message': str(e)}, 503, {'Retry-After': str(max(1, int(TAGGER_CHECK_INTERVAL)))}
+
+
+def wants_stream() -> bool:
+    """
+    :return: whether the client asked for a stream of NDJSON records rather than a single JSON document
+    """
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def prepared(body: PreparedBody) -> Response:
+    """
+    respond with a body serialized and compressed ahead of time, in the encoding the client prefers among those
+    available. A GET request whose `If-None-Match` holds the ETag of the body gets an empty 304 response instead.
+    """
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(body.etag):
+        response = Response(status=304)
+    else:
+        encoding = request.accept_encodings.best_match(body.encodings) or 'identity'
+        response = Response(body.encoded(encoding), mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    # the same tag for every encoding of the body, hence weak
+    response.set_etag(body.etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def stream(records: Iterable[Dict]):
+    """
+    respond with one JSON record per line, sent as soon as it is ready.
+    The first record is computed before responding, so that early errors still get their status code. Errors raised
+    later end the stream with an `error` record holding the `message` and the `status` the response would have had.
+    :param records: the records to send, an `error` record with a `status` first is sent as an error response
+    """
+    records = iter(records)
+    first = next(records)
+    if first['type'] == 'error':
+        status = first.pop('status', 500)
+        first.pop('type')
+        return first, status
+
+    def generate():
+        yield fast_json.dumps(first) + b'\n'
+        try:
+            for record in records:
+                yield fast_json.dumps(record) + b'\n'
+        except OverloadedError as e:
+            yield fast_json.dumps({'type': 'error', 'message': str(e), 'status': 429,
+                                   'retry_after': e.retry_after}) + b'\n'
+        except TaggerUnavailableError as e:
+            yield fast_json.dumps({'type': 'error', 'message': str(e), 'status': 503}) + b'\n'
+        except Exception:
+            logger.error(f'Error occurs while streaming a response.')
+            logger.error(traceback.format_exc())
+            yield fast_json.dumps({'type': 'error', 'message': 'An error has occurred, please contact developer.',
+                                   'status': 500}) + b'\n'
+
+    # tell Nginx not to buffer the stream
+    return Response(generate(), mimetype=NDJSON, headers={'X-Accel-Buffering': 'no'})
 
 
 class Article(Resource):
@@ -34,8 +101,16 @@ class Article(Resource):
         logger.debug(f'request received for {len(article_list)} articles.')
         try:
             metamapy = MetaMaPY(MAX_PROCESSES)
+            if wants_stream():
+                return stream(metamapy.stream(article_list))
             res = metamapy.run(article_list)  # run MetaMap
+            if metamapy.timed_out:
+                return {'terms': res, 'timed_out': metamapy.timed_out}, 200
             return {'terms': res}, 200
+        except OverloadedError as e:
+            return overloaded(e)
+        except TaggerUnavailableError as e:
+            return unavailable(e)
         except:
             logger.error(f'Error occurs while responding request for articles.')
             logger.error(traceback.format_exc())
@@ -44,7 +119,11 @@ class Article(Resource):
 
 class Term(Resource):
     parser = reqparse.RequestParser()
-    parser.add_argument('use_cache', type=bool)
+    parser.add_argument('use_cache', type=inputs.boolean)  # also parsed from the query string of GET
+    parser.add_argument('corpus', choices=('sample', 'full'), default='sample',
+                        help='Expect `corpus` to be `sample` or `full`.')
+    parser.add_argument('max_articles', type=inputs.positive, default=CORPUS_MAX_ARTICLES)
+    parser.add_argument('time_budget', type=float, default=CORPUS_TIME_BUDGET)
 
     def post(self, term: str):
         data = self.parser.parse_args()
@@ -54,34 +133,57 @@ class Term(Resource):
         logger.debug(f'Request received for {term}.')
         logger.debug(f'use_cache={use_cache}.')
         try:
-            if use_cache:
-                res = _cache.get(term)  # try to use cache first
-                if res:  # hit
-                    logger.info(f'{term} hits cache.')
-                    return {'terms': res}, 200
-                # miss
-                logger.info(f'{term} misses cache.')
-
-            pre_fetch = time.time()
-            with ProcessPoolExecutor(max_workers=2) as pool:
-                future_omim = pool.submit(get_omim, term)
-                future_pubmed = pool.submit(get_pubmed, term)
-            post_fetch = time.time()
-            logger.info(f'Querying OMIM and Pubmed took {post_fetch - pre_fetch}s.')
-            pubmed_result = future_pubmed.result()
-            omim_result = future_omim.result()
-
-            articles = pubmed_result if pubmed_result else []
-            if omim_result:
-                articles.append(omim_result)
-
-            metamapy = MetaMaPY(MAX_PROCESSES)
-            res = metamapy.run(articles)  # run MetaMap if cache misses
-            if len(articles) < 1:
-                return {'message': f'No literature found for {term}'}, 404
-            _cache.memorize(term, res)
-            return {'terms': res}, 200
+            if data['corpus'] == 'full':
+                if data['time_budget'] <= 0:
+                    return {'message': 'Expect `time_budget` to be a positive number of seconds.'}, 400
+                max_articles = min(data['max_articles'], CORPUS_MAX_ARTICLES)
+                time_budget = min(data['time_budget'], CORPUS_TIME_BUDGET)
+                if wants_stream():
+                    return stream(stream_corpus(term, max_articles, time_budget, use_cache=use_cache))
+                return search_corpus(term, max_articles, time_budget, use_cache=use_cache)
+            if wants_stream():
+                return stream(stream_term(term, use_cache=use_cache))
+            body = cached_term(term) if use_cache else None
+            if body is not None:  # sent as is, without going through JSON encoding again
+                return prepared(body)
+            return search_term(term, use_cache=use_cache)
+        except OverloadedError as e:
+            return overloaded(e)
+        except TaggerUnavailableError as e:
+            return unavailable(e)
         except:
             logger.error(f'Error occurs while responding request for {term}.')
             logger.error(traceback.format_exc())
             return {'message': f'An error has occurred while querying MetaMaPY for {term}'}, 500
+
+    def get(self, term: str):
+        # same as POST, with use_cache in the query string, and cacheable by clients with If-None-Match
+        return self.post(term)
+
+
+class TermList(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('terms', type=str, action='append', required=True, help=ERROR_MISSING_ARGS.format('terms'))
+    parser.add_argument('use_cache', type=inputs.boolean)
+
+    @classmethod
+    def post(cls):
+        data = cls.parser.parse_args(strict=True)
+        terms = data['terms']
+        use_cache = data['use_cache']
+        if use_cache is None:
+            use_cache = True  # default to use cache
+        if len(terms) > BULK_MAX_TERMS:
+            return {'message': f'Expect at most {BULK_MAX_TERMS} terms, submit larger batches to `/jobs`.'}, 400
+        logger.debug(f'Request received for {len(terms)} terms.')
+        try:
+            results = search_terms(terms, use_cache=use_cache)
+            return {'results': {term: dict(body, status=status) for term, (body, status) in results.items()}}, 200
+        except OverloadedError as e:
+            return overloaded(e)
+        except TaggerUnavailableError as e:
+            return unavailable(e)
+        except:
+            logger.error(f'Error occurs while responding request for {len(terms)} terms.')
+            logger.error(traceback.format_exc())
+            return {'message': f'An error has occurred while querying MetaMaPY for {len(terms)} terms'}, 500
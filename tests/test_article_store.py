@@ -0,0 +1,57 @@
+"""
+The article store filled offline from a fixture directory of the benchmarks, serving PubMed and OMIM lookups without
+any request but ESearch.
+
+    python -m pytest tests
+"""
+import os
+
+import pytest
+
+os.environ.setdefault('OMIM_KEY', 'test')
+os.environ.setdefault('PUBMED_KEY', 'test')
+
+import requests  # noqa: E402
+from bench.fixtures import Fixtures, generate  # noqa: E402
+from libs import omim, pubmed  # noqa: E402
+from libs.article_store import ArticleStore  # noqa: E402
+
+
+@pytest.fixture
+def fixtures(tmp_path):
+    directory = str(tmp_path / 'fixtures')
+    generate(directory, terms=12, median_articles=5, omim_ratio=0.5)
+    return directory
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    def send(*args, **kwargs):
+        raise AssertionError('network is disabled')
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+
+
+def test_serve_from_directory(monkeypatch, tmp_path, fixtures, offline):
+    store = ArticleStore(str(tmp_path / 'articles.sqlite3'))
+    assert store.load_directory(fixtures) > 0
+    monkeypatch.setattr(pubmed, 'article_store', store)
+    monkeypatch.setattr(omim, 'article_store', store)
+    term_ids = Fixtures(fixtures).term_ids
+    # ESearch results are not stored, they come from the fixtures as the fixture server would answer them
+    monkeypatch.setattr(pubmed, '_search_pubmed', lambda term: {
+        'count': len(term_ids[term]), 'query_key': '1', 'web_env': term, 'ids': term_ids[term][:pubmed.PUBMED_RET_MAX],
+    })
+
+    variants = 0
+    for term, ids in term_ids.items():
+        articles = pubmed.get_pubmed(term)
+        if ids:
+            assert [article['id'] for article in articles] == ids[:pubmed.PUBMED_RET_MAX]
+            assert all(article['source'] == 'pubmed' and article['text'] for article in articles)
+        variant = omim.get_omim(term)
+        if variant is not None:
+            variants += 1
+            assert variant['source'] == 'omim' and variant['text']
+            assert '#' in variant['id']
+    assert 0 < variants < len(term_ids)
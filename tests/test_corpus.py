@@ -0,0 +1,115 @@
+"""
+Full corpus queries against the fixture server and the fake MetaMap of the benchmarks, with an EFetch batch failing
+halfway through its body.
+
+    python -m pytest tests
+"""
+import os
+import subprocess
+import threading
+
+import pytest
+
+FAKE_METAMAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'fake_metamap')
+os.environ.update({
+    'METAMAP_PATH': FAKE_METAMAP,
+    'METAMAP_POOL': 'false',
+    'METAMAP_SLOTS': '0',
+    'METAMAP_SENTENCE_CACHE': 'false',
+    'TAGGER_PORT': '18795',
+    'FAKE_TAGGER_PORT': '18795',
+    'FAKE_METAMAP_STARTUP': '0',
+    'FAKE_METAMAP_LATENCY': '0',
+    'FAKE_METAMAP_LATENCY_PER_KB': '0',
+})
+os.environ.setdefault('OMIM_KEY', 'test')
+os.environ.setdefault('PUBMED_KEY', 'test')
+os.environ.pop('CACHE_PATH', None)
+
+from urllib3.exceptions import ProtocolError  # noqa: E402
+from bench.fixtures import Fixtures, generate, serve  # noqa: E402
+from libs import omim, pubmed, term_search  # noqa: E402
+from libs.metamap_slots import MetaMapSlots, OverloadedError  # noqa: E402
+from libs.metamapy import MetaMaPY  # noqa: E402
+from libs.tagger import tagger_supervisor  # noqa: E402
+
+BATCH_SIZE = 5
+MAX_ARTICLES = 40
+
+
+@pytest.fixture(scope='module')
+def fixtures(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('fixtures'))
+    generate(directory, terms=5, median_articles=40, omim_ratio=0)
+    server, _ = serve(directory, port=0, latency=0, jitter=0)
+    yield directory, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+@pytest.fixture
+def failing_batch(monkeypatch, fixtures):
+    """
+    :return: the term with the most articles, whose second EFetch batch loses its connection while being read
+    """
+    directory, base_url = fixtures
+    monkeypatch.setattr(pubmed, 'PUBMED_BASE_URL', f'{base_url}/eutils')
+    monkeypatch.setattr(omim, 'OMIM_URL', f'{base_url}/omim/entry/search?search=av_db_snp:{{}}&format=json')
+    parse_efetch = pubmed.parse_efetch
+    calls = []
+    lock = threading.Lock()
+
+    def parse(stream):
+        with lock:
+            calls.append(stream)
+            failing = len(calls) == 2
+        if failing:
+            raise ProtocolError('Connection broken: IncompleteRead')
+        return parse_efetch(stream)
+
+    monkeypatch.setattr(pubmed, 'parse_efetch', parse)
+    term_ids = Fixtures(directory).term_ids
+    return max(term_ids, key=lambda term: len(term_ids[term])), term_ids
+
+
+def test_iter_pubmed_skips_failed_batch(failing_batch):
+    term, term_ids = failing_batch
+    assert len(term_ids[term]) > MAX_ARTICLES
+    batches = list(pubmed.iter_pubmed(term, BATCH_SIZE, MAX_ARTICLES))
+    assert len(batches) == MAX_ARTICLES // BATCH_SIZE
+    assert [batch for _, _, batch in batches].count(None) == 1
+    fetched = [article['id'] for _, _, batch in batches if batch for article in batch]
+    assert len(fetched) == MAX_ARTICLES - BATCH_SIZE
+    assert set(fetched) < set(term_ids[term][:MAX_ARTICLES])
+
+
+def test_corpus_reports_failed_batch(monkeypatch, failing_batch):
+    term, term_ids = failing_batch
+    monkeypatch.setattr(term_search, 'CORPUS_BATCH_SIZE', BATCH_SIZE)
+    assert tagger_supervisor.start_servers()
+    try:
+        body, status = term_search.search_corpus(term, max_articles=MAX_ARTICLES)
+    finally:
+        subprocess.run([os.path.join(FAKE_METAMAP, 'skrmedpostctl'), 'stop'], stdout=subprocess.DEVNULL)
+    assert status == 200
+    assert body['terms']
+    assert body['missing_sources'] == ['pubmed']
+    corpus = body['corpus']
+    assert corpus['count'] == len(term_ids[term])
+    assert corpus['processed'] == MAX_ARTICLES - BATCH_SIZE
+    assert not corpus['complete']
+
+
+class Overloaded(MetaMapSlots):
+    def counts(self):
+        return 100, 1  # jobs waiting and holding a slot
+
+
+def test_corpus_admitted_like_requests(monkeypatch, tmp_path, failing_batch):
+    term, _ = failing_batch
+    monkeypatch.setattr(MetaMaPY, '_slots', Overloaded(str(tmp_path / 'slots.sqlite3'), 1, 8))
+    assert tagger_supervisor.start_servers()
+    try:
+        with pytest.raises(OverloadedError):
+            term_search.search_corpus(term, max_articles=MAX_ARTICLES)
+    finally:
+        subprocess.run([os.path.join(FAKE_METAMAP, 'skrmedpostctl'), 'stop'], stdout=subprocess.DEVNULL)
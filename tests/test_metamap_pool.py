@@ -0,0 +1,145 @@
+"""
+The persistent MetaMap pool against the fake MetaMap of the benchmarks: EOT framing, restart of dead or hung processes
+and priority of citations.
+
+    python -m pytest tests
+"""
+import os
+import threading
+import time
+
+import pytest
+
+FAKE_METAMAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'fake_metamap')
+os.environ.update({
+    'METAMAP_PATH': FAKE_METAMAP,
+    'METAMAP_POOL': 'false',  # enabled by the tests that need it
+    'METAMAP_SLOTS': '0',
+    'METAMAP_SENTENCE_CACHE': 'false',
+    'TAGGER_PORT': '18795',
+    'FAKE_TAGGER_PORT': '18795',
+    'FAKE_METAMAP_STARTUP': '0',
+    'FAKE_METAMAP_LATENCY': '0',
+    'FAKE_METAMAP_LATENCY_PER_KB': '0',
+})
+
+from libs.metamap_pool import MetaMapPool, MetaMapTimeout  # noqa: E402
+from libs.metamapy import MetaMaPY  # noqa: E402
+
+COMMAND = [os.path.join(FAKE_METAMAP, 'metamap'), '-E', '-I', '-p', '-K', '-8', '--silent', '--conj']
+
+
+@pytest.fixture
+def make_pool(monkeypatch):
+    """
+    :return: a function starting a pool of fake MetaMap processes, which sleep for `latency_per_kb` seconds on each
+    KB of text. Pools are shut down after the test.
+    """
+    monkeypatch.setenv('FAKE_METAMAP_BUSY', 'false')
+    pools = []
+
+    def make(size: int = 1, latency_per_kb: float = 0, check_interval: float = 5) -> MetaMapPool:
+        monkeypatch.setenv('FAKE_METAMAP_LATENCY_PER_KB', str(latency_per_kb))
+        pools.append(MetaMapPool(COMMAND, size, check_interval=check_interval))
+        return pools[-1]
+
+    yield make
+    for pool in pools:
+        pool.shutdown()
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_eot_framing(make_pool):
+    pool = make_pool()
+    lines = pool.submit('Hypertension elevates cardiovascular morbidity.\n\nPatients received metformin.\n\n',
+                        citations=2).result(timeout=10)
+    assert [line for line in lines if line.startswith('Processing')] == [
+        'Processing 00000000.tx.1: Hypertension elevates cardiovascular morbidity.\n',
+        'Processing 00000000.tx.1: Patients received metformin.\n',
+    ]
+    assert not any('EOT' in line for line in lines)
+    # the next citation only gets its own output
+    lines = pool.submit('Glucose tolerance improved.\n\n').result(timeout=10)
+    assert [line for line in lines if line.startswith('Processing')] == [
+        'Processing 00000000.tx.1: Glucose tolerance improved.\n',
+    ]
+
+
+def test_restart_dead_worker(make_pool):
+    pool = make_pool(check_interval=0.1)
+    worker = pool._workers[0]
+    process = worker._process
+    process.kill()
+    process.wait()
+    assert wait_for(lambda: worker._process is not process and worker.alive())
+    assert pool.submit('Hypertension elevates cardiovascular morbidity.\n\n').result(timeout=10)
+
+
+def test_timeout_kills_and_restarts(make_pool):
+    pool = make_pool(latency_per_kb=20)
+    worker = pool._workers[0]
+    process = worker._process
+    with pytest.raises(MetaMapTimeout):
+        pool.submit('Hypertension elevates cardiovascular morbidity. ' * 100 + '\n\n', timeout=0.5).result(timeout=10)
+    assert wait_for(lambda: process.poll() is not None)  # killed, not left hanging
+    lines = pool.submit('Short.\n\n').result(timeout=10)
+    assert [line for line in lines if line.startswith('Processing')] == ['Processing 00000000.tx.1: Short.\n']
+    assert worker._process is not process
+
+
+def test_priority_order(make_pool):
+    pool = make_pool(latency_per_kb=1)
+    first = pool.submit('Hypertension elevates cardiovascular morbidity. ' * 10 + '\n\n')  # about 0.5s
+    assert wait_for(lambda: pool.pending() == 0)  # the worker is busy with the first citation
+    order = []
+    lock = threading.Lock()
+
+    def record(name):
+        def done(_):
+            with lock:
+                order.append(name)
+        return done
+
+    futures = []
+    for name, priority in [('background-1', 1), ('background-2', 1), ('interactive', 0)]:
+        futures.append(pool.submit('Short.\n\n', priority=priority))
+        futures[-1].add_done_callback(record(name))
+    first.result(timeout=10)
+    for future in futures:
+        future.result(timeout=10)
+    assert order == ['interactive', 'background-1', 'background-2']
+
+
+def test_blank_texts_skip_metamap(monkeypatch):
+    monkeypatch.setattr(MetaMaPY, '_METAMAP_POOL', True)
+    monkeypatch.setattr(MetaMaPY, '_METAMAP_TIMEOUT', 5)  # a blank citation would time out instead of hanging
+    monkeypatch.setattr(MetaMaPY, '_slots', None)
+    monkeypatch.setattr(MetaMaPY, '_pool', None)
+    try:
+        outputs = {}
+        for output in MetaMaPY(1)._map_jobs(['', ' \n\n ', 'Hypertension elevates cardiovascular morbidity.']):
+            outputs.update(output)
+    finally:
+        if MetaMaPY._pool is not None:
+            MetaMaPY._pool.shutdown()
+    assert outputs[0] == [] and outputs[1] == []
+    assert MetaMaPY._parse_output(outputs[2])
+
+
+def test_pool_input_keeps_positions(monkeypatch):
+    monkeypatch.setattr(MetaMaPY, '_METAMAP_BATCH_SIZE', 1)
+    text = '\n  \nHypertension elevates\n\n\ncardiovascular morbidity.\r\n \t\nPatients received metformin.\n\n'
+    payload = MetaMaPY._format_job([text], [0], interactive=True)
+    assert payload.endswith('\n\n')
+    citation = payload[:-2]
+    assert all(line.strip() for line in citation.split('\n'))  # a single citation
+    assert [m.span() for m in MetaMaPY._NON_SPACE.finditer(citation)] == \
+        [m.span() for m in MetaMaPY._NON_SPACE.finditer(text)]
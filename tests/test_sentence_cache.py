@@ -0,0 +1,72 @@
+"""
+Sentence-cache results must match whole-text results. Runs MetaMaPY against the fake MetaMap of the benchmarks, with
+one-off MetaMap processes so that the output format can be switched between runs.
+
+    python -m pytest tests
+"""
+import os
+import random
+import subprocess
+
+import pytest
+
+FAKE_METAMAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'fake_metamap')
+os.environ.update({
+    'METAMAP_PATH': FAKE_METAMAP,
+    'METAMAP_POOL': 'false',
+    'METAMAP_SLOTS': '0',
+    'METAMAP_SENTENCE_CACHE': 'false',
+    'TAGGER_PORT': '18795',
+    'FAKE_TAGGER_PORT': '18795',
+    'FAKE_METAMAP_STARTUP': '0',
+    'FAKE_METAMAP_LATENCY': '0',
+    'FAKE_METAMAP_LATENCY_PER_KB': '0',
+})
+os.environ.pop('CACHE_PATH', None)  # in-memory caches, fresh for each test
+
+from bench.fixtures import sample_sentences, sample_text  # noqa: E402
+from libs.metamapy import MetaMaPY  # noqa: E402
+from libs.tagger import tagger_supervisor  # noqa: E402
+from utils.article_cache import ArticleCache  # noqa: E402
+from utils.sentence_cache import SentenceCache  # noqa: E402
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tagger():
+    assert tagger_supervisor.start_servers()
+    yield
+    subprocess.run([os.path.join(FAKE_METAMAP, 'skrmedpostctl'), 'stop'], stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def articles():
+    rng = random.Random(0)
+    sentences = sample_sentences()
+    articles = [{'source': 'pubmed', 'id': str(i), 'text': sample_text(rng, sentences, 600)} for i in range(8)]
+    # sentences shared between articles, as boilerplate is in PubMed
+    shared = 'Written informed consent was obtained from all participants. '
+    articles.append({'source': 'pubmed', 'id': '8', 'text': shared + articles[0]['text']})
+    articles.append({'source': 'omim', 'id': '9', 'text': articles[1]['text'] + ' ' + shared})
+    return articles
+
+
+def run(monkeypatch, articles, output: str, sentence_cache: bool):
+    monkeypatch.setattr(MetaMaPY, '_METAMAP_OUTPUT', output)
+    monkeypatch.setattr(MetaMaPY, '_METAMAP_SENTENCE_CACHE', sentence_cache)
+    monkeypatch.setattr(MetaMaPY, '_article_cache', ArticleCache())
+    return MetaMaPY(4).run(articles)
+
+
+@pytest.mark.parametrize('output', ['text', 'xml'])
+def test_sentence_cache_matches_whole_text(monkeypatch, articles, output):
+    monkeypatch.setattr(MetaMaPY, '_sentence_cache', SentenceCache())
+    whole = run(monkeypatch, articles, output, sentence_cache=False)
+    by_sentence = run(monkeypatch, articles, output, sentence_cache=True)
+    from_cache = run(monkeypatch, articles, output, sentence_cache=True)  # all sentences hit the sentence cache
+
+    assert whole
+    if output == 'xml':
+        assert all('positions' in term for term in whole)
+    key = lambda term: term['CUI']  # noqa: E731
+    assert sorted(by_sentence, key=key) == sorted(whole, key=key)
+    assert sorted(from_cache, key=key) == sorted(whole, key=key)
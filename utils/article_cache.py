@@ -0,0 +1,36 @@
+import hashlib
+from typing import List
+from utils.query_cache import QueryCache
+
+
+class ArticleCache(QueryCache):
+    """
+    Cache of parsed MetaMap output per article, keyed by the content of the article and the MetaMap options.
+    Articles retrieved by different queries share the same entry as long as their text is identical.
+    Configured with ARTICLE_CACHE_SIZE (entries), ARTICLE_CACHE_MAX_BYTES and ARTICLE_CACHE_TTL (seconds).
+    """
+    namespace = 'article'
+    env_prefix = 'ARTICLE_CACHE'
+    default_size = 1000
+
+    format_version = 1  # part of every key, bump it whenever the shape of cached entries changes
+
+    @classmethod
+    def make_key(cls, text: str, sem_types: List[str] = None, data_sources: List[str] = None, output: str = 'text',
+                 parse: str = 'whole') -> str:
+        """
+        hash the article text together with the MetaMap options and the parse path that affect the output, so that
+        entries of another shape are never served after a configuration change, even from a persistent cache
+        :param text: the ASCII text sent to MetaMap
+        :param sem_types: the semantic types MetaMap is restricted to
+        :param data_sources: the sources MetaMap is restricted to
+        :param output: the MetaMap output format the entries were parsed from, `text` or `xml`
+        :param parse: how the entries of the text were obtained, e.g. from chunks of a max size or from sentences
+        :return: a hex digest
+        """
+        digest = hashlib.sha256()
+        for part in (str(cls.format_version), text, ','.join(sem_types or []), ','.join(data_sources or []), output,
+                     parse):
+            digest.update(part.encode())
+            digest.update(b'\0')  # separator so that parts cannot run into each other
+        return digest.hexdigest()
@@ -0,0 +1,194 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Union
+from utils.logger import logger
+from utils.sqlite import SQLiteConnections
+
+"""
+Storage backends for the caches. Values are opaque bytes, serialization is up to the caller.
+CACHE_PATH is optional. When set, caches are stored in a SQLite database at that path, which is shared by all processes
+of the app (e.g. uWSGI workers) and survives restarts. Otherwise each process holds its own cache in memory.
+"""
+CACHE_PATH = os.getenv('CACHE_PATH')
+logger.info(f'CACHE_PATH={CACHE_PATH}')
+
+
+class MemoryBackend:
+    """
+    In-process LRU cache with O(1) operations, bounded in both entries and bytes, with expiring entries.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at), head is LRU and tail is MRU
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        if len(value) > self.max_bytes:
+            logger.debug(f'{key} is larger than the cache, skipped.')
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+            self._bytes += len(value)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))  # evict LRU
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1] >= time.time()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def recent_keys(self, limit: int) -> List[str]:
+        with self._lock:
+            return list(itertools.islice(reversed(self._data), limit))
+
+    def _remove(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[0])
+
+
+class SQLiteBackend:
+    """
+    LRU cache stored in a SQLite database shared by all processes, bounded in both entries and bytes, with expiring
+    entries. Entry count and total size are maintained by triggers and eviction walks an index on access time,
+    so no operation scans the table.
+    """
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        );
+        CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at);
+        CREATE TABLE IF NOT EXISTS cache_stats (
+            namespace TEXT PRIMARY KEY,
+            entries INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+            INSERT OR IGNORE INTO cache_stats (namespace) VALUES (NEW.namespace);
+            UPDATE cache_stats SET entries = entries + 1, bytes = bytes + NEW.size WHERE namespace = NEW.namespace;
+        END;
+        CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+            UPDATE cache_stats SET entries = entries - 1, bytes = bytes - OLD.size WHERE namespace = OLD.namespace;
+        END;
+    '''
+
+    def __init__(self, path: str, namespace: str, max_entries: int, max_bytes: int, ttl: float):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._connections = SQLiteConnections(path)
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        connection = self._connect()
+        now = time.time()
+        row = connection.execute('SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?',
+                                 (self.namespace, key)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < now:
+            self.delete(key)
+            return None
+        connection.execute('UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                           (now, self.namespace, key))
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        if len(value) > self.max_bytes:
+            logger.debug(f'{key} is larger than the cache, skipped.')
+            return
+        now = time.time()
+        connection = self._connect()
+        with connection:  # single transaction, so that eviction sees the new totals
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+            connection.execute('INSERT INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                               (self.namespace, key, value, len(value),
+                                now + (self.ttl if ttl is None else ttl), now))
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        """
+        remove LRU entries until the namespace fits in both bounds
+        """
+        while True:
+            entries, size = connection.execute('SELECT entries, bytes FROM cache_stats WHERE namespace = ?',
+                                               (self.namespace,)).fetchone()
+            if entries <= self.max_entries and size <= self.max_bytes:
+                return
+            connection.execute('''DELETE FROM cache WHERE namespace = ? AND key = (
+                                      SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at LIMIT 1)''',
+                               (self.namespace, self.namespace))
+
+    def delete(self, key: str) -> None:
+        self._connect().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+    def __contains__(self, key: str) -> bool:
+        row = self._connect().execute('SELECT 1 FROM cache WHERE namespace = ? AND key = ? AND expires_at >= ?',
+                                      (self.namespace, key, time.time())).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        row = self._connect().execute('SELECT entries FROM cache_stats WHERE namespace = ?',
+                                      (self.namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def recent_keys(self, limit: int) -> List[str]:
+        rows = self._connect().execute('SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT ?',
+                                       (self.namespace, limit))
+        return [key for key, in rows]
+
+
+def get_backend(namespace: str, max_entries: int, max_bytes: int, ttl: float) -> Union[MemoryBackend, SQLiteBackend]:
+    """
+    create a cache backend according to CACHE_PATH
+    :param namespace: name of the cache, caches sharing the database are isolated by namespace
+    :param max_entries: max number of entries
+    :param max_bytes: max total size of the values in bytes
+    :param ttl: default time to live of an entry in seconds
+    :return: a SQLiteBackend if CACHE_PATH is set, a MemoryBackend otherwise
+    """
+    if CACHE_PATH:
+        logger.info(f'{namespace} cache stored in {CACHE_PATH}')
+        return SQLiteBackend(CACHE_PATH, namespace, max_entries, max_bytes, ttl)
+    return MemoryBackend(max_entries, max_bytes, ttl)
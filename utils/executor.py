@@ -0,0 +1,28 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ProcessLocalThreadPool:
+    """
+    A ThreadPoolExecutor created on first use in each process. Threads do not survive a fork, so an executor
+    created before uWSGI forks its workers must not be reused by them.
+    """
+
+    def __init__(self, max_workers: int, name: str):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
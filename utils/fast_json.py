@@ -0,0 +1,31 @@
+import json
+from typing import Any, Union
+
+"""
+JSON encoding of responses and cache entries. orjson is used when it is installed, as it encodes and decodes several
+times faster than the json module. Both produce compact UTF-8 JSON, so either can read what the other wrote.
+"""
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    :param obj: the object to encode
+    :return: compact UTF-8 JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    :param data: JSON text
+    :return: the decoded object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
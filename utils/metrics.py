@@ -0,0 +1,363 @@
+import fcntl
+import glob
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from utils.logger import logger
+from utils.process import pid_alive
+
+"""
+Read from env for METRICS_DIR, METRICS_FLUSH_INTERVAL and SERVER_TIMING
+METRICS_DIR is optional, defines a directory where each app process writes its metrics, so that `/metrics` reports
+the sum over all uWSGI processes. Without it, `/metrics` only reports the metrics of the process serving it.
+METRICS_FLUSH_INTERVAL is optional, defines how often each process writes its metrics, defaults to 5s
+SERVER_TIMING is optional, set it to `true` to report the duration of each stage of a request in a `Server-Timing`
+response header
+"""
+METRICS_DIR = os.getenv('METRICS_DIR')
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+try:
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+except ValueError:
+    raise EnvironmentError('Expect METRICS_FLUSH_INTERVAL to evaluate to a number.')
+logger.info(f'METRICS_DIR={METRICS_DIR}, METRICS_FLUSH_INTERVAL={METRICS_FLUSH_INTERVAL}')
+logger.info(f'SERVER_TIMING={SERVER_TIMING}')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, math.inf)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, math.inf)
+
+
+class Metric:
+    """
+    A metric with labels, in the Prometheus data model. Values are kept by tuple of label values.
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self) -> List:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        """
+        set the total, for counters maintained elsewhere and collected on flush
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Gauges of processes that are gone are dropped, and the gauges of the processes
+    alive are summed, unless `machine_wide` is set, in which case the value of the reporting process is used.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), machine_wide: bool = False):
+        super().__init__(name, documentation, labels)
+        self.machine_wide = machine_wide
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0, 0)
+            counts = list(counts)  # snapshots hold the previous list
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+
+class Registry:
+    """
+    The metrics of the app. Each process writes its metrics to METRICS_DIR in the background, and the process serving
+    a scrape sums the metrics of all processes.
+    """
+
+    def __init__(self, directory: str = None, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._pid = None
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = (), machine_wide: bool = False) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, machine_wide))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """
+        :param collector: called before the metrics are written or reported, to update metrics read from elsewhere
+        """
+        self._collectors.append(collector)
+
+    def _collect(self) -> Dict:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f'failed to collect metrics. {e}')
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def ensure_started(self) -> None:
+        """
+        start writing the metrics of this process in the background, once per process since threads do not survive
+        uWSGI forking its workers
+        """
+        if not self.directory:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for metric in self._metrics.values():
+                metric.reset()  # values recorded before a fork belong to the parent process
+            threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f'failed to write metrics. {e}')
+
+    def flush(self) -> None:
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(self._collect(), file)
+        os.replace(f'{path}.tmp', path)  # readers never see a partial file
+
+    def _snapshots(self) -> List[Tuple[str, Dict]]:
+        """
+        :return: the state of each process, `current`, `alive` or `dead`, and its metrics. The metrics of all
+        processes that are gone come as a single dead one.
+        """
+        res = [('current', self._collect())]
+        if not self.directory:
+            return res
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # a scrape served by another process may be folding files
+            try:
+                res.append(('dead', self._fold_dead()))
+                for path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+                    pid = int(os.path.splitext(os.path.basename(path))[0])
+                    if pid == os.getpid():
+                        continue
+                    try:
+                        with open(path) as file:
+                            res.append(('alive', json.load(file)))
+                    except (OSError, ValueError):
+                        continue  # replaced while reading
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return res
+
+    def _fold_dead(self) -> Dict:
+        """
+        add the counters and histograms of the processes that are gone to those of the processes gone before, kept in
+        `exited.json`, and delete their files, so that METRICS_DIR does not grow as uWSGI replaces its workers.
+        Must be called with the lock of METRICS_DIR held.
+        :return: the metrics of all processes that are gone
+        """
+        path = os.path.join(self.directory, 'exited.json')
+        try:
+            with open(path) as file:
+                snapshots = [json.load(file)]
+        except (OSError, ValueError):
+            snapshots = []
+        dead = []
+        for pid_path in glob.glob(os.path.join(self.directory, '[0-9]*.json')):
+            pid = int(os.path.splitext(os.path.basename(pid_path))[0])
+            if pid == os.getpid() or pid_alive(pid):
+                continue
+            try:
+                with open(pid_path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+            dead.append(pid_path)
+        if not dead:
+            return snapshots[0] if snapshots else {}
+        totals = self._sum([('dead', snapshot) for snapshot in snapshots])
+        exited = {name: [[list(key), value] for key, value in values.items()] for name, values in totals.items()}
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(exited, file)
+        os.replace(f'{path}.tmp', path)
+        for pid_path in dead:
+            os.remove(pid_path)
+        return exited
+
+    def _sum(self, snapshots: List[Tuple[str, Dict]]) -> Dict[str, Dict[Tuple[str, ...], object]]:
+        """
+        :param snapshots: the state and metrics of processes, as returned by _snapshots
+        :return: the values of each metric by labels, summed over the processes. Gauges of dead processes are left
+        out, and machine-wide gauges are only taken from the current process.
+        """
+        totals = {name: {} for name in self._metrics}
+        for state, snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                if isinstance(metric, Gauge) and (state == 'dead' or metric.machine_wide and state != 'current'):
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    if isinstance(metric, Histogram):
+                        counts, total, count = totals[name].get(key) or ([0] * len(metric.buckets), 0, 0)
+                        totals[name][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1],
+                                             count + value[2])
+                    else:
+                        totals[name][key] = totals[name].get(key, 0) + value
+        return totals
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the Prometheus text format, summed over all processes
+        """
+        totals = self._sum(self._snapshots())
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(totals[name].items()):
+                labels = list(zip(metric.labels, key))
+                if isinstance(metric, Histogram):
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(metric.buckets, counts):
+                        cumulative += bucket_count
+                        le = '+Inf' if bound == math.inf else repr(float(bound))
+                        lines.append(f'{name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {count}')
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+registry = Registry(METRICS_DIR)
+
+STAGE_SECONDS = registry.histogram('metamapy_stage_seconds', 'Duration of each stage of a request.', ('stage',))
+CACHE_REQUESTS = registry.counter('metamapy_cache_requests_total', 'Cache lookups by cache and result.',
+                                  ('cache', 'result'))
+UPSTREAM_SECONDS = registry.histogram('metamapy_upstream_request_seconds', 'Latency of OMIM and PubMed requests.',
+                                      ('source',))
+UPSTREAM_ERRORS = registry.counter('metamapy_upstream_errors_total', 'Failed OMIM and PubMed requests.', ('source',))
+REQUEST_ARTICLES = registry.histogram('metamapy_request_articles', 'Number of articles of each MetaMap run.',
+                                      buckets=COUNT_BUCKETS)
+REQUEST_TERMS = registry.histogram('metamapy_request_terms', 'Number of terms found by each MetaMap run.',
+                                   buckets=COUNT_BUCKETS)
+METAMAP_TIMEOUTS = registry.counter('metamapy_metamap_timeouts_total', 'Articles MetaMap timed out on.')
+POOL_PENDING = registry.gauge('metamapy_pool_pending_jobs', 'MetaMap jobs waiting for a worker of the pool.')
+POOL_BUSY_SECONDS = registry.counter('metamapy_pool_busy_seconds_total', 'Seconds each pool worker spent on jobs.',
+                                     ('worker',))
+SLOTS_JOBS = registry.gauge('metamapy_slots_jobs', 'MetaMap jobs waiting for or holding a machine-wide slot.',
+                            ('state',), machine_wide=True)
+HTTP_REQUESTS = registry.histogram('metamapy_http_request_seconds', 'Latency of API requests.',
+                                   ('endpoint', 'method', 'status'))
+
+_timings = threading.local()
+
+
+def start_timing() -> None:
+    """
+    start collecting the stage durations of the request served by this thread
+    """
+    _timings.stages = []
+
+
+def stop_timing() -> List[Tuple[str, float]]:
+    """
+    :return: (stage, seconds) of each stage recorded since start_timing
+    """
+    stages = getattr(_timings, 'stages', None) or []
+    _timings.stages = None
+    return stages
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """
+    record the duration of a stage, in the stage histogram and in the timings of the current request if any
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    stages = getattr(_timings, 'stages', None)
+    if stages is not None:
+        stages.append((stage, seconds))
+
+
+def server_timing(stages: List[Tuple[str, float]]) -> str:
+    """
+    :return: the value of a `Server-Timing` header reporting the stages, in milliseconds
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in stages)
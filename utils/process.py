@@ -0,0 +1,15 @@
+import os
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    :param pid: id of a process on this machine
+    :return: whether the process is still running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, but belongs to another user
+    return True
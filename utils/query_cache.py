@@ -1,31 +1,33 @@
-from typing import List, Union
-from utils.logger import logger
 import os
+import time
+from typing import Any, List, Union
+from utils import fast_json
+from utils.logger import logger
+from utils.cache_backend import get_backend
+from utils.metrics import CACHE_REQUESTS
+from utils.snapshot import Snapshot
 
 
 class QueryCache:
     """
-    MRU cache using singleton constructor
+    LRU cache of query results with expiring entries, bounded in both entries and bytes.
+    When CACHE_PATH is set, the cache is shared by all app processes and survives restarts.
+    Configured with CACHE_SIZE (entries), CACHE_MAX_BYTES and CACHE_TTL (seconds).
     """
-    class __QueryCache:
-        def __init__(self):
-            _cache_size = int(os.getenv('CACHE_SIZE', 30))
-            logger.info(f'CACHE_SIZE={_cache_size}')
-            self.max_size = _cache_size
-            self._cache = {}  # a dict that uses RSID as key and the result list as value
-            self._mru = []  # head is LRU(Least Recently Used) and tail is MRU
-            logger.info(f'QueryCache created with max_size={self.max_size}')
-
-    instance = None
+    namespace = 'query'
+    env_prefix = 'CACHE'
+    default_size = 30
 
     def __init__(self):
-        if not self.instance:
-            self.instance = self.__QueryCache()
-        else:
-            logger.debug(f'Using QueryCache singleton with max_size={self.max_size}')
-
-    def __getattr__(self, name):
-        return getattr(self.instance, name)
+        max_size = int(os.getenv(f'{self.env_prefix}_SIZE', self.default_size))
+        max_bytes = int(os.getenv(f'{self.env_prefix}_MAX_BYTES', 64 * 1024 * 1024))
+        ttl = float(os.getenv(f'{self.env_prefix}_TTL', 7 * 24 * 3600))
+        logger.info(f'{self.env_prefix}_SIZE={max_size}, {self.env_prefix}_MAX_BYTES={max_bytes}, '
+                    f'{self.env_prefix}_TTL={ttl}')
+        self.max_size = max_size
+        self.ttl = ttl
+        self._backend = get_backend(self.namespace, max_size, max_bytes, ttl)
+        logger.info(f'{type(self).__name__} created with max_size={self.max_size}')
 
     def __contains__(self, key: str) -> bool:
         """
@@ -33,47 +35,62 @@ class QueryCache:
         :param key: key of the data
         :return: True if it's cached, False otherwise
         """
-        return key in self._mru
+        return key in self._backend
 
-    def memorize(self, key: str, value: List) -> None:
+    def memorize(self, key: str, value: List, ttl: float = None) -> None:
         """
         Add a key value pair to cache.
-        If cache exceeds the size, remove the LRU element
-        If it already exists, update the _mru
+        If cache exceeds its bounds, LRU elements are removed.
         :param key: the key of the data to cache
         :param value: the value of the data to cache
+        :param ttl: time to live of this entry in seconds, defaults to the cache TTL
         """
-        if len(self._mru) < self.max_size:   # cache has space
-            if key in self:
-                self._mru.remove(key)    # remove previous position in MRU cache
-                logger.debug(f'updating MRU cache.')
-        else:   # cache is full
-            logger.debug(f'cache is full.')
-            self._forget()
-        self._mru.append(key)  # append to tail of MRU
-        self._cache[key] = value     # add to cache
+        self._backend.set(key, self._encode(value), ttl=ttl)
         logger.debug(f'{key} cached.')
 
-    def _forget(self):
-        """
-        if _cache is not empty, remove LRU element from both _mru and _cache
-        """
-        if len(self._mru):
-            logger.debug(f'removing LRU element from cache.')
-            key = self._mru[0]
-            self._mru.remove(key)
-            self._cache.pop(key, None)
-            logger.debug(f'{key} removed from cache.')
-
     def get(self, key: str) -> Union[List, None]:
         """
         If the key has been cached, return the value and update MRU. If not, return None and do nothing else.
         :param key:
         :return:
         """
-        if key in self:
-            # update LRU
-            self._mru.remove(key)
-            self._mru.append(key)
-            logger.debug(f'{key} hits cache.')
-        return self._cache.get(key, None)
+        value = self._backend.get(key)
+        CACHE_REQUESTS.inc(cache=self.namespace, result='miss' if value is None else 'hit')
+        if value is None:
+            return None
+        logger.debug(f'{key} hits cache.')
+        return self._decode(value)
+
+    @classmethod
+    def _encode(cls, value: Any) -> bytes:
+        return fast_json.dumps(value)
+
+    @classmethod
+    def _decode(cls, data: bytes) -> Any:
+        return fast_json.loads(data)
+
+    def recent_keys(self, limit: int) -> List[str]:
+        """
+        :param limit: max number of keys
+        :return: the keys used most recently, most recent first
+        """
+        return self._backend.recent_keys(limit)
+
+    def load_snapshot(self, path: str) -> int:
+        """
+        Load the entries of a snapshot that are not expired, keeping their remaining time to live. Keys already cached
+        are skipped, since they are fresher. The hottest entries are loaded last, so that they are the last evicted.
+        :param path: path of a Snapshot
+        :return: number of entries loaded
+        """
+        now = time.time()
+        entries = sorted(Snapshot(path).latest().values(), key=lambda entry: entry.get('rank', 0), reverse=True)
+        loaded = 0
+        for entry in entries:
+            ttl = entry['created_at'] + self.ttl - now
+            if ttl <= 0 or entry['key'] in self:
+                continue
+            self.memorize(entry['key'], entry['value'], ttl=ttl)
+            loaded += 1
+        logger.info(f'{loaded} of {len(entries)} entries loaded from snapshot {path}')
+        return loaded
@@ -0,0 +1,123 @@
+import hashlib
+import struct
+import zlib
+from typing import Dict, List, Tuple, Union
+from utils import fast_json
+from utils.logger import logger
+from utils.metrics import CACHE_REQUESTS
+from utils.query_cache import QueryCache
+
+"""
+Bodies are compressed once, when they are cached, at the highest levels that stay cheap next to computing them.
+brotli is optional, clients are offered br only when it is installed.
+"""
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+class PreparedBody:
+    """
+    A response body serialized ahead of time, with its compressed encodings and a fingerprint to use as ETag.
+    Packed into bytes as a magic number, the length of a JSON header (etag and size of each encoding) and the
+    encodings one after the other, so that serving a hit only copies the encoding it sends.
+    """
+    _MAGIC = b'\0pb1'  # never the first bytes of JSON, so packed bodies and plain JSON values can be told apart
+    _LENGTH = struct.Struct('>I')
+
+    def __init__(self, data: bytes, etag: str, offsets: Dict[str, Tuple[int, int]]):
+        """
+        :param data: the buffer holding the encodings
+        :param etag: fingerprint of the identity encoding
+        :param offsets: start and end of each encoding in data, by name
+        """
+        self._data = data
+        self.etag = etag
+        self._offsets = offsets
+
+    @property
+    def encodings(self) -> List[str]:
+        """
+        :return: the available encodings, smallest first, ending with identity
+        """
+        return list(self._offsets)
+
+    def encoded(self, encoding: str = 'identity') -> bytes:
+        start, end = self._offsets[encoding]
+        return self._data[start:end]
+
+    @classmethod
+    def build(cls, body: bytes) -> 'PreparedBody':
+        """
+        :param body: the identity encoding
+        :return: the body along with its compressed encodings that are smaller than it
+        """
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        encodings = {'gzip': compressor.compress(body) + compressor.flush()}
+        if brotli is not None:
+            encodings['br'] = brotli.compress(body, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        encodings = {name: data for name, data in sorted(encodings.items(), key=lambda item: len(item[1]))
+                     if len(data) < len(body)}
+        encodings['identity'] = body
+        offsets, start = {}, 0
+        for name, data in encodings.items():
+            offsets[name] = (start, start + len(data))
+            start += len(data)
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        return cls(b''.join(encodings.values()), etag, offsets)
+
+    def pack(self) -> bytes:
+        header = fast_json.dumps({'etag': self.etag, 'offsets': self._offsets})
+        return b''.join([self._MAGIC, self._LENGTH.pack(len(header)), header, self._data])
+
+    @classmethod
+    def unpack(cls, data: bytes) -> Union['PreparedBody', None]:
+        """
+        :param data: bytes written by pack
+        :return: the body, or None if data was not written by pack
+        """
+        if not data.startswith(cls._MAGIC):
+            return None
+        start = len(cls._MAGIC) + cls._LENGTH.size
+        end = start + cls._LENGTH.unpack_from(data, len(cls._MAGIC))[0]
+        header = fast_json.loads(data[start:end])
+        offsets = {name: (first + end, last + end) for name, (first, last) in header['offsets'].items()}
+        return cls(data, header['etag'], offsets)
+
+
+class ResponseCache(QueryCache):
+    """
+    Query cache whose entries hold the `/term` response body of each result, serialized and compressed when it is
+    cached rather than on every hit. Values written by the plain query cache are still read.
+    Configured like the query cache, with CACHE_SIZE, CACHE_MAX_BYTES and CACHE_TTL.
+    """
+
+    def get_response(self, key: str) -> Union[PreparedBody, None]:
+        """
+        If the key has been cached, return its prepared response body and update MRU. Only hits are counted, since a
+        miss is followed by a regular lookup.
+        :param key: the key of the data
+        :return: the prepared body, or None if the key is not cached or was cached by an older version
+        """
+        value = self._backend.get(key)
+        body = PreparedBody.unpack(value) if value is not None else None
+        if body is None:
+            return None
+        CACHE_REQUESTS.inc(cache=self.namespace, result='hit')
+        logger.debug(f'{key} hits cache.')
+        return body
+
+    @classmethod
+    def _encode(cls, value: List) -> bytes:
+        return PreparedBody.build(fast_json.dumps({'terms': value})).pack()
+
+    @classmethod
+    def _decode(cls, data: bytes) -> List:
+        body = PreparedBody.unpack(data)
+        if body is None:
+            return fast_json.loads(data)
+        return fast_json.loads(body.encoded())['terms']
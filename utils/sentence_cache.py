@@ -0,0 +1,12 @@
+from utils.article_cache import ArticleCache
+
+
+class SentenceCache(ArticleCache):
+    """
+    Cache of parsed MetaMap output per sentence, keyed by the normalized sentence and the MetaMap options.
+    Used when METAMAP_SENTENCE_CACHE is on, so that sentences shared by many articles go through MetaMap once.
+    Configured with SENTENCE_CACHE_SIZE (entries), SENTENCE_CACHE_MAX_BYTES and SENTENCE_CACHE_TTL (seconds).
+    """
+    namespace = 'sentence'
+    env_prefix = 'SENTENCE_CACHE'
+    default_size = 100000
@@ -0,0 +1,85 @@
+import fcntl
+import hashlib
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Union
+from utils.logger import logger
+from utils.cache_backend import CACHE_PATH
+
+"""
+SINGLE_FLIGHT_LOCK_DIR is optional, defines the folder of the lock files used to coalesce identical requests across
+processes. Defaults to `<CACHE_PATH>.locks` when the cache is shared, otherwise requests are only coalesced within
+a process, since followers in other processes would have no way to read the result of the leader.
+SINGLE_FLIGHT_STRIPES is optional, defines the number of lock files keys are hashed into, defaults to 1024.
+"""
+SINGLE_FLIGHT_LOCK_DIR = os.getenv('SINGLE_FLIGHT_LOCK_DIR', f'{CACHE_PATH}.locks' if CACHE_PATH else None)
+SINGLE_FLIGHT_STRIPES = int(os.getenv('SINGLE_FLIGHT_STRIPES', 1024))
+logger.info(f'SINGLE_FLIGHT_LOCK_DIR={SINGLE_FLIGHT_LOCK_DIR}')
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing the same key, so that only the first one (the leader) computes.
+    Within a process, followers wait on the future of the leader.
+    Across processes, the leader holds a file lock while computing. Followers block on that lock and then look the
+    result up (e.g. in the shared cache the leader has written to) before computing by themselves.
+    """
+
+    def __init__(self, lock_dir: str = SINGLE_FLIGHT_LOCK_DIR, stripes: int = SINGLE_FLIGHT_STRIPES):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> Future of the leader
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key: str, compute: Callable[[], Any], lookup: Callable[[], Union[Any, None]] = None) -> Any:
+        """
+        compute the value of a key, or wait for the identical call that is already computing it
+        :param key: identifies identical calls
+        :param compute: computes the value
+        :param lookup: returns the value if another process has computed it already, None otherwise.
+        Calls are only coalesced across processes when it is given.
+        :return: the value
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+        if not leader:
+            logger.info(f'waiting for the in-flight request of {key}.')
+            return future.result()
+
+        try:
+            if self.lock_dir and lookup is not None:
+                value = self._do_locked(key, compute, lookup)
+            else:
+                value = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _do_locked(self, key: str, compute: Callable[[], Any], lookup: Callable[[], Union[Any, None]]) -> Any:
+        stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % self.stripes
+        with open(os.path.join(self.lock_dir, f'{stripe}.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # another process is computing, wait for it and use its result
+                logger.info(f'waiting for the in-flight request of {key} in another process.')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                value = lookup()
+                if value is not None:
+                    return value
+            try:
+                return compute()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,68 @@
+import gzip
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, Iterator
+
+from utils.logger import logger
+
+
+class Snapshot:
+    """
+    A compact file of query results, as gzip-compressed JSON lines of `key`, `value`, `created_at` (epoch seconds)
+    and `rank` (lower is hotter). Each entry is flushed as soon as it is appended, so a snapshot cut short by a crash
+    is still readable up to its last complete entry.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def read(self) -> Iterator[Dict]:
+        """
+        :return: yields the entries of the snapshot, in the order they were written
+        """
+        if not os.path.exists(self.path):
+            return
+        with gzip.open(self.path, 'rt') as file:
+            try:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logger.error(f'skipping a truncated entry of snapshot {self.path}')
+            except (EOFError, OSError, zlib.error) as e:
+                logger.error(f'snapshot {self.path} is truncated, entries after the last complete one are lost. {e}')
+
+    def latest(self) -> Dict[str, Dict]:
+        """
+        :return: the last entry written for each key
+        """
+        return {entry['key']: entry for entry in self.read()}
+
+    def write(self, entries: Iterable[Dict]) -> None:
+        """
+        replace the snapshot with the entries, atomically
+        """
+        with gzip.open(f'{self.path}.tmp', 'wt') as file:
+            for entry in entries:
+                file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def append(self, entry: Dict) -> None:
+        """
+        append an entry, readable as soon as this returns. Entries of a key appended later replace earlier ones.
+        """
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'at')
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self._file.flush()  # gzip sync flush, the entry can be decompressed without closing the file
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,25 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteConnections:
+    """
+    Hand out one SQLite connection per thread and per process, since connections must neither be shared across
+    threads nor across forks. Connections are in autocommit mode with WAL journaling, so that readers do not block
+    writers of other processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
@@ -0,0 +1,110 @@
+"""
+Precompute the `/term` results of a list of rsIDs, so that the first users of popular terms do not pay for OMIM,
+PubMed and MetaMap after a deploy. Results are cached, and written to a snapshot that the app loads when it starts
+with CACHE_SNAPSHOT set. With CACHE_PATH set, the app processes also see them right away through the shared cache.
+
+The rsID file lists one term per line, hottest first. Terms already in the snapshot and younger than `--max-age` are
+skipped, so an interrupted run resumes where it stopped. With `--refresh`, terms are queried again every `--interval`
+seconds once their result is older than `--max-age`, before it expires from the cache. The keys used most recently in
+the shared cache are refreshed as well.
+
+    python warm_cache.py rsids.txt --snapshot cache_snapshot.gz --workers 4
+    python warm_cache.py rsids.txt --snapshot cache_snapshot.gz --refresh --interval 3600 --top 1000
+"""
+import settings  # load env before any imports
+import argparse
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+
+from libs.tagger import tagger_supervisor
+from libs.term_search import refresh_term, query_cache
+from utils.logger import logger
+from utils.snapshot import Snapshot
+
+WARM_PRIORITY = 1  # MetaMap jobs of interactive requests run at priority 0 and come first
+
+
+def read_terms(path: str) -> List[str]:
+    with open(path) as file:
+        terms = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(terms))  # keep the first, hottest, occurrence
+
+
+def warm(terms: List[str], snapshot: Snapshot, workers: int, max_age: float) -> Dict[str, int]:
+    """
+    query the terms whose snapshot entry is missing or older than max_age, appending results to the snapshot
+    :param terms: the terms to warm up, hottest first
+    :param snapshot: the snapshot to update
+    :param workers: number of terms queried at the same time
+    :param max_age: seconds after which a result is queried again
+    :return: number of terms `skipped`, `cached` and `failed`
+    """
+    now = time.time()
+    ranks = {term: rank for rank, term in enumerate(terms)}
+    entries = [entry for entry in snapshot.latest().values() if entry['created_at'] + query_cache.ttl > now]
+    for entry in entries:
+        entry['rank'] = ranks.get(entry['key'], len(terms))
+    snapshot.write(sorted(entries, key=lambda entry: entry['rank']))  # drop expired and replaced entries
+    fresh = {entry['key'] for entry in entries if now - entry['created_at'] < max_age}
+    todo = [term for term in terms if term not in fresh]
+    stats = {'skipped': len(terms) - len(todo), 'cached': 0, 'failed': 0}
+    logger.info(f'warming up {len(todo)} terms, {stats["skipped"]} already fresh in {snapshot.path}')
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warm') as executor:
+            futures = {executor.submit(refresh_term, term, WARM_PRIORITY, admit=False): term for term in todo}
+            for n, future in enumerate(as_completed(futures), 1):
+                term = futures[future]
+                try:
+                    body, status = future.result()
+                except Exception:
+                    logger.error(f'failed to query {term}.')
+                    logger.error(traceback.format_exc())
+                    body, status = {}, 500
+                if status == 200 and 'missing_sources' not in body and 'timed_out' not in body:
+                    snapshot.append({'key': term, 'value': body['terms'], 'created_at': time.time(),
+                                     'rank': ranks[term]})
+                    stats['cached'] += 1
+                else:  # no literature or partial result, not cached by the app either
+                    logger.info(f'{term} not cached, status {status}: {body.get("message", "partial result")}')
+                    stats['failed'] += 1
+                if n % 10 == 0 or n == len(todo):
+                    logger.info(f'{n} of {len(todo)} terms done, {stats}')
+    finally:
+        snapshot.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('terms', help='file of rsIDs, one per line, hottest first')
+    parser.add_argument('--snapshot', default='cache_snapshot.gz', help='path of the snapshot to write')
+    parser.add_argument('--workers', type=int, default=4, help='terms queried at the same time')
+    parser.add_argument('--max-age', type=float, help='seconds after which a result is queried again, '
+                                                      'defaults to 80%% of CACHE_TTL')
+    parser.add_argument('--refresh', action='store_true', help='keep refreshing the results periodically')
+    parser.add_argument('--interval', type=float, default=3600, help='seconds between two refreshes')
+    parser.add_argument('--top', type=int, help='max number of terms to refresh, hottest first')
+    args = parser.parse_args()
+
+    max_age = args.max_age if args.max_age is not None else 0.8 * query_cache.ttl
+    snapshot = Snapshot(args.snapshot)
+    if not tagger_supervisor.start_servers():
+        parser.exit(1, 'MetaMap or its servers are not available.\n')
+    while True:
+        terms = read_terms(args.terms)
+        if args.refresh:
+            terms = list(dict.fromkeys(terms + query_cache.recent_keys(args.top or len(terms) or 100)))
+        if args.top:
+            terms = terms[:args.top]
+        stats = warm(terms, snapshot, args.workers, max_age)
+        logger.info(f'warm-up of {len(terms)} terms done, {stats}')
+        if not args.refresh:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()